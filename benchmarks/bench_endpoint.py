@@ -0,0 +1,123 @@
+"""
+=============================
+Endpoint and connection costs
+=============================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+asv style benchmarks for endpoints. Can also be run directly, to compare
+with the former dict based representation:
+
+.. code:: bash
+
+    python benchmarks/bench_endpoint.py
+"""
+
+import logging
+import time
+import tracemalloc
+
+from pyxnet.topology.endpoint import Endpoint, Endpoint_Connection, Endpoint_Kind
+
+N = 100_000
+
+
+class _Parent:
+    def __init__(self, name):
+        self.name = name
+
+
+class _Dict_Endpoint:
+    """
+    Former representation, for comparison: instance dict, logger and
+    properties dict per endpoint, path formatted on each hash.
+    """
+
+    def __init__(self, name, kind, parent):
+        self.log        = logging.getLogger(f"Endpoint {name}")
+        self.name       = name
+        self.kind       = kind
+        self.parent     = parent
+        self._ifname    = None
+        self.properties = dict()
+
+    @property
+    def path(self):
+        return f"{self.parent.name}/{self.name}"
+
+    def __hash__(self):
+        return str.__hash__(self.path)
+
+    def __eq__(self, other):
+        return self.path == other.path
+
+
+def _endpoints(cls, n=N):
+    parents = [_Parent(f"sw{i}") for i in range(n // 2)]
+    return [cls(f"p{j}", Endpoint_Kind.Virtual, parent) for parent in parents for j in range(2)]
+
+
+##############################
+# Benchmarks
+##############################
+
+class Endpoint_Suite:
+    def setup(self):
+        self.endpoints = _endpoints(Endpoint)
+        self.conns     = [Endpoint_Connection(a, b) for a, b in zip(self.endpoints[0::2], self.endpoints[1::2])]
+        self.ep_set    = set(self.endpoints)
+        self.conn_set  = set(self.conns)
+
+    def time_create(self):
+        _endpoints(Endpoint)
+
+    def time_endpoint_set(self):
+        set(self.endpoints)
+
+    def time_endpoint_lookup(self):
+        ep_set = self.ep_set
+        for ep in self.endpoints:
+            ep in ep_set
+
+    def time_connection_set(self):
+        set(self.conns)
+
+    def time_connection_lookup(self):
+        conn_set = self.conn_set
+        for conn in self.conns:
+            conn in conn_set
+
+    def peakmem_create(self):
+        _endpoints(Endpoint)
+
+
+##############################
+# Direct comparison
+##############################
+
+def _measure(cls):
+    t_start  = time.perf_counter()
+    eps      = _endpoints(cls)
+    t_create = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    for _ in range(10):
+        ep_set = set(eps)
+        for ep in eps:
+            ep in ep_set
+    t_set = (time.perf_counter() - t_start) / 10
+
+    del eps, ep_set
+    tracemalloc.start()
+    eps     = _endpoints(cls)
+    mem, _  = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return t_create, mem, t_set
+
+
+if __name__ == "__main__":
+    for label, cls in (("dict", _Dict_Endpoint), ("slots", Endpoint)):
+        t_create, peak, t_set = _measure(cls)
+        print(f"{label:>6}: create {t_create*1000:8.1f} ms, memory {peak/1e6:7.1f} MB, set build+lookup {t_set*1000:7.1f} ms ({N} endpoints)")
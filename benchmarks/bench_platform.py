@@ -0,0 +1,87 @@
+"""
+===============================
+Instanciation and cleanup costs
+===============================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+asv benchmarks of the host operations, against the stand-ins of
+benchmarks/stubs.py: ovs-vsctl, ovs-dpctl, netlink and NDB calls sleep
+for a realistic latency instead of changing the host. With the "none"
+latency, only the time spent in pyxnet is measured.
+"""
+
+import asyncio
+
+from pyxnet.platform import cleanup
+
+from .stubs      import Stub_Host, Stub_Latency
+from .topologies import PLATFORM_SIZES, ring
+
+
+LATENCIES = {
+    "host": Stub_Latency(),
+    "none": Stub_Latency(**{name: 0.0 for name in Stub_Latency.__dataclass_fields__}),
+}
+
+
+class _Platform_Suite:
+    params      = (PLATFORM_SIZES, list(LATENCIES))
+    param_names = ["nodes", "latency"]
+
+    # Each operation changes the stand-in host state: one call per setup
+    number      = 1
+    repeat      = 5
+    timeout     = 300
+
+    def setup(self, n, latency):
+        self.host = Stub_Host(LATENCIES[latency]).__enter__()
+        self.topo = ring(n)
+        self.topo.plan()
+
+    def teardown(self, n, latency):
+        self.host.__exit__(None, None, None)
+
+
+##############################
+# Instanciation
+##############################
+
+class Instanciate_Suite(_Platform_Suite):
+    def time_instanciate(self, n, latency):
+        self.topo.instanciate()
+
+    def time_instanciate_sequential(self, n, latency):
+        self.topo.instanciate(workers=1)
+
+    def time_instanciate_async(self, n, latency):
+        asyncio.run(self.topo.instanciate_async())
+
+
+##############################
+# Instanciated topology
+##############################
+
+class Instanciated_Suite(_Platform_Suite):
+    def setup(self, n, latency):
+        super().setup(n, latency)
+        self.topo.instanciate()
+
+    def time_up(self, n, latency):
+        self.topo.up()
+
+    def time_remove(self, n, latency):
+        self.topo.remove()
+
+    def time_remove_async(self, n, latency):
+        asyncio.run(self.topo.remove_async())
+
+    def time_cleanup_all(self, n, latency):
+        cleanup.cleanup_all()
+
+    def time_cleanup_all_parallel(self, n, latency):
+        cleanup.cleanup_all(parallel=True)
+
+    def time_reconcile_unchanged(self, n, latency):
+        self.topo.reconcile()
@@ -0,0 +1,180 @@
+"""
+==========================
+Topology declaration costs
+==========================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+asv benchmarks of the pure-Python parts of a topology: construction
+with register/connect, graphviz export and planning. Nothing is done
+on the host.
+"""
+
+import shutil
+import tempfile
+
+from pyxnet.topology                 import analysis, export
+from pyxnet.topology.objects.topology import Topology
+
+from .topologies import SIZES, ring, ring_pairs, switches
+
+
+##############################
+# Construction
+##############################
+
+class Construction_Suite:
+    params      = SIZES
+    param_names = ["nodes"]
+
+    # Objects can only be registered once: one call per setup
+    number      = 1
+    repeat      = 5
+    timeout     = 300
+
+    def setup(self, n):
+        self.objs  = switches(n)
+        self.fresh = switches(n) # Not registered yet
+
+        self.topo  = Topology(name="bench")
+        self.topo.register_many(self.objs)
+
+    def time_switches(self, n):
+        switches(n)
+
+    def time_register(self, n):
+        Topology(name="bench").register_many(self.fresh)
+
+    def time_register_one_by_one(self, n):
+        topo = Topology(name="bench")
+        for obj in self.fresh:
+            topo.register(obj)
+
+    def time_connect(self, n):
+        self.topo.connect_many(ring_pairs(self.objs))
+
+    def time_connect_one_by_one(self, n):
+        for a, b in ring_pairs(self.objs):
+            self.topo.connect(a, b)
+
+    def time_ring(self, n):
+        ring(n)
+
+    def peakmem_ring(self, n):
+        ring(n)
+
+
+##############################
+# Graphviz export
+##############################
+
+class Graphviz_Suite:
+    params      = SIZES
+    param_names = ["nodes"]
+    timeout     = 300
+
+    def setup(self, n):
+        self.topo = ring(n)
+
+    def time_export_graphviz(self, n):
+        self.topo.export_graphviz(large=False).source
+
+    def time_write_dot(self, n):
+        self.topo.write_dot(large=False)
+
+    def time_write_dot_large(self, n):
+        self.topo.write_dot(large=True)
+
+    def time_dot_pages(self, n):
+        self.topo.dot_pages()
+
+
+##############################
+# Machine-readable export
+##############################
+
+class _Null_Output:
+    def write(self, chunk):
+        pass
+
+
+class Export_Suite:
+    params      = SIZES
+    param_names = ["nodes"]
+    timeout     = 300
+
+    def setup(self, n):
+        self.topo = ring(n)
+
+    def time_write_json(self, n):
+        export.write_json(self.topo, _Null_Output())
+
+    def time_write_graphml(self, n):
+        export.write_graphml(self.topo, _Null_Output())
+
+    def peakmem_write_json(self, n):
+        export.write_json(self.topo, _Null_Output())
+
+
+##############################
+# Graph analysis
+##############################
+
+class Analysis_Suite:
+    params      = SIZES
+    param_names = ["nodes"]
+    timeout     = 300
+
+    def setup(self, n):
+        self.topo = ring(n)
+        self.far  = f"sw{n // 2}"
+
+    def time_components(self, n):
+        self.topo.invalidate()
+        analysis.components(self.topo)
+
+    def time_loops(self, n):
+        self.topo.invalidate()
+        analysis.loops(self.topo)
+
+    def time_shortest_path(self, n):
+        analysis.shortest_path(self.topo, "sw0", self.far)
+
+
+##############################
+# Planning
+##############################
+
+class Plan_Suite:
+    params      = SIZES
+    param_names = ["nodes"]
+    timeout     = 600
+
+    def setup(self, n):
+        self.cache_dir = tempfile.mkdtemp(prefix="pyxnet-bench-")
+
+        self.topo   = ring(n)
+        self.cached = ring(n, plan_cache=self.cache_dir)
+        self.cached.plan() # Stored in the cache
+
+    def teardown(self, n):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def time_plan(self, n):
+        self.topo.invalidate()
+        self.topo.plan()
+
+    def time_plan_from_cache(self, n):
+        self.cached.invalidate()
+        self.cached.plan()
+
+    def time_content_hash(self, n):
+        self.topo.content_hash()
+
+    def time_snapshot(self, n):
+        self.topo.plan().snapshot()
+
+    def peakmem_plan(self, n):
+        self.topo.invalidate()
+        self.topo.plan()
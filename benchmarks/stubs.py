@@ -0,0 +1,394 @@
+"""
+=======================
+Host platform stand-ins
+=======================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+Stand-ins for ovs-vsctl, ovs-dpctl, netlink sockets, NDB and network
+namespaces, so that instanciation and cleanup can be benchmarked without
+root access or openvswitch. Each call sleeps for a latency close to the
+one measured on a real host, and keeps track of the created bridges,
+datapaths, interfaces and addresses so that scans and removals see them.
+
+.. code:: python
+
+    with Stub_Host() as host:
+        topo.instanciate()
+        print(host.calls)
+"""
+
+import asyncio
+import itertools
+import subprocess
+import time
+
+from dataclasses           import dataclass
+
+from pyroute2.netlink.rtnl import RTM_NEWLINK, RTM_DELLINK, RTM_NEWADDR, RTM_DELADDR
+
+from pyxnet.platform.tools import ovs, netlink
+
+
+##############################
+# Latencies
+##############################
+
+@dataclass
+class Stub_Latency:
+    """
+    Simulated latencies, in seconds
+    """
+
+    vsctl_call: float      = 0.008
+    """Process start and OVSDB transaction of an ovs-vsctl call"""
+
+    vsctl_command: float   = 0.0002
+    """Each command of an ovs-vsctl call"""
+
+    dpctl_call: float      = 0.004
+    netlink_message: float = 0.00002
+    netlink_dump: float    = 0.0005
+    ndb_start: float       = 0.05
+    """NDB loads the whole interfaces database on start"""
+
+    ndb_commit: float      = 0.001
+    netns: float           = 0.002
+
+
+##############################
+# Netlink
+##############################
+
+class _Attrs(dict):
+    # Enough of pyroute2 messages for link dumps
+    def __init__(self, attrs, **fields):
+        super().__init__(fields)
+        self.attrs = attrs
+
+    def get_attr(self, name):
+        return self.attrs.get(name, None)
+
+
+def _attr(msg, name):
+    for nla in msg["attrs"]:
+        if nla[0] == name:
+            return nla[1]
+    return None
+
+
+def _peer_name(msg):
+    # The peer of a veth request is a nested message given as a dict
+    info = _attr(msg, "IFLA_LINKINFO") or {}
+    for nla in info.get("attrs", ()):
+        if nla[0] == "IFLA_INFO_DATA":
+            for sub in nla[1].get("attrs", ()):
+                if sub[0] == "VETH_INFO_PEER":
+                    return _attr(sub[1], "IFLA_IFNAME")
+    return None
+
+
+class _Stub_IPRoute:
+    def __init__(self, host, netns):
+        self.host  = host
+        self.netns = netns
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _handle(self, msg):
+        links = self.host.links.setdefault(self.netns, dict())
+        kind  = msg["header"]["type"]
+
+        if kind == RTM_NEWLINK:
+            name = _attr(msg, "IFLA_IFNAME")
+            peer = _peer_name(msg)
+            if _attr(msg, "IFLA_LINKINFO") is not None:
+                links[name] = self.host.new_link(name, "veth", peer)
+                if peer is not None:
+                    links[peer] = self.host.new_link(peer, "veth", name)
+            else:
+                link  = self.host.find(links, name, msg["index"])
+                group = _attr(msg, "IFLA_GROUP")
+                if (link is not None) and (group is not None):
+                    link.attrs["IFLA_GROUP"] = group
+
+        elif kind == RTM_DELLINK:
+            group = _attr(msg, "IFLA_GROUP")
+            if group is not None:
+                for x in [v for v in links.values() if v.attrs["IFLA_GROUP"] == group]:
+                    self._delete(links, x)
+            else:
+                link = self.host.find(links, _attr(msg, "IFLA_IFNAME"), msg["index"])
+                if link is not None:
+                    self._delete(links, link)
+
+        elif kind in (RTM_NEWADDR, RTM_DELADDR):
+            self._address(kind == RTM_NEWADDR, msg["index"], f"{_attr(msg, 'IFA_ADDRESS')}/{msg['prefixlen']}")
+
+    def _address(self, present, index, address):
+        link = self.host.find(self.host.links.get(self.netns, dict()), None, index)
+        if link is not None:
+            self.host.set_address(self.netns, link.attrs["IFLA_IFNAME"], address, present)
+
+    def _delete(self, links, link):
+        # Removing a veth removes its peer
+        for x in (link.attrs["IFLA_IFNAME"], link.peer):
+            links.pop(x, None)
+            self.host.addresses.pop((self.netns, x), None)
+
+    def nlm_request_batch(self, msgs, noraise=False):
+        self.host.sleep(self.host.latency.netlink_message * len(msgs))
+        for msg in msgs:
+            msg["header"]["sequence_number"] = next(self.host.sequence)
+            self._handle(msg)
+            yield {"header": {"sequence_number": msg["header"]["sequence_number"], "error": None}}
+
+    def nlm_request(self, msg, msg_type=None, msg_flags=None):
+        list(self.nlm_request_batch([msg]))
+
+    def get_links(self):
+        self.host.sleep(self.host.latency.netlink_dump)
+        return list(self.host.links.get(self.netns, dict()).values())
+
+    def link_lookup(self, ifname):
+        link = self.host.links.get(self.netns, dict()).get(ifname, None)
+        return [link["index"]] if link is not None else []
+
+    def link(self, command, **kwarg):
+        self.host.sleep(self.host.latency.netlink_message)
+
+        link = self.host.find(self.host.links.get(self.netns, dict()), None, kwarg.get("index", None))
+        if (command == "set") and (link is not None) and ("address" in kwarg):
+            link["address"] = kwarg["address"]
+
+    def addr(self, command, **kwarg):
+        self.host.sleep(self.host.latency.netlink_message)
+        self._address(command != "del", kwarg["index"], kwarg["address"])
+
+    def tc(self, command, **kwarg):
+        self.host.sleep(self.host.latency.netlink_message)
+
+
+class _Stub_Interface:
+    def __init__(self, host, netns, name, link):
+        self.host  = host
+        self.netns = netns
+        self.name  = name
+        self.link  = link
+
+    def __getitem__(self, key):
+        return self.link.get(key, None)
+
+    def set(self, key, value):
+        self.link[key] = value
+        return self
+
+    @property
+    def ipaddr(self):
+        return set(self.host.addresses.get((self.netns, self.name), ()))
+
+    def add_ip(self, address):
+        self.host.set_address(self.netns, self.name, address, True)
+        return self
+
+    def del_ip(self, address):
+        self.host.set_address(self.netns, self.name, address, False)
+        return self
+
+    def remove(self):
+        links = self.host.links.get(self.netns, dict())
+        if self.name in links:
+            _Stub_IPRoute(self.host, self.netns)._delete(links, links[self.name])
+        return self
+
+    def commit(self):
+        self.host.sleep(self.host.latency.ndb_commit)
+        return self
+
+
+class _Stub_NDB:
+    def __init__(self, host, netns):
+        self.host  = host
+        self.netns = netns
+        host.sleep(host.latency.ndb_start)
+
+    def __getitem__(self, name):
+        # ndb.interfaces[name]
+        link = self.host.links.get(self.netns, dict()).get(name, None)
+        if link is None:
+            raise KeyError(name)
+        return _Stub_Interface(self.host, self.netns, name, link)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    @property
+    def interfaces(self):
+        return self
+
+
+class _Stub_Netns:
+    def __init__(self, host):
+        self.host = host
+
+    def listnetns(self):
+        return [x for x in self.host.links if x is not None]
+
+    def create(self, name):
+        self.host.sleep(self.host.latency.netns)
+        self.host.links.setdefault(name, dict())
+
+    def remove(self, name):
+        self.host.sleep(self.host.latency.netns)
+        self.host.links.pop(name, None)
+
+
+##############################
+# Stand-in host
+##############################
+
+class Stub_Host:
+    """
+    Replaces the host tools for the duration of a with block.
+
+    :param latency: Simulated latencies, Stub_Latency() by default. Stub_Latency
+                    with all fields set to 0 measures the pyxnet overhead only.
+    """
+
+    def __init__(self, latency: Stub_Latency = None):
+        self.latency   = latency if latency is not None else Stub_Latency()
+
+        self.bridges   = set()
+        self.datapaths = set()
+        self.links     = {None: dict()} # Network namespace -> Interface name -> Link
+        self.addresses = dict()         # (Network namespace, interface name) -> Addresses
+        self.commands  = list()         # ovs-vsctl commands, with their options
+        self.calls     = {"vsctl": 0, "dpctl": 0, "ndb": 0}
+
+        self.sequence  = itertools.count(1)
+        self._index    = itertools.count(1)
+        self._saved    = None
+
+    def sleep(self, duration):
+        if duration > 0:
+            time.sleep(duration)
+
+    def new_link(self, name, kind, peer=None):
+        index = next(self._index)
+        link  = _Attrs(
+            {"IFLA_IFNAME": name, "IFLA_GROUP": 0, "IFLA_LINKINFO": _Attrs({"IFLA_INFO_KIND": kind})},
+            index   = index,
+            address = f"02:00:00:00:{index >> 8:02x}:{index & 0xFF:02x}",
+        )
+        link.peer = peer
+        return link
+
+    def find(self, links, name, index):
+        if name is not None:
+            return links.get(name, None)
+        return next((x for x in links.values() if x["index"] == index), None)
+
+    def set_address(self, netns, name, address, present):
+        addresses = self.addresses.setdefault((netns, name), set())
+        if present:
+            addresses.add(address)
+        else:
+            addresses.discard(address)
+
+
+    # ---------------- ovs-vsctl / ovs-dpctl
+
+    def vsctl(self, *args):
+        self.calls["vsctl"] += 1
+
+        # Split the call into commands, without the global options
+        commands = [list(g) for sep, g in itertools.groupby(args, lambda x: x == "--") if not sep]
+        self.commands.extend(commands)
+        commands = [[x for x in cmd if not x.startswith("--")] for cmd in commands]
+        commands = [cmd for cmd in commands if cmd]
+
+        self.sleep(self.latency.vsctl_call + self.latency.vsctl_command * len(commands))
+
+        stdout = ""
+        for cmd in commands:
+            # Bridges come with an internal interface of the same name
+            if   cmd[0] == "add-br":
+                self.bridges.add(cmd[1])
+                self.links[None][cmd[1]] = self.new_link(cmd[1], "openvswitch")
+            elif cmd[0] == "del-br":
+                self.bridges.discard(cmd[1])
+                self.links[None].pop(cmd[1], None)
+                self.addresses.pop((None, cmd[1]), None)
+            elif cmd[0] in ("list-br", "find"):
+                stdout = "".join(f"{x}\n" for x in sorted(self.bridges))
+
+        return subprocess.CompletedProcess(["ovs-vsctl", *args], 0, stdout.encode("utf-8"), b"")
+
+    def dpctl(self, *args):
+        self.calls["dpctl"] += 1
+        self.sleep(self.latency.dpctl_call)
+
+        stdout = ""
+        if   args[0] == "add-dp":
+            self.datapaths.add(args[1])
+        elif args[0] == "del-dp":
+            self.datapaths.discard(args[1])
+        elif args[0] == "dump-dps":
+            stdout = "".join(f"system@{x}\n" for x in sorted(self.datapaths))
+
+        return subprocess.CompletedProcess(["ovs-dpctl", *args], 0, stdout.encode("utf-8"), b"")
+
+    async def vsctl_async(self, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, self.vsctl, *args)
+
+    async def dpctl_async(self, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, self.dpctl, *args)
+
+
+    # ---------------- Netlink
+
+    def new_ndb(self, netns):
+        self.calls["ndb"] += 1
+        return _Stub_NDB(self, netns)
+
+    def new_ipr(self, netns):
+        return _Stub_IPRoute(self, netns)
+
+
+    # ---------------- Patching
+
+    def __enter__(self):
+        replaced = (
+            (ovs    , "vsctl"         , self.vsctl),
+            (ovs    , "dpctl"         , self.dpctl),
+            (ovs    , "vsctl_async"   , self.vsctl_async),
+            (ovs    , "dpctl_async"   , self.dpctl_async),
+            (netlink, "_new_ndb"      , self.new_ndb),
+            (netlink, "_new_ipr"      , self.new_ipr),
+            (netlink, "pyroute2_netns", _Stub_Netns(self)),
+        )
+
+        self._saved = [(module, name, getattr(module, name)) for module, name, _ in replaced]
+        for module, name, value in replaced:
+            setattr(module, name, value)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for module, name, value in self._saved:
+            setattr(module, name, value)
+        self._saved = None
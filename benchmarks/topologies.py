@@ -0,0 +1,63 @@
+"""
+====================
+Benchmark topologies
+====================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+Topologies of a given size, built the same way for every benchmark so
+that results stay comparable between versions.
+"""
+
+from pyxnet.topology.objects.topology import Topology
+from pyxnet.topology.objects.switch   import Switch
+from pyxnet.topology.endpoint         import Endpoint_Kind
+
+
+SIZES = [100, 1_000, 10_000, 100_000]
+"""Number of nodes of the pure-Python benchmarks"""
+
+PLATFORM_SIZES = [10, 100, 1_000]
+"""Number of nodes of the benchmarks against the stand-in host"""
+
+GROUP_SIZE = 50
+"""Number of switches in each group"""
+
+
+class Bench_Switch(Switch):
+    """
+    RSTP switch with two ports, as in the examples
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name, stp_config={"rstp_enabled": True, "bridge_priority": 0x8000})
+
+        self.p0 = self._endpoint_register("p0", Endpoint_Kind.Virtual)
+        self.p1 = self._endpoint_register("p1", Endpoint_Kind.Virtual)
+
+        for endp in (self.p0, self.p1):
+            endp.properties["stp_config"] = {"path_cost": 100, "priority": 0x8000}
+
+
+def switches(n: int):
+    return [Bench_Switch(f"sw{i}") for i in range(n)]
+
+
+def ring_pairs(objs):
+    return [(objs[i].p1, objs[(i + 1) % len(objs)].p0) for i in range(len(objs))]
+
+
+def ring(n: int, name: str = "bench", **kwargs):
+    """
+    Ring of n switches, in groups of GROUP_SIZE switches
+    """
+
+    topo = Topology(name=name, **kwargs)
+    objs = switches(n)
+
+    for i in range(0, n, GROUP_SIZE):
+        topo.register_many(objs[i:i+GROUP_SIZE], group=f"group{i // GROUP_SIZE}")
+    topo.connect_many(ring_pairs(objs))
+
+    return topo
@@ -7,16 +7,32 @@ Diagram helpers
 :Date: January 2023
 """
 
+import functools
 import graphviz
 from pathlib import Path
 
 __assets_dir = (Path(__file__) / "..").resolve() / "assets"
 
+@functools.lru_cache(maxsize=1024)
 def asset(x: Path):
     x = Path(x)
     return __assets_dir / x
 
 
+@functools.lru_cache(maxsize=4096)
+def box_logo_label(logo_path, text):
+    """
+    HTML label of box_logo_node(). Labels are kept, so that exporting
+    the same topologies again does not build them again.
+    """
+
+    return f"""<
+        <TABLE BORDER="0">
+            <TR><TD WIDTH="64" HEIGHT="64" FIXEDSIZE="TRUE"><IMG SRC="{logo_path!s}" SCALE="BOTH"/></TD></TR>
+            <TR><TD>{text}</TD></TR>
+        </TABLE>>"""
+
+
 def box_logo_node(dot, node_name, logo_path, text, **kwargs):
     """
     Generates a node with a box shape and some logo
@@ -26,8 +42,4 @@ def box_logo_node(dot, node_name, logo_path, text, **kwargs):
     if not "shape" in kwargs:
         kwargs["shape"] = "box"
 
-    dot.node(node_name, label=f"""<
-        <TABLE BORDER="0">
-            <TR><TD WIDTH="64" HEIGHT="64" FIXEDSIZE="TRUE"><IMG SRC="{logo_path!s}" SCALE="BOTH"/></TD></TR>
-            <TR><TD>{text}</TD></TR>
-        </TABLE>>""", **kwargs)
\ No newline at end of file
+    dot.node(node_name, label=box_logo_label(logo_path, text), **kwargs)
\ No newline at end of file
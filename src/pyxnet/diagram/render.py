@@ -0,0 +1,301 @@
+"""
+=================
+Diagram rendering
+=================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+`Dot_Stream` writes DOT statements to a file or buffer as they are given,
+with the same node/edge/subgraph methods as `graphviz.Graph`, so that
+objects export_graphviz() methods can write to it unchanged. Nothing is
+kept in memory.
+
+Rendered diagrams are kept in a `Render_Cache`, keyed by a hash of the DOT
+source, engine and format: the layout engine only runs for topologies that
+changed. `render_many()` renders the other ones in worker processes.
+
+.. code:: python
+
+    cache = render.Render_Cache()
+    render.render_many([(topo, f"docs/{topo.name}.svg") for topo in topologies], cache=cache)
+"""
+
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib         import contextmanager
+from pathlib            import Path
+from typing             import Callable
+
+import graphviz
+
+from graphviz           import quoting
+
+__log = logging.getLogger("Render")
+
+
+##############################
+# Streaming DOT writer
+##############################
+
+# Node names, endpoint names and attribute values come back a lot:
+# quoting is cached, which is most of the writing time.
+
+@functools.lru_cache(maxsize=65536)
+def quote(x):
+    return quoting.quote(x)
+
+
+@functools.lru_cache(maxsize=65536)
+def quote_edge(x):
+    return quoting.quote_edge(x)
+
+
+def a_list(label=None, kwargs=None, attributes=None):
+    """
+    Same as graphviz.quoting.a_list, with cached quoting
+    """
+
+    res = [f"label={quote(label)}"] if label is not None else []
+    if kwargs:
+        items = sorted(kwargs.items()) if type(kwargs) is dict else kwargs.items()
+        res  += [f"{quote(k)}={quote(v)}" for k, v in items if v is not None]
+    if attributes:
+        items = (sorted(attributes.items()) if type(attributes) is dict else attributes.items()) if hasattr(attributes, "items") else attributes
+        res  += [f"{quote(k)}={quote(v)}" for k, v in items if v is not None]
+    return " ".join(res)
+
+
+def attr_list(label=None, kwargs=None, attributes=None):
+    content = a_list(label, kwargs, attributes)
+    return f" [{content}]" if content else ""
+
+
+class Dot_Stream:
+    """
+    Writes the DOT source of a graph as it is built. The output is the
+    same as graphviz.Graph.source, except that the statements given to
+    the parent graph inside a subgraph block are written in the subgraph.
+
+    :param write: Called with each chunk of DOT source
+    :param prefix: Indentation of the statements, for subgraphs
+    """
+
+    def __init__(self, write: Callable, prefix: str = ""):
+        self.write  = write
+        self.prefix = prefix
+
+    @classmethod
+    @contextmanager
+    def graph(cls, out, name: str = None, graph_attr=None, node_attr=None, edge_attr=None, body=None, strict: bool = False):
+        """
+        Write an undirected graph to the out file object, with the same
+        arguments as graphviz.Graph.
+        """
+
+        write = out.write
+        head  = "strict graph" if strict else "graph"
+        write(f"{head} {quote(name)} {{\n" if name else f"{head} {{\n")
+
+        for kw, attrs in (("graph", graph_attr), ("node", node_attr), ("edge", edge_attr)):
+            if attrs:
+                write(f"\t{kw}{attr_list(None, kwargs=attrs)}\n")
+
+        for line in (body or ()):
+            write(line)
+
+        yield cls(write)
+
+        write("}\n")
+
+    def node(self, name: str, label: str = None, _attributes=None, **attrs):
+        self.write(f"{self.prefix}\t{quote(name)}{attr_list(label, kwargs=attrs, attributes=_attributes)}\n")
+
+    def edge(self, tail_name: str, head_name: str, label: str = None, _attributes=None, **attrs):
+        self.write(
+            f"{self.prefix}\t{quote_edge(tail_name)} -- {quote_edge(head_name)}"
+            f"{attr_list(label, kwargs=attrs, attributes=_attributes)}\n"
+        )
+
+    def edges(self, tail_head_iter):
+        for tail_name, head_name in tail_head_iter:
+            self.write(f"{self.prefix}\t{quote_edge(tail_name)} -- {quote_edge(head_name)}\n")
+
+    def attr(self, kw: str = None, _attributes=None, **attrs):
+        if attrs or _attributes:
+            if kw is None:
+                self.write(f"{self.prefix}\t{a_list(None, kwargs=attrs, attributes=_attributes)}\n")
+            else:
+                self.write(f"{self.prefix}\t{kw}{attr_list(None, kwargs=attrs, attributes=_attributes)}\n")
+
+    @contextmanager
+    def subgraph(self, name: str = None, graph_attr=None, node_attr=None, edge_attr=None, body=None):
+        prefix = self.prefix + "\t"
+        self.write(f"{prefix}subgraph {quote(name)} {{\n" if name else f"{prefix}{{\n")
+
+        for kw, attrs in (("graph", graph_attr), ("node", node_attr), ("edge", edge_attr)):
+            if attrs:
+                self.write(f"{prefix}\t{kw}{attr_list(None, kwargs=attrs)}\n")
+
+        for line in (body or ()):
+            self.write(f"{prefix}{line}")
+
+        yield Dot_Stream(self.write, prefix)
+
+        self.write(f"{prefix}}}\n")
+
+
+def dot_source(item):
+    """
+    Returns the DOT source of a topology (see Topology.write_dot), or
+    of anything with a source attribute, like graphviz graphs
+    """
+
+    if isinstance(item, str):
+        return item
+    elif hasattr(item, "write_dot"):
+        return item.write_dot()
+    return item.source
+
+
+##############################
+# Render cache
+##############################
+
+def dot_hash(source: str, engine: str = "dot", format: str = "svg"):
+    data = f"{engine}\0{format}\0{source}".encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def default_cache_dir():
+    """
+    Directory of the render cache: $PYXNET_RENDER_CACHE, or pyxnet/renders
+    in the user cache directory.
+    """
+
+    if os.environ.get("PYXNET_RENDER_CACHE"):
+        return Path(os.environ["PYXNET_RENDER_CACHE"])
+
+    base = os.environ.get("XDG_CACHE_HOME") or (Path.home() / ".cache")
+    return Path(base) / "pyxnet" / "renders"
+
+
+class Render_Cache:
+    """
+    Rendered diagrams, one file per hash of the DOT source, engine and format
+    """
+
+    def __init__(self, directory=None):
+        self.directory = Path(directory) if directory is not None else default_cache_dir()
+
+    def _path(self, key: str, format: str):
+        return self.directory / f"{key}.{format}"
+
+    def get(self, key: str, format: str):
+        """
+        Returns the path of a cached render, or None
+        """
+
+        path = self._path(key, format)
+        return path if path.exists() else None
+
+    def store(self, key: str, format: str, data: bytes):
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # Written aside then renamed, so that readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=f".{key}.")
+        try:
+            with os.fdopen(fd, "wb") as fhandle:
+                fhandle.write(data)
+            os.replace(tmp, self._path(key, format))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        return self._path(key, format)
+
+    def clear(self):
+        if self.directory.exists():
+            for path in self.directory.iterdir():
+                path.unlink()
+
+
+##############################
+# Rendering
+##############################
+
+def _format_of(path: Path, format: str = None):
+    return format or path.suffix.lstrip(".") or "svg"
+
+
+def _render(source: str, path: Path, format: str, engine: str, cache_dir):
+    # Runs in worker processes: only takes picklable arguments
+    cache = Render_Cache(cache_dir) if cache_dir is not None else None
+    key   = dot_hash(source, engine, format)
+
+    data  = graphviz.pipe(engine, format, source.encode("utf-8"))
+    if cache is not None:
+        cache.store(key, format, data)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def render(item, path, format: str = None, engine: str = "dot", cache: Render_Cache = None):
+    """
+    Render a topology or a DOT source to a file. With a cache, the layout
+    engine only runs if the same source was never rendered.
+
+    :param item: Topology, graphviz graph or DOT source
+    :param path: Output file
+    :param format: Output format, defaults to the file extension
+    :return: The output path
+    """
+
+    return render_many([(item, path)], format=format, engine=engine, cache=cache, workers=1)[0]
+
+
+def render_many(items, format: str = None, engine: str = "dot", cache: Render_Cache = None, workers: int = None):
+    """
+    Render several topologies or DOT sources. Cached renders are copied,
+    the other ones are rendered in worker processes.
+
+    :param items: Iterable of (topology or DOT source, output path) tuples
+    :param workers: Number of worker processes, None for one per CPU, 1 to
+                    render in the calling process.
+    :return: List of output paths, in the order of items
+    """
+
+    res  = list()
+    jobs = list()
+
+    for item, path in items:
+        path   = Path(path)
+        fmt    = _format_of(path, format)
+        source = dot_source(item)
+        cached = cache.get(dot_hash(source, engine, fmt), fmt) if cache is not None else None
+
+        if cached is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(cached, path)
+        else:
+            jobs.append((source, path, fmt, engine, cache.directory if cache is not None else None))
+        res.append(path)
+
+    __log.debug(f"{len(res) - len(jobs)} diagrams from cache, {len(jobs)} to render")
+
+    if (workers == 1) or (len(jobs) < 2):
+        for job in jobs:
+            _render(*job)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_render, *zip(*jobs)))
+
+    return res
@@ -5,16 +5,209 @@ Tools to cleanup all the mess!
 :Authors: - Théo Bourdon <theo.bourdon@elsys-design.com>
           - Florian Dupeyron <florian.dupeyron@mugcat.fr>
 :Date: December 2022
+
+The host state is read once (one netlink dump, one bridge list, one
+datapath list), then everything matching the pyxnet prefix is removed in
+batches: bridges in a single ovs-vsctl transaction, datapaths one by one,
+optionally in parallel, veth pairs with a single netlink request, and
+network namespaces last.
+
+Removing interfaces one by one is slow, as the kernel waits for a RCU
+grace period on each removal. Instead, the interfaces are moved to an
+unused interface group, and the whole group is removed at once. The groups
+in use are read from the namespace of the interfaces right before, so that
+no other interface is removed with them.
 """
 
+import errno
 import logging
+import random
+
+from concurrent.futures    import ThreadPoolExecutor
+from dataclasses           import dataclass, field
+from typing                import Dict, List, Optional
 
-from pyxnet.platform.tools import ovs, ifp
-from pyroute2              import NDB
+from pyxnet.platform.tools import ovs, netlink, ifp
 
 __cleanup_log = logging.getLogger("cleanup")
 
 
+##############################
+# Resources on the host
+##############################
+
+@dataclass
+class Cleanup_Resources:
+    datapaths: List[str]       = field(default_factory=list)
+    bridges: List[str]         = field(default_factory=list)
+    interfaces: Dict[str, Optional[int]] = field(default_factory=dict)
+    """veth interfaces, with their index if known"""
+
+    netns_interfaces: Dict[str, Dict[str, Optional[int]]] = field(default_factory=dict)
+    """veth interfaces in other network namespaces, by namespace"""
+
+    namespaces: List[str]      = field(default_factory=list)
+    """Named network namespaces"""
+
+    def __len__(self):
+        return (
+            len(self.datapaths) + len(self.bridges) + len(self.interfaces) + len(self.namespaces)
+            + sum(len(x) for x in self.netns_interfaces.values())
+        )
+
+
+def scan(prefix: str = None, datapaths=True, bridges=True, interfaces=True, namespaces=True, tag: str = None):
+    """
+    List the pyxnet resources present on the host
+
+    :param prefix: Name prefix of the resources, pyxnet one by default
+    :param tag: Only list the bridges of the topology with this tag
+    :return: A Cleanup_Resources object
+    """
+
+    prefix = prefix or ifp()
+    res    = Cleanup_Resources()
+
+    if datapaths:
+        res.datapaths = [x for x in ovs.list_dp() if x.startswith(prefix)]
+
+    if bridges:
+        names         = ovs.list_br() if tag is None else ovs.find_br("pyxnet-topology", tag)
+        res.bridges   = [x for x in names if x.startswith(prefix)]
+
+    if interfaces:
+        with netlink.ipr() as ipr:
+            for link in ipr.get_links():
+                ifname = link.get_attr("IFLA_IFNAME")
+                info   = link.get_attr("IFLA_LINKINFO")
+                kind   = info.get_attr("IFLA_INFO_KIND") if info is not None else None
+
+                if (kind == "veth") and ifname.startswith(prefix):
+                    res.interfaces[ifname] = link["index"]
+
+    # Interfaces in the namespaces are removed with them
+    if namespaces:
+        res.namespaces = [x for x in netlink.netns_list() if x.startswith(prefix)]
+
+    return res
+
+
+##############################
+# Removal
+##############################
+
+VSCTL_CHUNK = 512
+"""Maximum number of bridges removed by a single ovs-vsctl call"""
+
+
+def _remove_datapaths(names, workers):
+    def _del(name):
+        __cleanup_log.debug(f"Removing {name} dp")
+        ovs.dpctl("del-dp", name)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_del, names))
+    else:
+        for name in names:
+            _del(name)
+
+
+def _remove_bridges(names):
+    for i in range(0, len(names), VSCTL_CHUNK):
+        with ovs.transaction() as tr:
+            for name in names[i:i+VSCTL_CHUNK]:
+                __cleanup_log.debug(f"Removing {name} virtual switch")
+                tr.add("--if-exists", "del-br", name)
+
+
+def _ifsel(name, index):
+    # The kernel finds the interface by name when no index is given
+    return {"index": index} if index is not None else {"ifname": name}
+
+
+def _check_interfaces(interfaces, errors, action):
+    # Removing a veth removes its peer: requests on the peer give ENODEV
+    failed = [(name, err) for name, err in zip(interfaces, errors) if (err is not None) and (err.code != errno.ENODEV)]
+    if failed:
+        name, err = failed[0]
+        raise RuntimeError(f"Failed to {action} {len(failed)} interfaces, first one is {name}: {err}")
+
+
+def _unused_group(ipr):
+    groups = {link.get_attr("IFLA_GROUP") for link in ipr.get_links()}
+
+    group = random.randint(1, 0x7FFFFFFF)
+    while group in groups:
+        group = random.randint(1, 0x7FFFFFFF)
+    return group
+
+
+def _remove_interfaces(interfaces, netns=None):
+    if not interfaces:
+        return
+
+    with netlink.ipr(netns) as ipr:
+        group  = _unused_group(ipr)
+        msgs   = [netlink.link_request("set", group=group, **_ifsel(name, index)) for name, index in interfaces.items()]
+        _check_interfaces(interfaces, netlink.batch(ipr, msgs), "move")
+
+        __cleanup_log.debug(f"Removing {len(interfaces)} interfaces in group {group}")
+        err, = netlink.batch(ipr, [netlink.link_request("del", group=group)])
+
+        if (err is not None) and (err.code != errno.ENODEV):
+            # Fallback to one request per interface
+            __cleanup_log.debug(f"Group removal failed ({err}), removing interfaces one by one")
+            msgs = [netlink.link_request("del", **_ifsel(name, index)) for name, index in interfaces.items()]
+            _check_interfaces(interfaces, netlink.batch(ipr, msgs), "remove")
+
+
+def _remove_all_interfaces(res):
+    _remove_interfaces(res.interfaces)
+
+    for netns, interfaces in res.netns_interfaces.items():
+        if netns in netlink.netns_list():
+            _remove_interfaces(interfaces, netns=netns)
+
+
+def _remove_namespaces(names):
+    for name in names:
+        __cleanup_log.debug(f"Removing {name} network namespace")
+        netlink.netns_remove(name)
+
+
+def remove_resources(res: Cleanup_Resources, parallel: bool = False, workers: int = 8):
+    """
+    Remove resources listed by scan(), or built by hand.
+
+    :param parallel: Remove datapaths, bridges and interfaces at the same time,
+                     and datapaths concurrently.
+    :param workers: Number of concurrent removals when parallel is set
+    """
+
+    if not parallel:
+        _remove_datapaths(res.datapaths, 1)
+        _remove_bridges(res.bridges)
+        _remove_all_interfaces(res)
+
+    else:
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            futures = [
+                pool.submit(_remove_datapaths, res.datapaths, workers),
+                pool.submit(_remove_bridges, res.bridges),
+                pool.submit(_remove_all_interfaces, res),
+            ]
+
+        for fut in futures:
+            fut.result()
+
+    _remove_namespaces(res.namespaces)
+
+
+##############################
+# Cleanup functions
+##############################
+
 def cleanup_dpctl():
     """
     Cleanup all pyxnet related openvswitch data paths
@@ -22,18 +215,10 @@ def cleanup_dpctl():
 
     __cleanup_log.info("Cleanup datapaths...")
 
-    ret = ovs.dpctl("dump-dps")
-    switches = ret.stdout.decode("utf-8").strip().split("\n")
-
-    deleted = 0
-    for switch in switches :
-        s = switch.split("@")
-        # If the split works and the name of the datapath start with the prefix pxn
-        if s != [""] and s[1].startswith(ifp()):
-            __cleanup_log.debug(f"Removing {s[1]} dp")
-            ovs.dpctl("del-dp", s[1])
-            deleted += 1
-    __cleanup_log.info(f"> Deleted {deleted} dps")
+    res = scan(bridges=False, interfaces=False, namespaces=False)
+    remove_resources(res)
+
+    __cleanup_log.info(f"> Deleted {len(res.datapaths)} dps")
     
 
 def cleanup_vsctl():
@@ -43,16 +228,10 @@ def cleanup_vsctl():
 
     __cleanup_log.info("Cleanup virtual switches...")
 
-    ret =  ovs.vsctl("list-br")
-    bridges = ret.stdout.decode("utf-8").strip().split("\n")
-    deleted = 0
-    if bridges != [""]:
-        for bridge in bridges :
-            if bridge.startswith(ifp()):
-                __cleanup_log.debug(f"Removing {bridge} virtual switch")
-                ovs.vsctl("del-br", bridge)
-                deleted += 1
-    __cleanup_log.info(f"> Deleted {deleted} switches")
+    res = scan(datapaths=False, interfaces=False, namespaces=False)
+    remove_resources(res)
+
+    __cleanup_log.info(f"> Deleted {len(res.bridges)} switches")
 
 def cleanup_ports():
     """
@@ -60,27 +239,26 @@ def cleanup_ports():
     """
 
     __cleanup_log.info("Cleanup ip interfaces...")
-    deleted = 0
-    
-    with NDB() as ndb:
-        while True:
-            veths = list(filter(lambda x: (x['kind'] == "veth") and (x["ifname"].startswith(ifp())), ndb.interfaces.dump()))
-            
-            if not veths:
-                break
-            else:
-                veth = veths[0]
-                __cleanup_log.debug(f"Removing {veth} interface")
-                ndb.interfaces[veth].remove().commit()
-                deleted += 1
+
+    res = scan(datapaths=False, bridges=False, namespaces=False)
+    remove_resources(res)
       
-    __cleanup_log.info(f"> Deleted {deleted} interfaces")
+    __cleanup_log.info(f"> Deleted {len(res.interfaces)} interfaces")
     
 
-def cleanup_all():
-    cleanup_dpctl()
-    cleanup_vsctl()
-    cleanup_ports()      
+def cleanup_all(parallel: bool = False):
+    """
+    Cleanup all pyxnet related datapaths, switches and interfaces
+
+    :param parallel: See remove_resources()
+    """
+
+    __cleanup_log.info("Cleanup all...")
+
+    res = scan()
+    remove_resources(res, parallel=parallel)
+
+    __cleanup_log.info(f"> Deleted {len(res.datapaths)} dps, {len(res.bridges)} switches, {len(res.interfaces)} interfaces, {len(res.namespaces)} namespaces")
     
 if __name__ == "__main__":
     cleanup_all()
@@ -0,0 +1,278 @@
+"""
+================
+Resource journal
+================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+A `Resource_Journal` records the kernel and openvswitch resources created
+while it is active, so that they can be removed later without looking at
+the rest of the host. Resources are recorded before being created: if the
+process crashes in the middle of an instanciation, replaying the journal
+still removes everything that may exist.
+
+When a path is given, each entry is appended to the file as a JSON line
+as soon as it is recorded, and the journal can be replayed by another
+process with `recover()`.
+
+.. code:: python
+
+    with journal:
+        Link_VEth("a", "b").instanciate() # records ("veth", "a")
+
+    journal.replay()
+"""
+
+import json
+import logging
+import threading
+
+from contextvars             import ContextVar
+from pathlib                 import Path
+
+from pyxnet.platform.tools   import netlink
+from pyxnet.platform.cleanup import Cleanup_Resources, remove_resources
+
+
+# Entries of settings changed on existing interfaces, restored on replay
+_settings = frozenset(("ip", "mac", "qdisc"))
+
+
+class Resource_Journal:
+    """
+    Ordered list of created resources. Each entry is a dict with a "kind"
+    and a "name" key, and optional data:
+
+    - ("veth", name, netns, peer, peer_netns): veth pair, removed with its peer ;
+    - ("bridge", name): openvswitch bridge ;
+    - ("datapath", name): openvswitch datapath ;
+    - ("netns", name): named network namespace ;
+    - ("ip", name, address): address added to an existing interface ;
+    - ("mac", name, address): MAC address changed on an existing interface,
+      address is the former one ;
+    - ("qdisc", name): impairment qdisc set on an existing interface.
+    """
+
+    def __init__(self, path=None):
+        self.log      = logging.getLogger("Resource journal")
+        self.path     = Path(path) if path is not None else None
+        self.entries  = list()
+
+        self._lock    = threading.Lock()
+        self._fhandle = None
+        self._tokens  = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        self._tokens.append(_current_journal.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_journal.reset(self._tokens.pop())
+
+        if not self._tokens:
+            self.close()
+
+
+    # ---------------- Recording
+
+    def record(self, kind: str, name: str, **data):
+        entry = {"kind": kind, "name": name, **data}
+
+        with self._lock:
+            self.entries.append(entry)
+
+            if self.path is not None:
+                if self._fhandle is None:
+                    self.path.parent.mkdir(parents=True, exist_ok=True)
+                    self._fhandle = open(self.path, "a")
+
+                self._fhandle.write(json.dumps(entry) + "\n")
+                self._fhandle.flush()
+
+    def close(self):
+        with self._lock:
+            if self._fhandle is not None:
+                self._fhandle.close()
+                self._fhandle = None
+
+    def pop_settings(self, name: str):
+        """
+        Forget the settings changed on an existing interface ("ip", "mac"
+        and "qdisc" entries), once they are restored by the caller.
+
+        :return: The entries of the interface, in recording order
+        """
+
+        with self._lock:
+            res = [x for x in self.entries if (x["name"] == name) and (x["kind"] in _settings)]
+            if res:
+                self.entries = [x for x in self.entries if not ((x["name"] == name) and (x["kind"] in _settings))]
+                self._rewrite()
+
+        return res
+
+    def _rewrite(self):
+        # Called with the lock held
+        if self.path is None:
+            return
+
+        if self._fhandle is not None:
+            self._fhandle.close()
+            self._fhandle = None
+
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as fhandle:
+            fhandle.writelines(json.dumps(entry) + "\n" for entry in self.entries)
+        tmp.replace(self.path)
+
+    def clear(self):
+        """
+        Forget all entries, and remove the journal file
+        """
+
+        self.close()
+        with self._lock:
+            self.entries = list()
+            if (self.path is not None) and self.path.exists():
+                self.path.unlink()
+
+
+    # ---------------- Persistence
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a journal file. A truncated last line, from a crash while
+        writing, is ignored.
+        """
+
+        journal = cls(path)
+        if journal.path.exists():
+            with open(journal.path, "r") as fhandle:
+                for line in fhandle:
+                    try:
+                        journal.entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        journal.log.warning(f"Ignoring corrupted journal line: {line!r}")
+
+        return journal
+
+
+    # ---------------- Replay
+
+    def replay(self, parallel: bool = False):
+        """
+        Remove all recorded resources, last recorded first, then clear
+        the journal. Resources that are already gone are ignored.
+
+        Interface settings are restored first, then datapaths, bridges and
+        veth pairs are removed in batches (see cleanup.remove_resources).
+        """
+
+        entries  = list(reversed(self.entries))
+        res      = Cleanup_Resources()
+        restores = list()
+
+        for entry in entries:
+            kind = entry["kind"]
+            if   kind == "veth":
+                _veth_entry(res, entry)
+            elif kind == "bridge":
+                if entry["name"] not in res.bridges:
+                    res.bridges.append(entry["name"])
+            elif kind == "datapath":
+                if entry["name"] not in res.datapaths:
+                    res.datapaths.append(entry["name"])
+            elif kind == "netns":
+                if entry["name"] not in res.namespaces:
+                    res.namespaces.append(entry["name"])
+            elif kind in _settings:
+                restores.append(entry)
+            else:
+                self.log.warning(f"Unknown resource kind {kind} for {entry['name']}")
+
+        self.log.info(f"Replay journal: {len(restores)} settings, {len(res)} resources")
+
+        if restores:
+            _restore(restores, self.log)
+        remove_resources(res, parallel=parallel)
+
+        self.clear()
+
+
+def _veth_entry(res, entry):
+    netns      = entry.get("netns", None)
+    peer       = entry.get("peer", None)
+    peer_netns = entry.get("peer_netns", None)
+
+    # Removing one end removes the other one, preferably from here
+    if netns is None:
+        res.interfaces.setdefault(entry["name"], None)
+    elif (peer is not None) and (peer_netns is None):
+        res.interfaces.setdefault(peer, None)
+    else:
+        res.netns_interfaces.setdefault(netns, dict()).setdefault(entry["name"], None)
+        # Not moved yet if the process stopped right after the creation
+        res.interfaces.setdefault(entry["name"], None)
+
+
+def _restore(entries, log):
+    with netlink.ipr() as ipr:
+        for entry in entries:
+            index = ipr.link_lookup(ifname=entry["name"])
+            if not index:
+                continue
+
+            try:
+                if entry["kind"] == "ip":
+                    ipr.addr("del", index=index[0], address=entry["address"])
+                elif entry["kind"] == "qdisc":
+                    ipr.tc("del", index=index[0])
+                elif entry["address"] is not None:
+                    ipr.link("set", index=index[0], address=entry["address"])
+            except Exception as exc:
+                log.warning(f"Cannot restore {entry['kind']} of {entry['name']}: {exc}")
+
+
+##############################
+# Active journal
+##############################
+
+_current_journal = ContextVar("resource_journal", default=None)
+
+
+def current():
+    """
+    Returns the active journal, or None
+    """
+
+    return _current_journal.get()
+
+
+def record(kind: str, name: str, **data):
+    """
+    Record a resource in the active journal, if any
+    """
+
+    journal = _current_journal.get()
+    if journal is not None:
+        journal.record(kind, name, **data)
+
+
+def recover(path, parallel: bool = False):
+    """
+    Remove the resources listed in a journal file left by a crashed run
+
+    :return: True if there was something to recover
+    """
+
+    journal = Resource_Journal.load(path)
+    if not journal.entries:
+        return False
+
+    journal.replay(parallel=parallel)
+    return True
@@ -7,17 +7,21 @@ Virtual links managment
 :Date: November 2022
 """
 
+import asyncio
 import logging
-from pyroute2 import NDB
 from abc      import ABC, abstractmethod
 
-from pyxnet.platform.tools import ovs
+from pyxnet.platform.tools import ovs, netlink, tc, to_thread
+from pyxnet.platform       import journal
 
 ##########################################
 # Base link class
 ##########################################
 
 class Link(ABC):
+    kind = None
+    """Link type name, used in link descriptions"""
+
     def __init__(self):
         super().__init__()
 
@@ -29,58 +33,289 @@ class Link(ABC):
     def remove(self):
         pass
 
+    # Descriptions are plain dicts that can be saved, compared, and
+    # turned back into link objects to remove links that are no longer
+    # declared.
+
+    @abstractmethod
+    def describe(self) -> dict:
+        pass
+
+    @staticmethod
+    def from_description(desc: dict):
+        """
+        Build a link object from the output of describe()
+        """
+
+        args = dict(desc)
+        kind = args.pop("type")
+        if kind not in link_types:
+            raise ValueError(f"Unknown link type: {kind}")
+        return link_types[kind](**args)
+
+    @classmethod
+    def _described_live(cls, desc: dict, live: dict):
+        """
+        Tells if a described link exists on the host.
+
+        :param live: dict with "interfaces" and "bridges" sets
+        """
+
+        return True
+
+    # Impairments (see tools.tc) can be changed on an existing link,
+    # without creating it again.
+
+    def impairments(self):
+        """
+        Returns the (interface name, network namespace, impairment) of each
+        interface of the link that can be impaired
+        """
+
+        return []
+
+    def set_impairment(self, ifname: str, impairment):
+        raise ValueError(f"{self.kind} links can't be impaired")
+
+    # So can the addresses of some link types, see set_addresses().
+
+    address_fields = ()
+    """Description keys of the addresses that can be changed on an existing link"""
+
+    def addresses(self):
+        """
+        Returns the (interface name, network namespace, address) of each
+        interface of the link which address can be changed in place
+        """
+
+        return []
+
+    # Async variants run the blocking implementation in the default
+    # executor, unless a link type gives a better one.
+
+    async def instanciate_async(self):
+        return await to_thread(self.instanciate)
+
+    async def remove_async(self):
+        return await to_thread(self.remove)
+
 
 ##########################################
 # Veth port managment
 ##########################################
 
 class Link_VEth(Link):
-    def __init__(self, p0_name, p1_name, p0_mac=None, p1_mac=None, p0_ip=None, p1_ip=None):
+    kind = "veth"
+
+    def __init__(self, p0_name, p1_name, p0_mac=None, p1_mac=None, p0_ip=None, p1_ip=None, p0_netns=None, p1_netns=None,
+        p0_impairment=None, p1_impairment=None):
         super().__init__()
 
-        self.log     = logging.getLogger(f"VEth {p0_name}@{p1_name}")
+        self._log     = None
 
-        self.p0_name = p0_name
-        self.p1_name = p1_name
+        self.p0_name  = p0_name
+        self.p1_name  = p1_name
 
-        self.p0_mac  = p0_mac
-        self.p1_mac  = p1_mac
+        self.p0_mac   = p0_mac
+        self.p1_mac   = p1_mac
 
-        self.p0_ip   = p0_ip
-        self.p1_ip   = p1_ip
+        self.p0_ip    = p0_ip
+        self.p1_ip    = p1_ip
 
-    def instanciate(self, create=True, exists_ok=True):
-        self.log.info(f"Creating virtual eth ports {self.p0_name}@{self.p1_name}")
+        self.p0_netns = p0_netns # None -> Current network namespace
+        self.p1_netns = p1_netns
 
-        with NDB() as ndb:
-            if create:
-                if not (self.p0_name in ndb.interfaces) or (self.p1_name in ndb.interfaces):
-                    ndb.interfaces.create(ifname=self.p0_name, kind="veth", peer={"ifname": self.p1_name}).commit()
-                elif not exists_ok:
-                    raise RuntimeError(f"Interface {p0_name} or {p1_name} already exists")
+        self.p0_impairment = tc.describe(p0_impairment)
+        self.p1_impairment = tc.describe(p1_impairment)
 
-            if self.p0_mac is not None:
-                self.log.info(f"> Set {self.p0_name} MAC addr to {self.p0_mac}")
-                ndb.interfaces[self.p0_name].set("address", self.p0_mac).commit()
+    @property
+    def log(self):
+        # Created on first use, as big topologies have a lot of veth pairs
+        if self._log is None:
+            self._log = logging.getLogger(f"VEth {self.p0_name}@{self.p1_name}")
+        return self._log
 
-            if self.p1_mac is not None:
-                self.log.info(f"> Set {self.p1_name} MAC addr to {self.p1_mac}")
-                ndb.interfaces[self.p1_name].set("address", self.p1_mac).commit()
+    def describe(self):
+        return {
+            "type"    : self.kind,
+            "p0_name" : self.p0_name , "p1_name" : self.p1_name ,
+            "p0_mac"  : self.p0_mac  , "p1_mac"  : self.p1_mac  ,
+            "p0_ip"   : self.p0_ip   , "p1_ip"   : self.p1_ip   ,
+            "p0_netns": self.p0_netns, "p1_netns": self.p1_netns,
+            "p0_impairment": self.p0_impairment, "p1_impairment": self.p1_impairment,
+        }
 
-            if self.p0_ip is not None:
-                self.log.info(f"> Set {self.p0_name} IP addr to {self.p0_ip}")
-                ndb.interfaces[self.p0_name].add_ip(self.p0_ip).commit()
+    @classmethod
+    def _described_live(cls, desc, live):
+        # Interfaces in other namespaces are not listed
+        return all(
+            (desc[f"{x}_netns"] is not None) or (desc[f"{x}_name"] in live["interfaces"])
+            for x in ("p0", "p1")
+        )
 
-            if self.p1_ip is not None:
-                self.log.info(f"> Set {self.p1_name} IP addr to {self.p1_ip}")
-                ndb.interfaces[self.p1_name].add_ip(self.p1_ip).commit()
+    def _ends(self):
+        return ((self.p0_name, self.p0_netns, self.p0_mac, self.p0_ip), (self.p1_name, self.p1_netns, self.p1_mac, self.p1_ip))
+
+    def impairments(self):
+        return [(self.p0_name, self.p0_netns, self.p0_impairment), (self.p1_name, self.p1_netns, self.p1_impairment)]
+
+    address_fields = ("p0_ip", "p1_ip")
 
+    def addresses(self):
+        return [(self.p0_name, self.p0_netns, self.p0_ip), (self.p1_name, self.p1_netns, self.p1_ip)]
+
+    def set_impairment(self, ifname: str, impairment):
+        if ifname == self.p0_name:
+            self.p0_impairment = tc.describe(impairment)
+        elif ifname == self.p1_name:
+            self.p1_impairment = tc.describe(impairment)
+        else:
+            raise ValueError(f"{ifname} is not an end of {self.p0_name}@{self.p1_name}")
+
+    def instanciate(self, create=True, exists_ok=True):
+        Link_VEth.instanciate_batch([self], create=create, exists_ok=exists_ok)
         return self
 
+    @staticmethod
+    def instanciate_batch(links, create=True, exists_ok=True):
+        """
+        Instanciate several veth pairs with raw netlink requests. All creation
+        requests are sent at once, with the MAC addresses given in the creation
+        request, then ends are moved to their network namespace, then all
+        addresses are sent at once, by namespace, then all impairment qdiscs.
+
+        :param links: List of Link_VEth objects
+        :param create: Create the veth pairs, or only configure existing ones
+        :param exists_ok: Do not fail if the veth pair already exists
+
+        A pair is found when both ends are in their network namespace. Ends
+        of a half pair, e.g. whose peer was in a deleted namespace or was
+        never moved to its namespace, are removed and the pair is created
+        again. Without create, a missing end is an error.
+        """
+
+        if not links:
+            return
+
+        namespaces = {None} | {ns for link in links for (_, ns, _, _) in link._ends()}
+
+        def _indexes():
+            res = dict()
+            for ns in namespaces:
+                with netlink.ipr(ns) as ipr:
+                    res[ns] = netlink.link_indexes(ipr)
+            return res
+
+        def _index(indexes, ns, name):
+            try:
+                return indexes[ns][name]
+            except KeyError:
+                raise RuntimeError(f"Interface {name} not found in namespace {ns or 'host'}")
+
+        def _send(msgs):
+            for ns, ns_msgs in msgs.items():
+                if ns_msgs:
+                    with netlink.ipr(ns) as ipr:
+                        Link_VEth._check_batch(ns_msgs, netlink.batch(ipr, ns_msgs))
+
+        indexes = _indexes()
+        removes = {ns: [] for ns in namespaces}
+        msgs    = {ns: [] for ns in namespaces}
+        moves   = []
+
+        for link in links:
+            missing = [(name, ns) for (name, ns, _, _) in link._ends() if name not in indexes[ns]]
+            exists  = len(missing) < len(link._ends())
+
+            if create and exists and not exists_ok:
+                raise RuntimeError(f"Interface {link.p0_name} or {link.p1_name} already exists")
+
+            if missing and not create:
+                name, ns = missing[0]
+                raise RuntimeError(f"Interface {name} of {link.p0_name}@{link.p1_name} not found in namespace {ns or 'host'}")
+
+            if missing:
+                # Ends left by a half pair, in their namespace or the host one,
+                # are removed first
+                for (name, ns, _, _) in link._ends():
+                    for where in {ns, None}:
+                        if name in indexes[where]:
+                            link.log.info(f"> Remove {name} left in namespace {where or 'host'}")
+                            removes[where].append(netlink.link_request("del", index=indexes[where][name]))
+
+                link.log.info(f"Creating virtual eth ports {link.p0_name}@{link.p1_name}")
+                peer = {"ifname": link.p1_name}
+                args = {"ifname": link.p0_name, "kind": "veth", "peer": peer}
+
+                if link.p0_mac is not None:
+                    link.log.info(f"> Set {link.p0_name} MAC addr to {link.p0_mac}")
+                    args["address"] = link.p0_mac
+                if link.p1_mac is not None:
+                    link.log.info(f"> Set {link.p1_name} MAC addr to {link.p1_mac}")
+                    peer["address"] = link.p1_mac
+
+                # Pairs are created in the current namespace, then moved
+                msgs[None].append(netlink.link_request("add", **args))
+                journal.record("veth", link.p0_name, netns=link.p0_netns, peer=link.p1_name, peer_netns=link.p1_netns)
+
+                for (name, ns, _, _) in link._ends():
+                    if ns is not None:
+                        link.log.info(f"> Move {name} to network namespace {ns}")
+                        moves.append(netlink.link_request("set", ifname=name, net_ns_fd=ns))
+
+            else:
+                for (name, ns, mac, _) in link._ends():
+                    if mac is not None:
+                        link.log.info(f"> Set {name} MAC addr to {mac}")
+                        msgs[ns].append(netlink.link_request("set", index=indexes[ns][name], address=mac))
+
+        # Deletions fail for ends already removed with their peer
+        for ns, ns_removes in removes.items():
+            if ns_removes:
+                with netlink.ipr(ns) as ipr:
+                    netlink.batch(ipr, ns_removes)
+
+        _send(msgs)
+        _send({None: moves})
+
+        # Addresses need the index of the created interfaces
+        if any((ip is not None) for link in links for (_, _, _, ip) in link._ends()):
+            indexes = _indexes()
+            msgs    = {ns: [] for ns in namespaces}
+
+            for link in links:
+                for (name, ns, _, ip) in link._ends():
+                    if ip is not None:
+                        link.log.info(f"> Set {name} IP addr to {ip}")
+                        msgs[ns].append(netlink.addr_request("replace", index=_index(indexes, ns, name), address=ip))
+
+            _send(msgs)
+
+        tc.apply(
+            (name, ns, None, imp)
+            for link in links for (name, ns, imp) in link.impairments() if imp is not None
+        )
+
+    @staticmethod
+    async def instanciate_batch_async(links, create=True, exists_ok=True):
+        """
+        Same as instanciate_batch(), without blocking the event loop
+        """
+
+        return await to_thread(Link_VEth.instanciate_batch, links, create=create, exists_ok=exists_ok)
+
+    @staticmethod
+    def _check_batch(msgs, errors):
+        failed = [(msg, err) for msg, err in zip(msgs, errors) if err is not None]
+        if failed:
+            msg, err = failed[0]
+            name     = msg.get_attr("IFLA_IFNAME") or msg["index"]
+            raise RuntimeError(f"{len(failed)} netlink requests failed, first one on {name}: {err}")
+
     def remove(self):
         self.log.info(f"Remove virtual eth ports {self.p0_name}@{self.p1_name}")
 
-        with NDB() as ndb:
+        with netlink.ndb(self.p0_netns) as ndb:
             ndb.interfaces[self.p0_name].remove().commit()
 
 
@@ -89,37 +324,88 @@ class Link_VEth(Link):
 ##########################################
 
 class Link_Phy(Link):
-    def __init__(self, name, mac_addr=None, ip_addr=None):
+    kind = "phy"
+
+    def __init__(self, name, mac_addr=None, ip_addr=None, impairment=None):
         super().__init__()
 
         self.log  = logging.getLogger(f"Phy {name}")
         self.name = name
 
-        self.mac_addr = mac_addr
-        self.ip_addr  = ip_addr
+        self.mac_addr   = mac_addr
+        self.ip_addr    = ip_addr
+        self.impairment = tc.describe(impairment)
+
+        self._former_mac = None # Settings to restore on removal
+        self._added_ip   = False
+
+    def _recorded(self, entries):
+        """
+        Settings to restore on removal, from the journal entries of the
+        interface (see Resource_Journal.pop_settings), for links built from
+        their description.
+        """
+
+        macs             = [x["address"] for x in entries if x["kind"] == "mac"]
+        self._former_mac = macs[0] if macs else None
+        self._added_ip   = any((x["kind"] == "ip") and (x["address"] == self.ip_addr) for x in entries)
+
+    def describe(self):
+        return {"type": self.kind, "name": self.name, "mac_addr": self.mac_addr, "ip_addr": self.ip_addr, "impairment": self.impairment}
+
+    def impairments(self):
+        return [(self.name, None, self.impairment)]
+
+    def set_impairment(self, ifname: str, impairment):
+        if ifname != self.name:
+            raise ValueError(f"{ifname} is not the {self.name} physical interface")
+        self.impairment = tc.describe(impairment)
 
     def instanciate(self):
         self.log.info(f"Configure {self.name} physical link")
-        if (self.mac_addr is not None):
-            self.log.info(f"> Set {self.name} MAC addr to {self.mac_addr}")
+        with netlink.ndb() as ndb:
+            if (self.mac_addr is not None):
+                self.log.info(f"> Set {self.name} MAC addr to {self.mac_addr}")
+
+                self._former_mac = ndb.interfaces[self.name]["address"]
+                journal.record("mac", self.name, address=self._former_mac)
 
-            with NDB() as ndb:
                 ndb.interfaces[self.name].set("state", "down").commit()
                 ndb.interfaces[self.name].set("address", self.mac_addr).commit()
-        
-        if (self.ip_addr is not None):
-            self.log.info(f"> Set {self.name} IP address to {self.ip_addr}")
-            
-            with NDB() as ndb:
+
+            if (self.ip_addr is not None):
+                self.log.info(f"> Set {self.name} IP address to {self.ip_addr}")
+
                 itf = ndb.interfaces[self.name]
                 if self.ip_addr in itf.ipaddr:
                     self.log.warn(f"IP address {self.ip_addr} already registered for interface")
                 else:
+                    journal.record("ip", self.name, address=self.ip_addr)
                     ndb.interfaces[self.name].add_ip(self.ip_addr).commit()
+                    self._added_ip = True
+
+        if self.impairment is not None:
+            self.log.info(f"> Set {self.name} impairment to {self.impairment}")
+            journal.record("qdisc", self.name)
+            tc.apply([(self.name, None, None, self.impairment)])
 
     
     def remove(self):
-        pass
+        # Physical interfaces are not removed, only their settings are restored
+        if self.impairment is not None:
+            self.log.info(f"> Remove {self.name} impairment")
+            tc.apply([(self.name, None, self.impairment, None)])
+
+        with netlink.ndb() as ndb:
+            if self._added_ip:
+                self.log.info(f"> Remove {self.ip_addr} IP address from {self.name}")
+                ndb.interfaces[self.name].del_ip(self.ip_addr).commit()
+                self._added_ip = False
+
+            if self._former_mac is not None:
+                self.log.info(f"> Restore {self.name} MAC addr to {self._former_mac}")
+                ndb.interfaces[self.name].set("address", self._former_mac).commit()
+                self._former_mac = None
 
 
 ##########################################
@@ -141,6 +427,8 @@ class Link_Pipe(Link):
         to link to physical ports together.
     """
 
+    kind = "pipe"
+
     def __init__(self, name, p0_name, p1_name, p0_mac=None, p1_mac=None, p0_ip=None, p1_ip=None):
         super().__init__()
 
@@ -158,41 +446,75 @@ class Link_Pipe(Link):
 
     ###########################
 
+    def describe(self):
+        return {
+            "type"   : self.kind,
+            "name"   : self.name,
+            "p0_name": self.p0_name, "p1_name": self.p1_name,
+            "p0_mac" : self.p0_mac , "p1_mac" : self.p1_mac ,
+            "p0_ip"  : self.p0_ip  , "p1_ip"  : self.p1_ip  ,
+        }
+
+    address_fields = ("p0_ip", "p1_ip")
+
+    def addresses(self):
+        # Ports of datapaths are in the current network namespace
+        return [(self.p0_name, None, self.p0_ip), (self.p1_name, None, self.p1_ip)]
+
     def instanciate(self):
         self.log.info(f"Configure pipe {self.name} {self.p0_name} {self.p1_name}")
-        ovs.dpctl("add-dp", self.name)
-        ovs.dpctl("add-if", self.name, self.p0_name)
-        ovs.dpctl("add-if", self.name, self.p1_name)
+        journal.record("datapath", self.name)
+
+        # ovs-dpctl has no transaction syntax, but ports can be given on datapath creation
+        ovs.dpctl("add-dp", self.name, self.p0_name, self.p1_name)
 
         # Add rules
         self.log.debug("> Redirect 0 <=> 1")
         ovs.dpctl("add-flow", self.name, "in_port(1),eth()", "2")
         ovs.dpctl("add-flow", self.name, "in_port(2),eth()", "1")
 
+        self._configure_ports()
+
+    async def instanciate_async(self):
+        self.log.info(f"Configure pipe {self.name} {self.p0_name} {self.p1_name}")
+        journal.record("datapath", self.name)
+
+        await ovs.dpctl_async("add-dp", self.name, self.p0_name, self.p1_name)
+
+        self.log.debug("> Redirect 0 <=> 1")
+        await asyncio.gather(
+            ovs.dpctl_async("add-flow", self.name, "in_port(1),eth()", "2"),
+            ovs.dpctl_async("add-flow", self.name, "in_port(2),eth()", "1"),
+        )
+
+        await to_thread(self._configure_ports)
+
+    def _configure_ports(self):
         # Configure mac and IP addr
-        if self.p0_mac is not None:
-            self.log.debug(f"> Configure port0 mac to {self.p0_mac}")
-            with NDB() as ndb:
+        with netlink.ndb() as ndb:
+            if self.p0_mac is not None:
+                self.log.debug(f"> Configure port0 mac to {self.p0_mac}")
                 ndb.interfaces[self.p0_name].set("state", "down").commit()
                 ndb.interfaces[self.p0_name].set("address", self.p0_mac).commit()
-        if self.p1_mac is not None:
-            self.log.debug(f"> Configure port1 mac to {self.p1_mac}")
-            with NDB() as ndb:
+            if self.p1_mac is not None:
+                self.log.debug(f"> Configure port1 mac to {self.p1_mac}")
                 ndb.interfaces[self.p1_name].set("state", "down").commit()
                 ndb.interfaces[self.p1_name].set("address", self.p1_mac).commit()
-        if self.p0_ip is not None:
-            self.log.debug(f"> Configure port0 IP to {self.p0_ip}")
-            with NDB() as ndb:
+            if self.p0_ip is not None:
+                self.log.debug(f"> Configure port0 IP to {self.p0_ip}")
                 ndb.interfaces[self.p0_name].add_ip(self.p0_ip).commit()
-        if self.p1_ip is not None:
-            self.log.debug(f"> Configure port0 IP to {self.p1_ip}")
-            with NDB() as ndb:
+            if self.p1_ip is not None:
+                self.log.debug(f"> Configure port1 IP to {self.p1_ip}")
                 ndb.interfaces[self.p1_name].add_ip(self.p1_ip).commit()
 
     def remove(self):
         self.log.info("Remove bypass")
         ovs.dpctl("del-dp", self.name)
 
+    async def remove_async(self):
+        self.log.info("Remove bypass")
+        await ovs.dpctl_async("del-dp", self.name)
+
     ###########################
 
     #def up(self):
@@ -207,4 +529,47 @@ class Link_Pipe(Link):
 
     #    with NDB() as ndb:
     #        ndb.interfaces[self.p0_name].set("state", "down").commit()
-    #        ndb.interfaces[self.p1_name].set("state", "down").commit()
\ No newline at end of file
+    #        ndb.interfaces[self.p1_name].set("state", "down").commit()
+
+
+##########################################
+# Addresses
+##########################################
+
+def set_addresses(targets):
+    """
+    Change the addresses of several interfaces, in one netlink batch per
+    network namespace. Former addresses are removed before the new ones
+    are added.
+
+    :param targets: Iterable of (ifname, netns, old address, new address)
+                    tuples, addresses are None when not set.
+    """
+
+    by_ns = dict()
+    for name, ns, old, new in targets:
+        if old != new:
+            by_ns.setdefault(ns, list()).append((name, old, new))
+
+    for ns, ns_targets in by_ns.items():
+        with netlink.ipr(ns) as ipr:
+            indexes = netlink.link_indexes(ipr)
+            removes = [netlink.addr_request("del"    , index=indexes[name], address=old) for name, old, _ in ns_targets if old is not None]
+            adds    = [netlink.addr_request("replace", index=indexes[name], address=new) for name, _, new in ns_targets if new is not None]
+
+            # Former addresses may have been removed by hand already
+            if removes:
+                netlink.batch(ipr, removes)
+            if adds:
+                Link_VEth._check_batch(adds, netlink.batch(ipr, adds))
+
+
+##########################################
+# Link types by name
+##########################################
+
+link_types = {
+    Link_VEth.kind: Link_VEth,
+    Link_Phy.kind : Link_Phy,
+    Link_Pipe.kind: Link_Pipe,
+}
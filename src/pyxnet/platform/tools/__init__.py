@@ -7,6 +7,11 @@ Simple tool wrappers
 :Date: January 2023
 """
 
+import asyncio
+import contextvars
+import functools
+
+
 def ifp(x=""):
     """
     InterFace Prefix. Prefix an interface name with pyxnet- for easier identification.
@@ -15,18 +20,13 @@ def ifp(x=""):
     return f"pxn-{x}"
 
 
-def sth(x):
-    """
-    ShorTHand. Generate a shorthand name on 3 characters.
-    """
-    return x
-    #return f"{x[:2]}{x[-1]}" if len(x) > 3 else x
-
-
-def ifs(x):
+async def to_thread(fn, *args, **kwargs):
     """
-    Return an interface name within the size of IFNAMSIZ=16 characters, including
-    null terminating byte (so max 15 chars.).
+    Run a blocking function in the event loop's default executor, with
+    a copy of the current context (active netlink session, ovs transaction...).
+    Same as asyncio.to_thread, which is only available from python 3.9.
     """
 
-    return x[0:min(len(x), 16)]
\ No newline at end of file
+    loop = asyncio.get_running_loop()
+    ctx  = contextvars.copy_context()
+    return await loop.run_in_executor(None, functools.partial(ctx.run, fn, *args, **kwargs))
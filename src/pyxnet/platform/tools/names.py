@@ -0,0 +1,153 @@
+"""
+=========================
+Interface name allocation
+=========================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+Interface, bridge and datapath names are limited to IFNAMSIZ-1 = 15
+characters by the kernel. A `Name_Allocator` gives each key (endpoint path,
+object name...) a unique name within this limit:
+
+- the readable name (e.g. pxn-sw1-p0) when it fits and is free ;
+- otherwise a name derived from a hash of the key (e.g. pxn-k3q9d0x2mfa),
+  with a counter mixed in the hash in the unlikely case of a collision.
+
+Names only depend on the keys (and on the allocation order for collisions),
+so the same topology always gets the same names. A salt gives different
+names to several copies of a topology sharing the same host namespace.
+"""
+
+import base64
+import hashlib
+
+from pyxnet.platform.tools import ifp
+
+
+IFNAMSIZ = 16
+"""Kernel interface name buffer size, including the null terminating byte"""
+
+
+class Name_Allocator:
+    def __init__(self, prefix: str = None, salt: str = ""):
+        self.prefix  = prefix if prefix is not None else ifp()
+        self.salt    = salt
+
+        if len(self.prefix) > IFNAMSIZ - 5:
+            raise ValueError(f"Prefix {self.prefix} is too long")
+
+        self._names  = dict() # Key  -> Name
+        self._keys   = dict() # Name -> Key
+
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, key: str):
+        return key in self._names
+
+
+    def _hashed(self, key: str, counter: int):
+        data   = f"{self.salt}|{key}|{counter}".encode("utf-8")
+        digest = base64.b32encode(hashlib.blake2b(data, digest_size=10).digest()).decode("ascii").lower()
+        return self.prefix + digest[:IFNAMSIZ - 1 - len(self.prefix)]
+
+    def allocate(self, key: str, hint: str = None):
+        """
+        Returns the name of a key, allocating it on first call.
+
+        :param key: Unique identifier of the interface, e.g. an endpoint path
+        :param hint: Readable name to use if possible, without prefix. Defaults
+                     to the key with "/" replaced by "-". Not used with a salt.
+        """
+
+        name = self._names.get(key, None)
+        if name is not None:
+            return name
+
+        if not self.salt:
+            readable = self.prefix + (hint if hint is not None else key.replace("/", "-"))
+            if (len(readable) < IFNAMSIZ) and (readable not in self._keys):
+                name = readable
+
+        counter = 0
+        while name is None:
+            candidate = self._hashed(key, counter)
+            if candidate not in self._keys:
+                name = candidate
+            counter += 1
+
+        self._names[key] = name
+        self._keys[name] = key
+        return name
+
+    def reserve(self, name: str, key: str = None):
+        """
+        Mark a name as used, e.g. by an interface that pyxnet does not manage
+        """
+
+        if name in self._keys:
+            raise ValueError(f"Name {name} already used by {self._keys[name]}")
+
+        self._keys[name] = key
+        if key is not None:
+            self._names[key] = name
+
+    def release(self, key: str):
+        name = self._names.pop(key, None)
+        if name is not None:
+            del self._keys[name]
+
+    def state(self):
+        """
+        Returns the allocated names, by key
+        """
+
+        return dict(self._names)
+
+    def restore(self, state: dict):
+        """
+        Allocate names saved with state(). Nothing is done if a name is
+        already used by another key, or a key already has another name.
+
+        :return: True if the names were restored
+        """
+
+        for key, name in state.items():
+            if self._names.get(key, name) != name or self._keys.get(name, key) != key:
+                return False
+
+        for key, name in state.items():
+            self._names[key] = name
+            self._keys[name] = key
+        return True
+
+    def name_of(self, key: str):
+        """
+        Returns the name allocated to a key, or None
+        """
+
+        return self._names.get(key, None)
+
+    def key_of(self, name: str):
+        """
+        Returns the key a name was allocated to, or None
+        """
+
+        return self._keys.get(name, None)
+
+
+##############################
+# Default allocator
+##############################
+
+__default = Name_Allocator()
+
+
+def default():
+    """
+    Allocator used by connections and objects outside of a topology
+    """
+
+    return __default
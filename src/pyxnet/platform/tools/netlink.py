@@ -0,0 +1,484 @@
+"""
+=======================
+Shared netlink sessions
+=======================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+Starting a pyroute2 `NDB` is expensive: it spawns a netlink source and loads
+the whole interface database. A `Netlink_Session` creates one NDB (or one raw
+`IPRoute` socket) on first use, and shares it with every `ndb()`/`ipr()` call
+made while the session is active.
+
+Outside of any session, `ndb()` and `ipr()` open and close a temporary
+object, so that objects and links can still be used on their own.
+
+Both accessors take an optional network namespace name. A session keeps
+one NDB/socket per namespace.
+"""
+
+import logging
+import os
+import select
+import threading
+import time
+
+from contextlib  import contextmanager
+from contextvars import ContextVar
+
+from pyroute2    import NDB, IPRoute, NetNS
+from pyroute2    import netns as pyroute2_netns
+
+from pyroute2.netlink.exceptions     import NetlinkError
+from pyroute2.netlink                import NLM_F_REQUEST, NLM_F_ACK, NLM_F_CREATE, NLM_F_EXCL, NLM_F_REPLACE
+from pyroute2.netlink.rtnl           import RTM_NEWLINK, RTM_DELLINK, RTM_NEWADDR, RTM_DELADDR, RTMGRP_LINK
+from pyroute2.netlink.rtnl.ifinfmsg  import ifinfmsg, IFF_LOWER_UP
+from pyroute2.netlink.rtnl.ifaddrmsg import ifaddrmsg
+from pyroute2.netlink.rtnl.tcmsg     import tcmsg, plugins as tc_plugins
+from pyroute2.netlink.rtnl           import RTM_NEWQDISC, RTM_DELQDISC, TC_H_ROOT
+from pyroute2.iproute.linux          import transform_handle
+
+from pyroute2.requests.main          import RequestProcessor
+from pyroute2.requests.link          import LinkFieldFilter, LinkIPRouteFilter
+from pyroute2.requests.address       import AddressFieldFilter, AddressIPRouteFilter
+
+from pyxnet.platform.tools           import trace
+
+
+#####################################
+# Session object
+#####################################
+
+class Netlink_Session:
+    """
+    Holds a NDB and an IPRoute socket for the duration of a set of operations
+    """
+
+    def __init__(self):
+        self.log       = logging.getLogger("Netlink session")
+
+        self._ndbs     = dict() # Network namespace -> NDB
+        self._iprs     = dict() # Network namespace -> IPRoute/NetNS socket
+
+        self._lock     = threading.Lock()  # Protects lazy creation
+        self._ipr_lock = threading.RLock() # IPRoute sockets are not thread safe
+
+        self._tokens   = []
+
+    def __enter__(self):
+        self._tokens.append(_current_session.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_session.reset(self._tokens.pop())
+
+        # Only close when leaving the outermost block
+        if not self._tokens:
+            self.close()
+
+
+    @property
+    def ndb(self):
+        return self.get_ndb(None)
+
+    @property
+    def ipr(self):
+        return self.get_ipr(None)
+
+    def get_ndb(self, netns: str = None):
+        with self._lock:
+            if netns not in self._ndbs:
+                self.log.debug(f"Start NDB (netns: {netns})")
+                self._ndbs[netns] = _new_ndb(netns)
+            return self._ndbs[netns]
+
+    def get_ipr(self, netns: str = None):
+        with self._lock:
+            if netns not in self._iprs:
+                self.log.debug(f"Open netlink socket (netns: {netns})")
+                self._iprs[netns] = _new_ipr(netns)
+            return self._iprs[netns]
+
+    def close(self):
+        with self._lock:
+            for netns, x in self._ndbs.items():
+                self.log.debug(f"Close NDB (netns: {netns})")
+                x.close()
+
+            for netns, x in self._iprs.items():
+                self.log.debug(f"Close netlink socket (netns: {netns})")
+                x.close()
+
+            self._ndbs = dict()
+            self._iprs = dict()
+
+
+def _new_ndb(netns):
+    # Starting a NDB loads the whole interfaces database
+    with trace.span("NDB start", tool="ndb", netns=netns):
+        if netns is None:
+            return NDB()
+        else:
+            return NDB(sources=[{"target": netns, "kind": "netns", "netns": netns}])
+
+
+def _new_ipr(netns):
+    if netns is None:
+        return IPRoute()
+    else:
+        return NetNS(netns)
+
+
+_current_session = ContextVar("netlink_session", default=None)
+
+
+def current():
+    """
+    Returns the active session, or None
+    """
+
+    return _current_session.get()
+
+
+#####################################
+# Accessors
+#####################################
+
+@contextmanager
+def ndb(netns: str = None):
+    """
+    Gives the NDB of the active session, or a temporary one.
+
+    .. code:: python
+
+        with netlink.ndb() as ndb:
+            ndb.interfaces["eth0"].set("state", "up").commit()
+
+    :param netns: Network namespace name, None for the current one
+    """
+
+    session = _current_session.get()
+    if session is not None:
+        yield session.get_ndb(netns)
+    else:
+        with _new_ndb(netns) as x:
+            yield x
+
+
+@contextmanager
+def ipr(netns: str = None):
+    """
+    Gives the IPRoute socket of the active session, or a temporary one.
+    The socket is reserved to the caller for the duration of the block.
+
+    :param netns: Network namespace name, None for the current one
+    """
+
+    session = _current_session.get()
+    if session is not None:
+        with session._ipr_lock:
+            yield session.get_ipr(netns)
+    else:
+        with _new_ipr(netns) as x:
+            yield x
+
+
+#####################################
+# Network namespaces
+#####################################
+
+def netns_list():
+    return pyroute2_netns.listnetns()
+
+
+def netns_create(name: str):
+    """
+    Create a named network namespace
+
+    :return: True if the namespace was created, False if it already exists
+    """
+
+    if name in pyroute2_netns.listnetns():
+        return False
+
+    with trace.span("create netns", tool="netns", netns=name):
+        pyroute2_netns.create(name)
+    return True
+
+
+def netns_remove(name: str):
+    """
+    Remove a named network namespace, with the interfaces in it
+    """
+
+    if name in pyroute2_netns.listnetns():
+        with trace.span("remove netns", tool="netns", netns=name):
+            pyroute2_netns.remove(name)
+
+
+#####################################
+# Batched requests
+#####################################
+
+BATCH_SIZE = 128
+"""Maximum number of messages sent at once, so that ACKs do not overflow the socket buffer"""
+
+__flags_req     = NLM_F_REQUEST | NLM_F_ACK
+__flags_create  = __flags_req   | NLM_F_CREATE | NLM_F_EXCL
+__flags_replace = __flags_req   | NLM_F_CREATE | NLM_F_REPLACE
+
+__link_commands = {
+    "add": (RTM_NEWLINK, __flags_create),
+    "set": (RTM_NEWLINK, __flags_req   ),
+    "del": (RTM_DELLINK, __flags_req   ),
+}
+
+__addr_commands = {
+    "add"    : (RTM_NEWADDR, __flags_create ),
+    "replace": (RTM_NEWADDR, __flags_replace),
+    "del"    : (RTM_DELADDR, __flags_req    ),
+}
+
+__qdisc_commands = {
+    "add"    : (RTM_NEWQDISC, __flags_create ),
+    "replace": (RTM_NEWQDISC, __flags_replace),
+    "del"    : (RTM_DELQDISC, __flags_req    ),
+}
+
+
+def _request(msg, filters, msg_type, msg_flags, kwarg, skip=()):
+    """
+    Build a netlink message the same way IPRoute methods do, without sending it
+    """
+
+    request = RequestProcessor(context=kwarg, prime=kwarg)
+    for rfilter in filters:
+        request.apply_filter(rfilter)
+    request.finalize()
+
+    for field in msg.fields:
+        if field[0] not in skip:
+            msg[field[0]] = request.pop(field[0], 0)
+
+    for key, value in request.items():
+        nla = type(msg).name2nla(key)
+        if msg.valid_nla(nla) and value is not None:
+            msg["attrs"].append([nla, value])
+
+    msg["header"]["type"]  = msg_type
+    msg["header"]["flags"] = msg_flags
+    return msg
+
+
+def link_request(command: str, **kwarg):
+    """
+    Build a RTM_NEWLINK/RTM_DELLINK message, with the same arguments as `IPRoute.link`:
+
+    .. code:: python
+
+        netlink.link_request("add", ifname="v0", kind="veth", address="02:00:00:00:00:01",
+            peer={"ifname": "v1", "address": "02:00:00:00:00:02"})
+
+    :param command: "add", "set" or "del"
+    """
+
+    msg_type, msg_flags = __link_commands[command]
+    return _request(ifinfmsg(), (LinkFieldFilter(), LinkIPRouteFilter(command)), msg_type, msg_flags, kwarg)
+
+
+def addr_request(command: str, **kwarg):
+    """
+    Build a RTM_NEWADDR/RTM_DELADDR message, with the same arguments as `IPRoute.addr`.
+
+    :param command: "add", "replace" or "del"
+    """
+
+    msg_type, msg_flags = __addr_commands[command]
+    # Flags are given as NLA for addresses
+    return _request(ifaddrmsg(), (AddressFieldFilter(), AddressIPRouteFilter(command)), msg_type, msg_flags, kwarg, skip=("flags",))
+
+
+def qdisc_request(command: str, kind: str = None, index: int = 0, handle=0, **kwarg):
+    """
+    Build a RTM_NEWQDISC/RTM_DELQDISC message, with the same arguments as `IPRoute.tc`:
+
+    .. code:: python
+
+        netlink.qdisc_request("replace", "netem", index=12, handle="1:", delay=20000, loss=1)
+
+    :param command: "add", "replace" or "del"
+    """
+
+    msg_type, msg_flags = __qdisc_commands[command]
+
+    msg = tcmsg()
+    msg["index"]  = index
+    msg["handle"] = transform_handle(handle)
+
+    parent = kwarg.pop("parent", None)
+    plugin = tc_plugins.get(kind, None)
+    if parent is None:
+        parent = getattr(plugin, "parent", TC_H_ROOT)
+    msg["parent"] = transform_handle(parent)
+
+    if kind is not None:
+        msg["attrs"].append(["TCA_KIND", kind])
+    if (plugin is not None) and kwarg:
+        msg["attrs"].append(["TCA_OPTIONS", plugin.get_parameters(kwarg)])
+
+    msg["header"]["type"]  = msg_type
+    msg["header"]["flags"] = msg_flags
+    return msg
+
+
+def batch(ipr, msgs):
+    """
+    Send the messages in as few writes as possible, then wait for all the ACKs.
+
+    :param ipr: IPRoute socket
+    :param msgs: List of messages from `link_request`/`addr_request`/`qdisc_request`
+    :return: List of errors (`NetlinkError` or None) in the order of msgs
+    """
+
+    with trace.span("batch", tool="netlink", messages=len(msgs), netns=isinstance(ipr, NetNS)):
+        if isinstance(ipr, NetNS):
+            # NetNS sockets are proxies to a process in the namespace, which
+            # cannot send batches: messages are sent one by one.
+            return [_request_one(ipr, msg) for msg in msgs]
+
+        errors = []
+        for i in range(0, len(msgs), BATCH_SIZE):
+            chunk   = msgs[i:i+BATCH_SIZE]
+            results = {}
+            for res in ipr.nlm_request_batch(chunk, noraise=True):
+                results[res["header"]["sequence_number"]] = res["header"].get("error", None)
+            errors.extend(results.get(msg["header"]["sequence_number"], None) for msg in chunk)
+
+        return errors
+
+
+def _request_one(ipr, msg):
+    try:
+        ipr.nlm_request(msg, msg_type=msg["header"]["type"], msg_flags=msg["header"]["flags"])
+        return None
+    except NetlinkError as exc:
+        return exc
+
+
+def link_indexes(ipr):
+    """
+    Returns a dict giving the index of each interface name, from a single dump.
+    """
+
+    with trace.span("dump links", tool="netlink"):
+        return {x.get_attr("IFLA_IFNAME"): x["index"] for x in ipr.get_links()}
+
+
+#####################################
+# Link state events
+#####################################
+
+class Link_Wait_Error(TimeoutError):
+    """
+    Raised when interfaces are not up in time. stragglers gives the last
+    known operational state of each of them, None if it was never seen.
+    """
+
+    def __init__(self, stragglers: dict, timeout: float):
+        self.stragglers = dict(stragglers)
+        self.timeout    = timeout
+
+        names = ", ".join(f"{key} ({state or 'missing'})" for key, state in sorted(self.stragglers.items()))
+        super().__init__(f"{len(self.stragglers)} interfaces not up after {timeout}s: {names}")
+
+
+def _event_socket(netns):
+    # NetNS sockets are proxies which cannot be waited on with select():
+    # a plain socket is opened from inside the namespace instead.
+    if netns is None:
+        sock = IPRoute()
+    else:
+        saved = os.open("/proc/thread-self/ns/net", os.O_RDONLY)
+        try:
+            pyroute2_netns.setns(netns, flags=0)
+            sock = IPRoute()
+        finally:
+            pyroute2_netns.setns(saved, flags=0)
+            os.close(saved)
+
+    sock.bind(groups=RTMGRP_LINK)
+    return sock
+
+
+def _link_ready(msg):
+    state = msg.get_attr("IFLA_OPERSTATE")
+    # Interfaces without carrier detection (e.g. openvswitch internal ports) stay UNKNOWN
+    return (state == "UP") or ((state == "UNKNOWN") and bool(msg["flags"] & IFF_LOWER_UP))
+
+
+def _link_events(pending, states, msgs):
+    for msg in msgs:
+        if msg["header"]["type"] != RTM_NEWLINK:
+            continue
+
+        key = pending.get(msg.get_attr("IFLA_IFNAME"), None)
+        if key is not None:
+            states[key] = msg.get_attr("IFLA_OPERSTATE")
+            if _link_ready(msg):
+                del pending[msg.get_attr("IFLA_IFNAME")]
+
+
+def wait_links_up(interfaces: dict, timeout: float = 10.0):
+    """
+    Wait until interfaces are operationally up. The link events of each
+    namespace are subscribed to before reading the current states, so
+    that no change is missed, then only the events are read: the call
+    returns as soon as the kernel reports the last interface up.
+
+    :param interfaces: dict giving the (interface name, network namespace) tuple
+                       of each key, e.g. of each endpoint path
+    :param timeout: Maximum time to wait, in seconds
+    :return: The time waited, in seconds
+    :raises Link_Wait_Error: if some interfaces are not up after timeout
+    """
+
+    t_start  = time.monotonic()
+    deadline = t_start + timeout
+
+    pending  = dict() # Network namespace -> Interface name -> key
+    states   = dict() # Key -> Last operational state
+    for key, (ifname, netns) in interfaces.items():
+        pending.setdefault(netns, dict())[ifname] = key
+        states[key] = None
+
+    sockets  = dict()
+    with trace.span("wait links up", tool="netlink", interfaces=len(interfaces)):
+        try:
+            for netns, names in pending.items():
+                sockets[netns] = _event_socket(netns)
+                _link_events(names, states, sockets[netns].get_links())
+
+            while any(pending.values()):
+                waiting = {sockets[ns]: ns for ns, names in pending.items() if names}
+
+                # Events received while dumping the links are kept by pyroute2
+                ready = [sock for sock in waiting if sock.backlog.get(0, None)]
+                if not ready:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    ready, _, _ = select.select(list(waiting), [], [], remaining)
+
+                for sock in ready:
+                    _link_events(pending[waiting[sock]], states, sock.get())
+
+        finally:
+            for sock in sockets.values():
+                sock.close()
+
+    stragglers = {key: states[key] for names in pending.values() for key in names.values()}
+    if stragglers:
+        raise Link_Wait_Error(stragglers, timeout)
+
+    return time.monotonic() - t_start
@@ -7,9 +7,16 @@ Simple tools to access openvswitch
 :Date: January 2023
 """
 
+import asyncio
+import json
 import logging
+import os
 import subprocess
 
+from contextlib  import contextmanager, asynccontextmanager
+from contextvars import ContextVar
+
+from pyxnet.platform.tools import to_thread, trace
 
 from pyroute2 import NDB
 
@@ -27,18 +34,306 @@ class OVS_Error(Exception):
 __ovs_vsctl_log = logging.getLogger("ovs-vsctl")
 __ovs_dpctl_log = logging.getLogger("ovs-dpctl")
 
+__backend       = os.environ.get("PYXNET_OVS_BACKEND", "vsctl")
+__backends      = ("vsctl", "ovsdb")
+
+
+def set_backend(name: str):
+    """
+    Select how vsctl() commands are run:
+
+    - "vsctl": fork an ovs-vsctl process for each call (default) ;
+    - "ovsdb": send the commands through a persistent OVSDB JSON-RPC connection.
+      Commands that the translation layer does not know fall back to ovs-vsctl.
+
+    The PYXNET_OVS_BACKEND environment variable gives the default value.
+    """
+
+    global __backend
+
+    if name not in __backends:
+        raise ValueError(f"Unknown OVS backend {name}, expected one of {__backends}")
+    __backend = name
+
+
+def get_backend():
+    return __backend
+
+
+def _span_name(tool, args):
+    # First command of the call, after the options and "--" separators
+    cmd = next((x for x in args if not x.startswith("-")), "")
+    return f"{tool} {cmd}"
+
 
 def vsctl(*args):
-    try:
-        __ovs_vsctl_log.debug(f"Call with args: {args}")
-        return subprocess.run(["ovs-vsctl", *args], capture_output=True, check=True)
-    except subprocess.CalledProcessError as exc:
-        raise OVS_Error(f"Failed {exc.cmd} call: {exc.stderr.decode('utf-8')}")
+    with trace.span(_span_name("ovs-vsctl", args), tool="vsctl", argv=args, backend=__backend):
+        if __backend == "ovsdb":
+            from pyxnet.platform.tools import ovsdb
+
+            __ovs_vsctl_log.debug(f"OVSDB call with args: {args}")
+            ret = ovsdb.vsctl(*args)
+            if ret is not None:
+                return ret
+
+        try:
+            __ovs_vsctl_log.debug(f"Call with args: {args}")
+            return subprocess.run(["ovs-vsctl", *args], capture_output=True, check=True)
+        except subprocess.CalledProcessError as exc:
+            raise OVS_Error(f"Failed {exc.cmd} call: {exc.stderr.decode('utf-8')}")
+
+
+def list_br():
+    """
+    Returns the list of bridge names
+    """
+
+    if __backend == "ovsdb":
+        from pyxnet.platform.tools import ovsdb
+        return sorted(row["name"] for row in ovsdb.client().select("Bridge", columns=["name"]))
+
+    ret = vsctl("list-br")
+    return [x for x in ret.stdout.decode("utf-8").split("\n") if x]
+
+
+def find_br(key: str, value: str):
+    """
+    Returns the names of the bridges with the given external_ids value
+    """
+
+    if __backend == "ovsdb":
+        from pyxnet.platform.tools import ovsdb
+        where = [["external_ids", "includes", ["map", [[key, value]]]]]
+        return sorted(row["name"] for row in ovsdb.client().select("Bridge", where=where, columns=["name"]))
+
+    ret = vsctl("--bare", "--columns=name", "find", "Bridge", f"external_ids:{key}={value}")
+    return [x for x in ret.stdout.decode("utf-8").split("\n") if x]
+
+
+def _ovsdb_map(value):
+    # OVSDB maps are ["map", [[key, value], ...]]
+    return dict(value[1]) if isinstance(value, list) and value and (value[0] == "map") else dict()
+
+
+def port_status(names=None):
+    """
+    Returns the STP and RSTP status of the ports, read in a single query.
+
+    :param names: Only return these ports. All the ports are read anyway.
+    :return: dict giving for each port name a dict with the "status" (STP,
+             e.g. stp_port_state) and "rstp_status" (e.g. rstp_port_state) maps.
+    """
+
+    columns = ["name", "status", "rstp_status"]
+
+    if __backend == "ovsdb":
+        from pyxnet.platform.tools import ovsdb
+        rows = [[row[x] for x in columns] for row in ovsdb.client().select("Port", columns=columns)]
+
+    else:
+        ret  = vsctl("--format=json", f"--columns={','.join(columns)}", "list", "Port")
+        rows = json.loads(ret.stdout.decode("utf-8"))["data"]
+
+    names = set(names) if names is not None else None
+    return {
+        name: {"status": _ovsdb_map(status), "rstp_status": _ovsdb_map(rstp_status)}
+        for name, status, rstp_status in rows
+        if (names is None) or (name in names)
+    }
 
 
 def dpctl(*args):
+    with trace.span(_span_name("ovs-dpctl", args), tool="dpctl", argv=args):
+        try:
+            __ovs_dpctl_log.debug(f"Call with args: {args}")
+            return subprocess.run(["ovs-dpctl", *args], capture_output=True, check=True)
+        except subprocess.CalledProcessError as exc:
+            raise OVS_Error(f"Failed {exc.cmd} call: {exc.stderr.decode('utf-8')}")
+
+
+def list_dp():
+    """
+    Returns the list of datapath names, without their type prefix
+    """
+
+    ret = dpctl("dump-dps")
+    return [x.partition("@")[2] for x in ret.stdout.decode("utf-8").split("\n") if "@" in x]
+
+
+#####################################
+# asyncio command wrappers
+#####################################
+
+async def _run_async(cmd, log):
+    log.debug(f"Async call with args: {cmd[1:]}")
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise OVS_Error(f"Failed {cmd} call: {stderr.decode('utf-8')}")
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout=stdout, stderr=stderr)
+
+
+async def vsctl_async(*args):
+    """
+    Same as vsctl(), without blocking the event loop
+    """
+
+    with trace.span(_span_name("ovs-vsctl", args), tool="vsctl", argv=args, backend=__backend):
+        if __backend == "ovsdb":
+            from pyxnet.platform.tools import ovsdb
+
+            __ovs_vsctl_log.debug(f"OVSDB call with args: {args}")
+            ret = await to_thread(ovsdb.vsctl, *args)
+            if ret is not None:
+                return ret
+
+        return await _run_async(["ovs-vsctl", *args], __ovs_vsctl_log)
+
+
+async def dpctl_async(*args):
+    """
+    Same as dpctl(), without blocking the event loop
+    """
+
+    with trace.span(_span_name("ovs-dpctl", args), tool="dpctl", argv=args):
+        return await _run_async(["ovs-dpctl", *args], __ovs_dpctl_log)
+
+
+#####################################
+# ovs-vsctl transactions
+#####################################
+
+class VSCtl_Transaction:
+    """
+    Collects ovs-vsctl commands so that they are sent as a single
+    `ovs-vsctl -- cmd1 -- cmd2 ...` call, hence a single OVSDB transaction.
+
+    Callbacks registered with `on_commit` are called once the commands
+    have been applied, for instance to configure an interface that only
+    exists once the transaction is done.
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.hooks    = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def add(self, *args):
+        """
+        Append a command to the transaction.
+
+        :param args: ovs-vsctl command and arguments, e.g. ("add-br", "br0")
+        """
+
+        self.commands.append(args)
+        return self
+
+    def on_commit(self, fn):
+        """
+        Register a callable to run after the transaction has been committed.
+        """
+
+        self.hooks.append(fn)
+        return fn
+
+    def commit(self):
+        """
+        Send all pending commands in one ovs-vsctl call, then run the
+        commit hooks. The transaction is empty afterwards and can be reused.
+        """
+
+        commands, self.commands = self.commands, []
+        hooks,    self.hooks    = self.hooks,    []
+
+        ret = vsctl(*self._args(commands)) if commands else None
+
+        for hook in hooks:
+            with trace.span(getattr(hook, "__qualname__", "commit hook"), tool="hook"):
+                hook()
+
+        return ret
+
+    async def commit_async(self):
+        """
+        Same as commit(), without blocking the event loop. Hooks can be
+        coroutine functions, other hooks are run in the default executor.
+        """
+
+        commands, self.commands = self.commands, []
+        hooks,    self.hooks    = self.hooks,    []
+
+        ret = (await vsctl_async(*self._args(commands))) if commands else None
+
+        for hook in hooks:
+            with trace.span(getattr(hook, "__qualname__", "commit hook"), tool="hook"):
+                if asyncio.iscoroutinefunction(hook):
+                    await hook()
+                else:
+                    await to_thread(hook)
+
+        return ret
+
+    @staticmethod
+    def _args(commands):
+        args = []
+        for cmd in commands:
+            args.extend(("--", *cmd))
+        return args
+
+
+__current_transaction = ContextVar("ovs_vsctl_transaction", default=None)
+
+
+@contextmanager
+def transaction():
+    """
+    Context manager giving the active ovs-vsctl transaction.
+
+    If a transaction is already active in the current context, it is reused,
+    and commands are only sent when the outermost block exits. This allows
+    to batch commands per object, or for a whole topology:
+
+    .. code:: python
+
+        with ovs.transaction() as tr:
+            tr.add("add-br", "br0")
+            tr.add("set", "Bridge", "br0", "stp_enable=true")
+    """
+
+    tr = __current_transaction.get()
+    if tr is not None:
+        yield tr
+        return
+
+    tr    = VSCtl_Transaction()
+    token = __current_transaction.set(tr)
     try:
-        __ovs_dpctl_log.debug(f"Call with args: {args}")
-        return subprocess.run(["ovs-dpctl", *args], capture_output=True, check=True)
-    except subprocess.CalledProcessError as exc:
-        raise OVS_Error(f"Failed {exc.cmd} call: {exc.stderr.decode('utf-8')}")
\ No newline at end of file
+        yield tr
+    finally:
+        __current_transaction.reset(token)
+
+    tr.commit()
+
+
+
+@asynccontextmanager
+async def transaction_async():
+    """
+    Same as transaction(), the outermost block commits with commit_async().
+    """
+
+    tr = __current_transaction.get()
+    if tr is not None:
+        yield tr
+        return
+
+    tr    = VSCtl_Transaction()
+    token = __current_transaction.set(tr)
+    try:
+        yield tr
+    finally:
+        __current_transaction.reset(token)
+
+    await tr.commit_async()
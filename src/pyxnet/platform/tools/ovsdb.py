@@ -0,0 +1,488 @@
+"""
+======================================
+Native OVSDB JSON-RPC client (RFC7047)
+======================================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+This module talks to `ovsdb-server` directly through its unix socket, instead of
+forking an `ovs-vsctl` process for each operation. A single connection is kept per
+process (see `client()`), and multiple operations are sent in one transaction.
+
+The `vsctl()` function translates the subset of `ovs-vsctl` commands used by pyxnet
+into OVSDB operations, so that `pyxnet.platform.tools.ovs.vsctl` call sites can switch
+to this backend transparently (see `pyxnet.platform.tools.ovs.set_backend`).
+"""
+
+import codecs
+import json
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+
+from itertools import count
+
+from pyxnet.platform.tools.ovs import OVS_Error
+
+
+#####################################
+# Errors
+#####################################
+
+class OVSDB_Error(OVS_Error):
+    def __init__(self, msg):
+        super().__init__(msg)
+
+
+#####################################
+# JSON-RPC client
+#####################################
+
+def default_socket_path():
+    """
+    Returns the path of the ovsdb-server socket, honoring the OVS_RUNDIR
+    environment variable like the openvswitch tools do.
+    """
+
+    return os.path.join(os.environ.get("OVS_RUNDIR", "/var/run/openvswitch"), "db.sock")
+
+
+class OVSDB_Client:
+    """
+    Minimal OVSDB JSON-RPC client over a unix socket.
+    """
+
+    def __init__(self, path: str = None, timeout: float = 10.0, db: str = "Open_vSwitch"):
+        self.path    = path or default_socket_path()
+        self.timeout = timeout
+        self.db      = db
+        self.log     = logging.getLogger(f"OVSDB {self.path}")
+
+        self._sock   = None
+        self._buffer = ""
+        self._ids    = count()
+        self._lock   = threading.RLock()
+        self._pid    = None
+
+        self._decoder = json.JSONDecoder()
+        self._utf8    = codecs.getincrementaldecoder("utf-8")()
+
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    @property
+    def connected(self):
+        return (self._sock is not None) and (self._pid == os.getpid())
+
+
+    def connect(self):
+        with self._lock:
+            if not self.connected:
+                self.log.debug("Connect to ovsdb-server")
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                try:
+                    sock.connect(self.path)
+                except OSError as exc:
+                    sock.close()
+                    raise OVSDB_Error(f"Cannot connect to {self.path}: {exc}")
+
+                self._sock   = sock
+                self._buffer = ""
+                self._pid    = os.getpid()
+                self._utf8.reset()
+        return self
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None:
+                # Do not close a socket inherited from a parent process
+                if self._pid == os.getpid():
+                    self._sock.close()
+                self._sock = None
+
+
+    # ---------------- Raw JSON-RPC
+
+    def _send(self, msg):
+        self._sock.sendall(json.dumps(msg).encode("utf-8"))
+
+    def _recv(self):
+        """
+        Read one JSON message. Messages are not delimited on the wire,
+        so the buffer is decoded incrementally. Characters split between
+        two reads are kept by the UTF-8 decoder until they are complete.
+        """
+
+        while True:
+            data = self._buffer.lstrip()
+            if data:
+                try:
+                    msg, end = self._decoder.raw_decode(data)
+                    self._buffer = data[end:]
+                    return msg
+                except json.JSONDecodeError:
+                    pass # Incomplete message
+
+            chunk = self._sock.recv(65536)
+            if not chunk:
+                self.close()
+                raise OVSDB_Error("Connection closed by ovsdb-server")
+            self._buffer = data + self._utf8.decode(chunk)
+
+    def call(self, method: str, params: list):
+        """
+        Send a JSON-RPC request and wait for its response.
+
+        :param method: JSON-RPC method, e.g. "transact"
+        :param params: Method parameters
+        :return: The "result" member of the response
+        """
+
+        with self._lock:
+            self.connect()
+
+            msg_id = next(self._ids)
+            try:
+                self._send({"method": method, "params": params, "id": msg_id})
+
+                while True:
+                    msg = self._recv()
+
+                    # Keepalive requests from the server
+                    if msg.get("method") == "echo":
+                        self._send({"result": msg.get("params", []), "error": None, "id": msg.get("id")})
+
+                    elif msg.get("id") == msg_id:
+                        if msg.get("error") is not None:
+                            raise OVSDB_Error(f"{method} failed: {msg['error']}")
+                        return msg.get("result")
+
+                    # Other messages (notifications, stale responses) are dropped
+
+            except OSError as exc:
+                self.close()
+                raise OVSDB_Error(f"{method} failed: {exc}")
+
+
+    # ---------------- OVSDB methods
+
+    def list_dbs(self):
+        return self.call("list_dbs", [])
+
+    def transact(self, *ops, errors: dict = None):
+        """
+        Run the given operations in a single OVSDB transaction.
+
+        :param errors: Error messages to raise when some operations fail, by
+                       operation index, instead of the server error.
+        :return: List of operation results
+        :raises OVSDB_Error: when any of the operations failed
+        """
+
+        results = self.call("transact", [self.db, *ops])
+        for i, (op, res) in enumerate(zip(ops, results)):
+            if isinstance(res, dict) and ("error" in res):
+                if (errors is not None) and (i in errors):
+                    raise OVSDB_Error(errors[i])
+                raise OVSDB_Error(f"Operation {op['op']} on {op.get('table', '?')} failed: {res['error']}: {res.get('details', '')}")
+
+        # An extra error is appended when the transaction itself failed to commit
+        if len(results) > len(ops) and results[-1] and ("error" in results[-1]):
+            raise OVSDB_Error(f"Transaction failed: {results[-1]['error']}: {results[-1].get('details', '')}")
+
+        return results
+
+    def select(self, table: str, where: list = None, columns: list = None):
+        op = {"op": "select", "table": table, "where": where or []}
+        if columns is not None:
+            op["columns"] = columns
+        return self.transact(op)[0]["rows"]
+
+    def wait_reconfigured(self, next_cfg: int, timeout: float = None):
+        """
+        Wait for ovs-vswitchd to apply a configuration, the same way ovs-vsctl does:
+        ovs-vswitchd copies next_cfg to cur_cfg once it is done reconfiguring.
+        """
+
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        delay    = 0.001
+        while True:
+            rows = self.select("Open_vSwitch", columns=["cur_cfg"])
+            if rows and rows[0]["cur_cfg"] >= next_cfg:
+                return
+
+            if time.monotonic() >= deadline:
+                raise OVSDB_Error(f"Timeout waiting for ovs-vswitchd to reach configuration {next_cfg}")
+
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+
+__client      = None
+__client_lock = threading.Lock()
+
+
+def client(path: str = None):
+    """
+    Returns the process wide OVSDB connection. It is created on first use,
+    and opened again after a fork.
+
+    :param path: Socket path. Giving a different path than the current client
+                 replaces it, which is useful to point to a stand-in server.
+    """
+
+    global __client
+
+    with __client_lock:
+        path = path or (__client.path if __client is not None else None) or default_socket_path()
+        if (__client is None) or (__client.path != path):
+            if __client is not None:
+                __client.close()
+            __client = OVSDB_Client(path)
+
+        return __client.connect()
+
+
+#####################################
+# ovs-vsctl commands translation
+#####################################
+
+class _Unsupported(Exception):
+    """Raised when a vsctl command cannot be translated"""
+    pass
+
+
+def _parse_value(x: str):
+    """
+    Convert an ovs-vsctl value string to an OVSDB atom
+    """
+
+    if len(x) >= 2 and x[0] == x[-1] == '"':
+        return x[1:-1]
+    if x in ("true", "false"):
+        return x == "true"
+    try:
+        return int(x, 0)
+    except ValueError:
+        return x
+
+
+def _uuids(value):
+    """
+    UUIDs of a reference column value, a single ["uuid", x] or a set of them
+    """
+
+    if value[0] == "uuid":
+        return [value[1]]
+    return [x[1] for x in value[1]]
+
+
+class _Translator:
+    """
+    Translates a list of ovs-vsctl commands into OVSDB operations
+    """
+
+    def __init__(self, client):
+        self.client   = client
+        self.ops      = []
+        self.uuids    = count()
+        self.names    = [] # Results of list-br commands, by op index
+        self.errors   = {} # Error message of the checks, by op index
+        self.deleted  = set() # Rows deleted by the transaction, by uuid
+        self.mutating = False
+
+    def _named_uuid(self):
+        return f"row{next(self.uuids)}"
+
+    def _uuid_of(self, table, name):
+        # Rows deleted earlier in the transaction don't exist anymore
+        rows = self.client.select(table, [["name", "==", name]], ["_uuid"])
+        return rows[0]["_uuid"] if rows and (rows[0]["_uuid"][1] not in self.deleted) else None
+
+    # -------- Commands
+
+    def add_br(self, opts, name):
+        if ("--may-exist" in opts) and self._uuid_of("Bridge", name):
+            return
+
+        iface, port, bridge = self._named_uuid(), self._named_uuid(), self._named_uuid()
+        self.ops += [
+            {"op": "insert", "table": "Interface", "uuid-name": iface , "row": {"name": name, "type": "internal"}},
+            {"op": "insert", "table": "Port"     , "uuid-name": port  , "row": {"name": name, "interfaces": ["named-uuid", iface]}},
+            {"op": "insert", "table": "Bridge"   , "uuid-name": bridge, "row": {"name": name, "ports": ["named-uuid", port]}},
+            {"op": "mutate", "table": "Open_vSwitch", "where": [],
+                "mutations": [["bridges", "insert", ["set", [["named-uuid", bridge]]]]]},
+        ]
+        self.mutating = True
+
+    def del_br(self, opts, name):
+        uuid = self._uuid_of("Bridge", name)
+        if uuid is None:
+            if "--if-exists" in opts:
+                return
+            raise OVSDB_Error(f"no bridge named {name}")
+
+        # Ports and interfaces are garbage collected with the bridge
+        ports = self.client.select("Bridge", [["_uuid", "==", uuid]], ["ports"])[0]["ports"]
+        self.deleted.add(uuid[1])
+        self.deleted.update(_uuids(ports))
+        self.ops.append({"op": "mutate", "table": "Open_vSwitch", "where": [],
+            "mutations": [["bridges", "delete", ["set", [uuid]]]]})
+        self.mutating = True
+
+    def list_br(self, opts):
+        self.names.append(len(self.ops))
+        self.ops.append({"op": "select", "table": "Bridge", "where": [], "columns": ["name"]})
+
+    def add_port(self, opts, bridge, name, *col_values):
+        if ("--may-exist" in opts) and self._uuid_of("Port", name):
+            return
+
+        # Rows that the bridge does not reference would be garbage collected
+        self._check_exists("Bridge", bridge, f"no bridge named {bridge}")
+
+        iface, port = self._named_uuid(), self._named_uuid()
+        self.ops += [
+            {"op": "insert", "table": "Interface", "uuid-name": iface, "row": {"name": name}},
+            {"op": "insert", "table": "Port"     , "uuid-name": port , "row": {"name": name, "interfaces": ["named-uuid", iface]}},
+            {"op": "mutate", "table": "Bridge", "where": [["name", "==", bridge]],
+                "mutations": [["ports", "insert", ["set", [["named-uuid", port]]]]]},
+        ]
+        self.mutating = True
+
+        if col_values:
+            self.set(opts, "Port", name, *col_values)
+
+    def del_port(self, opts, *args):
+        bridge, name = args if len(args) == 2 else (None, args[0])
+        uuid = self._uuid_of("Port", name)
+        if uuid is None:
+            if "--if-exists" in opts:
+                return
+            raise OVSDB_Error(f"no port named {name}")
+
+        self.deleted.add(uuid[1])
+        where = [["name", "==", bridge]] if bridge else [["ports", "includes", uuid]]
+        self.ops.append({"op": "mutate", "table": "Bridge", "where": where,
+            "mutations": [["ports", "delete", ["set", [uuid]]]]})
+        self.mutating = True
+
+    def _check_exists(self, table, record, message: str = None):
+        # Aborts the transaction if the row does not exist when the operation
+        # runs: rows added earlier in the same transaction are found.
+        self.errors[len(self.ops)] = message or f"no row \"{record}\" in table {table}"
+        self.ops.append({"op": "wait", "table": table, "where": [["name", "==", record]],
+            "columns": ["name"], "until": "!=", "rows": [], "timeout": 0})
+
+    def set(self, opts, table, record, *col_values):
+        if "--if-exists" not in opts:
+            self._check_exists(table, record)
+
+        columns   = {}
+        mutations = []
+        for col_value in col_values:
+            column, _, value = col_value.partition("=")
+            column, _, key   = column.partition(":")
+            if key:
+                # Replace a single key of a map column
+                mutations.append([column, "delete", ["set", [key]]])
+                mutations.append([column, "insert", ["map", [[key, value]]]])
+            else:
+                columns[column] = _parse_value(value)
+
+        where = [["name", "==", record]]
+        if columns:
+            self.ops.append({"op": "update", "table": table, "where": where, "row": columns})
+        if mutations:
+            self.ops.append({"op": "mutate", "table": table, "where": where, "mutations": mutations})
+        self.mutating = True
+
+    def remove(self, opts, table, record, column, *values):
+        if "--if-exists" not in opts:
+            self._check_exists(table, record)
+
+        # Keys of a map column, or values of a set column
+        self.ops.append({"op": "mutate", "table": table, "where": [["name", "==", record]],
+            "mutations": [[column, "delete", ["set", [_parse_value(x) for x in values]]]]})
+        self.mutating = True
+
+
+    __commands = {
+        "add-br"  : add_br,
+        "del-br"  : del_br,
+        "list-br" : list_br,
+        "add-port": add_port,
+        "del-port": del_port,
+        "set"     : set,
+        "remove"  : remove,
+    }
+
+    def translate(self, command):
+        opts = [x for x in command if x.startswith("--")]
+        args = [x for x in command if not x.startswith("--")]
+
+        if (not args) or (args[0] not in self.__commands) or any(x not in ("--may-exist", "--if-exists") for x in opts):
+            raise _Unsupported(command)
+
+        try:
+            self.__commands[args[0]](self, opts, *args[1:])
+        except TypeError:
+            raise _Unsupported(command)
+
+
+def _split_commands(args):
+    commands = [[]]
+    for x in args:
+        if x == "--":
+            commands.append([])
+        else:
+            commands[-1].append(x)
+    return [x for x in commands if x]
+
+
+def vsctl(*args, wait: bool = True):
+    """
+    Run ovs-vsctl style commands through the OVSDB connection.
+
+    Commands separated with "--" are sent in a single transaction. The return value
+    mimics `subprocess.run`, so that existing call sites keep working: the output of
+    `list-br` is written to stdout.
+
+    :return: A `subprocess.CompletedProcess`, or None when some command is not supported
+             by the translation layer; the caller should fall back to ovs-vsctl then.
+    """
+
+    cl = client()
+    tr = _Translator(cl)
+    try:
+        for cmd in _split_commands(args):
+            tr.translate(cmd)
+    except _Unsupported:
+        return None
+
+    ops = list(tr.ops)
+    if tr.mutating and wait:
+        # Ask ovs-vswitchd to notify when it has applied the changes
+        ops.append({"op": "mutate", "table": "Open_vSwitch", "where": [], "mutations": [["next_cfg", "+=", 1]]})
+        ops.append({"op": "select", "table": "Open_vSwitch", "where": [], "columns": ["next_cfg"]})
+
+    results = cl.transact(*ops, errors=tr.errors) if ops else []
+
+    if tr.mutating and wait:
+        cl.wait_reconfigured(results[len(ops) - 1]["rows"][0]["next_cfg"])
+
+    stdout = ""
+    for idx in tr.names:
+        stdout += "".join(f"{row['name']}\n" for row in sorted(results[idx]["rows"], key=lambda x: x["name"]))
+
+    return subprocess.CompletedProcess(["ovs-vsctl", *args], 0, stdout=stdout.encode("utf-8"), stderr=b"")
@@ -0,0 +1,201 @@
+"""
+================
+Link impairments
+================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+Delay, jitter, loss and rate limits of an interface, set with traffic
+control queueing disciplines:
+
+- delay, jitter and loss use a netem qdisc, as the root qdisc ;
+- rate limits use a tbf qdisc, as the root qdisc or under netem.
+
+Endpoints get an impairment with the "impairment" property, as an
+`Impairment` or a dict of its fields:
+
+.. code:: python
+
+    endp.properties["impairment"] = {"delay": 20, "jitter": 5, "loss": 0.5, "rate": "10mbit"}
+
+The qdiscs of all the interfaces are sent in one netlink batch per network
+namespace. Qdiscs are replaced in place when the impairment changes, and
+only removed first when the qdisc layout changes (e.g. netem to tbf).
+"""
+
+import logging
+import re
+
+from collections.abc         import Mapping
+from dataclasses             import dataclass, asdict, fields
+from typing                  import Optional, Union
+
+from pyroute2.common         import rate_suffixes
+
+from pyxnet.platform.tools   import netlink, trace
+
+__log = logging.getLogger("Impairments")
+
+
+NETEM_HANDLE = "1:"
+TBF_HANDLE   = "2:"
+TBF_PARENT   = "1:1" # Class of the netem qdisc, when both are used
+
+
+@dataclass
+class Impairment:
+    delay: float              = 0       # ms
+    jitter: float             = 0       # ms
+    loss: float               = 0       # percent
+    limit: int                = 1000    # netem queue, in packets
+
+    rate: Optional[Union[str, int]] = None # bits/s, or with a unit, e.g. "10mbit"
+    burst: int                = 32768   # tbf bucket, in bytes
+    latency: float            = 50      # tbf queue, ms
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Impairment from an endpoint property: None, an Impairment or a dict
+        """
+
+        if (value is None) or isinstance(value, Impairment):
+            return value
+        elif isinstance(value, Mapping):
+            return cls(**value)
+        raise TypeError(f"Invalid impairment: {value!r}")
+
+    @property
+    def netem(self):
+        return bool(self.delay or self.jitter or self.loss)
+
+    @property
+    def tbf(self):
+        return self.rate is not None
+
+    def layout(self):
+        """Qdiscs used by the impairment, as (netem, tbf)"""
+
+        return (self.netem, self.tbf)
+
+    def describe(self):
+        return asdict(self)
+
+    def _rate(self):
+        # pyroute2 takes plain numbers as bytes/s
+        return f"{self.rate}bit" if isinstance(self.rate, (int, float)) else self.rate
+
+    def requests(self, index: int):
+        """
+        Netlink messages setting the qdiscs of the impairment on an interface
+        """
+
+        res = list()
+        if self.netem:
+            res.append(netlink.qdisc_request("replace", "netem", index=index, handle=NETEM_HANDLE,
+                delay=int(self.delay * 1000), jitter=int(self.jitter * 1000), loss=self.loss, limit=self.limit
+            ))
+
+        if self.tbf:
+            parent = {"parent": TBF_PARENT} if self.netem else {}
+            res.append(netlink.qdisc_request("replace", "tbf", index=index, handle=TBF_HANDLE,
+                rate=self._rate(), burst=self.burst, latency=int(self.latency * 1000), **parent
+            ))
+
+        return res
+
+
+__rate_re = re.compile(r"^([0-9]+)([a-zA-Z]*)$")
+
+
+def check_impairment(value):
+    """
+    Returns the problem of an impairment property, or None
+    """
+
+    try:
+        imp = Impairment.parse(value)
+    except TypeError as exc:
+        return f"Invalid impairment {value!r}: {exc}"
+
+    for field in fields(imp):
+        x = getattr(imp, field.name)
+        if isinstance(x, (int, float)) and (x < 0):
+            return f"Negative impairment {field.name}: {x}"
+
+    if imp.loss > 100:
+        return f"Impairment loss above 100%: {imp.loss}"
+
+    if isinstance(imp.rate, str):
+        match = __rate_re.match(imp.rate)
+        if (match is None) or (match.group(2) and (match.group(2) not in rate_suffixes)):
+            return f"Invalid impairment rate {imp.rate!r}"
+
+    return None
+
+
+def layout(value):
+    imp = Impairment.parse(value)
+    return imp.layout() if imp is not None else (False, False)
+
+
+def describe(value):
+    """
+    Plain dict of an impairment property, for link descriptions. None if
+    the impairment needs no qdisc.
+    """
+
+    imp = Impairment.parse(value)
+    return imp.describe() if (imp is not None) and any(imp.layout()) else None
+
+
+##############################
+# Application
+##############################
+
+def apply(targets):
+    """
+    Set the impairments of several interfaces, in one netlink batch per
+    network namespace.
+
+    :param targets: Iterable of (ifname, netns, old impairment, new impairment)
+                    tuples. Impairments are None, Impairment objects or dicts,
+                    old is None for interfaces without impairment qdiscs.
+    """
+
+    targets = [x for x in targets if (layout(x[2]) != (False, False)) or (layout(x[3]) != (False, False))]
+    if not targets:
+        return
+
+    by_ns = dict()
+    for target in targets:
+        by_ns.setdefault(target[1], list()).append(target)
+
+    with trace.span("impairments", tool="netlink", interfaces=len(targets)):
+        for ns, ns_targets in by_ns.items():
+            with netlink.ipr(ns) as ipr:
+                indexes = netlink.link_indexes(ipr)
+                removes = list()
+                msgs    = list()
+
+                for name, _, old, new in ns_targets:
+                    index = indexes[name]
+
+                    # Qdiscs are replaced in place if the layout stays the same
+                    if layout(old) not in ((False, False), layout(new)):
+                        removes.append(netlink.qdisc_request("del", index=index))
+
+                    if new is not None:
+                        msgs.extend(Impairment.parse(new).requests(index))
+
+                __log.debug(f"{len(removes)} qdiscs to remove, {len(msgs)} to set in namespace {ns or 'host'}")
+
+                # Deletions fail if the interface only has the default qdisc
+                if removes:
+                    netlink.batch(ipr, removes)
+
+                errors = netlink.batch(ipr, msgs) if msgs else []
+                failed = [err for err in errors if err is not None]
+                if failed:
+                    raise RuntimeError(f"{len(failed)} qdisc requests failed in namespace {ns or 'host'}: {failed[0]}")
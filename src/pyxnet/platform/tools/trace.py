@@ -0,0 +1,285 @@
+"""
+==========================
+Operations instrumentation
+==========================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+While a `Tracer` is active, pyxnet records a span for each operation it
+does on the host: ovs-vsctl/ovs-dpctl calls, netlink batches, NDB sessions,
+scheduled operations... Each span knows the phase (plan, build...) and the
+topology object or link it was done for.
+
+.. code:: python
+
+    with trace.Tracer() as tracer:
+        topo.instanciate()
+
+    print(tracer.report())
+    tracer.export_chrome("instanciate.trace.json") # Open in chrome://tracing or Perfetto
+
+When no tracer is active, span() costs a context variable lookup.
+"""
+
+import json
+import os
+import threading
+import time
+
+from contextlib  import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, asdict
+from typing      import Callable, Dict, List, Optional
+
+
+##############################
+# Spans
+##############################
+
+@dataclass
+class Span:
+    name: str
+    tool: Optional[str]
+    """What did the operation: vsctl, dpctl, netlink, ndb, schedule, phase..."""
+
+    start: float
+    """time.perf_counter() value at the start of the operation, in seconds"""
+
+    duration: float             = 0.0
+    """In seconds"""
+
+    phase: Optional[str]        = None
+    obj: Optional[str]          = None
+    """Object, link or endpoint path the operation was done for"""
+
+    args: dict                  = field(default_factory=dict)
+    thread: int                 = 0
+
+
+@dataclass
+class Trace_Report:
+    """
+    Spans aggregated by phase, object and tool. Each entry gives the number
+    of spans and their total duration. Nested spans are counted in each level,
+    so the totals of a breakdown can overlap.
+    """
+
+    by_phase: Dict[str, List]   = field(default_factory=dict)
+    by_object: Dict[str, List]  = field(default_factory=dict)
+    by_tool: Dict[str, List]    = field(default_factory=dict)
+    wall_time: float            = 0.0
+    spans: List[Span]           = field(default_factory=list)
+
+    def slowest_objects(self, n: int = 10):
+        """
+        Returns the n objects which operations took the longest time,
+        as (path, count, total duration) tuples
+        """
+
+        return [(k, *v) for k, v in sorted(self.by_object.items(), key=lambda x: x[1][1], reverse=True)[:n]]
+
+    def slowest(self, n: int = 10):
+        """
+        Returns the n longest spans
+        """
+
+        return sorted(self.spans, key=lambda x: x.duration, reverse=True)[:n]
+
+    def __str__(self):
+        lines = [f"Wall time: {self.wall_time:.3f}s"]
+
+        for title, entries in (("phase", self.by_phase), ("tool", self.by_tool)):
+            lines.append(f"By {title}:")
+            for key, (count, total) in sorted(entries.items(), key=lambda x: x[1][1], reverse=True):
+                lines.append(f"  {str(key):<32} {count:>6} {total:>9.3f}s")
+
+        lines.append("Slowest objects:")
+        for key, count, total in self.slowest_objects(10):
+            lines.append(f"  {str(key):<32} {count:>6} {total:>9.3f}s")
+
+        return "\n".join(lines)
+
+
+##############################
+# Tracer
+##############################
+
+class Tracer:
+    """
+    Records the spans of the operations done while it is active.
+
+    :param callback: Called with each span once it is finished, for
+                     instance to forward spans to another tracing system.
+    """
+
+    def __init__(self, callback: Callable = None):
+        self.spans    = list()
+        self.callback = callback
+
+        self._lock    = threading.Lock()
+        self._tokens  = []
+        self._start   = None
+        self._end     = None
+
+    def __enter__(self):
+        if not self._tokens:
+            self._start = time.perf_counter()
+        self._tokens.append(_current_tracer.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_tracer.reset(self._tokens.pop())
+        if not self._tokens:
+            self._end = time.perf_counter()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+        if self.callback is not None:
+            self.callback(span)
+
+    def clear(self):
+        with self._lock:
+            self.spans = list()
+
+
+    # ---------------- Reports
+
+    def report(self):
+        res = Trace_Report(spans=list(self.spans))
+
+        for span in res.spans:
+            for key, entries in ((span.phase, res.by_phase), (span.obj, res.by_object), (span.tool, res.by_tool)):
+                # Phase spans are not counted in their own phase
+                if (key is None) or ((entries is res.by_phase) and (span.tool == "phase")):
+                    continue
+                entry     = entries.setdefault(key, [0, 0.0])
+                entry[0] += 1
+                entry[1] += span.duration
+
+        if self._start is not None:
+            res.wall_time = (self._end if self._end is not None else time.perf_counter()) - self._start
+
+        return res
+
+
+    # ---------------- Export
+
+    def export_json(self, path):
+        """
+        Write all the spans to a JSON file, as a list of dicts
+        """
+
+        with open(path, "w") as fhandle:
+            json.dump([asdict(x) for x in self.spans], fhandle, indent=1, default=str)
+
+    def export_chrome(self, path):
+        """
+        Write the spans in the Chrome trace event format, which can be opened
+        in chrome://tracing or https://ui.perfetto.dev
+        """
+
+        origin = self._start if self._start is not None else min((x.start for x in self.spans), default=0.0)
+        pid    = os.getpid()
+        events = list()
+
+        for span in self.spans:
+            # Transactions of big topologies have huge argument lists
+            args = {key: _shorten(str(value)) for key, value in span.args.items()}
+            if span.phase is not None:
+                args["phase"] = span.phase
+            if span.obj is not None:
+                args["object"] = span.obj
+
+            events.append({
+                "name": span.name,
+                "cat" : span.tool or "pyxnet",
+                "ph"  : "X",
+                "ts"  : (span.start - origin) * 1e6,
+                "dur" : span.duration * 1e6,
+                "pid" : pid,
+                "tid" : span.thread,
+                "args": args,
+            })
+
+        with open(path, "w") as fhandle:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fhandle)
+
+
+def _shorten(text: str, size: int = 1000):
+    return text if len(text) <= size else f"{text[:size]}... ({len(text)} chars)"
+
+
+##############################
+# Instrumentation API
+##############################
+
+_current_tracer = ContextVar("tracer", default=None)
+_current_phase  = ContextVar("tracer_phase", default=None)
+_current_obj    = ContextVar("tracer_object", default=None)
+
+
+def current():
+    """
+    Returns the active tracer, or None
+    """
+
+    return _current_tracer.get()
+
+
+@contextmanager
+def span(name: str, tool: str = None, obj: str = None, **args):
+    """
+    Record the duration of the block, if a tracer is active.
+
+    :param name: Name of the operation
+    :param tool: What does the operation (vsctl, netlink...)
+    :param obj: Path of the object the operation is done for. Spans inside
+                the block get it too. Defaults to the one of the enclosing span.
+    :param args: Additional data, e.g. command arguments
+    """
+
+    tracer = _current_tracer.get()
+    if tracer is None:
+        yield None
+        return
+
+    token = _current_obj.set(obj) if obj is not None else None
+    res   = Span(
+        name   = name,
+        tool   = tool,
+        start  = time.perf_counter(),
+        phase  = _current_phase.get(),
+        obj    = _current_obj.get(),
+        args   = args,
+        thread = threading.get_ident(),
+    )
+
+    try:
+        yield res
+    finally:
+        res.duration = time.perf_counter() - res.start
+        if token is not None:
+            _current_obj.reset(token)
+        tracer.add(res)
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Name the phase of the operations done in the block (plan, build...).
+    The phase itself is recorded as a span.
+    """
+
+    if _current_tracer.get() is None:
+        yield
+        return
+
+    token = _current_phase.set(name)
+    try:
+        with span(name, tool="phase"):
+            yield
+    finally:
+        _current_phase.reset(token)
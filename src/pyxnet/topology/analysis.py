@@ -0,0 +1,324 @@
+"""
+=======================
+Topology graph analysis
+=======================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+Queries on the graph of a declared topology: objects are the vertices,
+connections are the edges. Nothing is done on the host.
+
+The connections of each object are indexed by the topology as connect()
+and disconnect() are called (see Topology.links_of). Components, loops and
+articulation links are computed once per version of the topology, and
+kept until it changes.
+
+.. code:: python
+
+    analysis.loops(topo)                     # Objects forming L2 loops, that need STP
+    analysis.shortest_path(topo, s1.p0, s4)  # Connections from s1 to s4
+    analysis.split_by(topo, [topo.connection_of(s1.p0)])
+
+All searches are iterative, so that they work on topologies of any depth.
+"""
+
+from collections import deque
+from typing      import Iterable, List, Optional, Set
+
+from pyxnet.topology.endpoint import Endpoint, Endpoint_Connection
+
+
+##############################
+# Helpers
+##############################
+
+def _name(item):
+    """Object name of an object, endpoint or name"""
+
+    if isinstance(item, str):
+        return item
+    elif isinstance(item, Endpoint):
+        return item.parent.name
+    return item.name
+
+
+def _other(conn: Endpoint_Connection, name: str):
+    return conn.b.parent.name if conn.a.parent.name == name else conn.a.parent.name
+
+
+def _cached(topology, key: str, compute):
+    # Results are kept until the next change of the topology
+    version, cache = topology._analysis
+    if version != topology._version:
+        cache = dict()
+        topology._analysis = (topology._version, cache)
+
+    if key not in cache:
+        cache[key] = compute(topology)
+    return cache[key]
+
+
+##############################
+# Paths and reachability
+##############################
+
+def neighbours(topology, obj) -> Set[str]:
+    """
+    Names of the objects connected to an object
+    """
+
+    name = _name(obj)
+    return {_other(conn, name) for conn in topology._adjacency.get(name, ())} - {name}
+
+
+def reachable(topology, obj, without: Iterable[Endpoint_Connection] = ()) -> Set[str]:
+    """
+    Names of the objects that can be reached from an object, itself included
+
+    :param without: Connections to ignore, e.g. to simulate link failures
+    """
+
+    without = set(without)
+    start   = _name(obj)
+    seen    = {start}
+    queue   = deque([start])
+
+    while queue:
+        name = queue.popleft()
+        for conn in topology._adjacency.get(name, ()):
+            other = _other(conn, name)
+            if (other not in seen) and (conn not in without):
+                seen.add(other)
+                queue.append(other)
+
+    return seen
+
+
+def shortest_path(topology, a, b, without: Iterable[Endpoint_Connection] = ()) -> Optional[List[Endpoint_Connection]]:
+    """
+    Shortest path between two objects or endpoints, in number of links
+
+    :param a: Start object, endpoint or object name
+    :param b: End object, endpoint or object name
+    :param without: Connections to ignore
+    :return: Connections of the path from a to b, empty if a and b are the
+             same object, None if b can't be reached
+    """
+
+    without = set(without)
+    start   = _name(a)
+    end     = _name(b)
+    via     = {start: None} # Connection used to reach each object
+    queue   = deque([start])
+
+    while queue and (end not in via):
+        name = queue.popleft()
+        for conn in topology._adjacency.get(name, ()):
+            other = _other(conn, name)
+            if (other not in via) and (conn not in without):
+                via[other] = conn
+                queue.append(other)
+
+    if end not in via:
+        return None
+
+    path = list()
+    name = end
+    while via[name] is not None:
+        path.append(via[name])
+        name = _other(via[name], name)
+
+    path.reverse()
+    return path
+
+
+##############################
+# Components
+##############################
+
+def _components(topology):
+    seen = set()
+    res  = list()
+
+    for name in topology.objects:
+        if name not in seen:
+            comp = reachable(topology, name)
+            seen.update(comp)
+            res.append(frozenset(comp))
+
+    return tuple(res)
+
+
+def components(topology):
+    """
+    Connected components of the topology, as sets of object names, in
+    the registration order of their first object
+    """
+
+    return _cached(topology, "components", _components)
+
+
+def component_of(topology, obj):
+    """
+    Connected component of an object
+    """
+
+    index = _cached(topology, "component_index", lambda t: {name: comp for comp in components(t) for name in comp})
+    return index[_name(obj)]
+
+
+##############################
+# Articulation links and loops
+##############################
+
+def _articulations(topology):
+    # Iterative Tarjan: an edge is a bridge if the subtree below it has no
+    # other edge back to it, an object is an articulation point if one of
+    # its subtrees has none. Only the tree edge to the parent is skipped,
+    # so that parallel links between two objects count as a loop.
+    adjacency = topology._adjacency
+    index     = dict()
+    low       = dict()
+    bridges   = set()
+    points    = set()
+
+    for root in topology.objects:
+        if root in index:
+            continue
+
+        index[root] = low[root] = len(index)
+        children    = 0
+        stack       = [(root, None, iter(adjacency.get(root, ())))]
+
+        while stack:
+            name, via, conns = stack[-1]
+
+            for conn in conns:
+                if conn is via:
+                    continue
+
+                other = _other(conn, name)
+                if other not in index:
+                    index[other] = low[other] = len(index)
+                    stack.append((other, conn, iter(adjacency.get(other, ()))))
+                    break
+                low[name] = min(low[name], index[other])
+
+            else:
+                stack.pop()
+                if not stack:
+                    continue
+
+                parent      = stack[-1][0]
+                low[parent] = min(low[parent], low[name])
+
+                if low[name] > index[parent]:
+                    bridges.add(via)
+
+                if parent == root:
+                    children += 1
+                elif low[name] >= index[parent]:
+                    points.add(parent)
+
+        if children > 1:
+            points.add(root)
+
+    return frozenset(bridges), frozenset(points)
+
+
+def articulation_links(topology) -> Set[Endpoint_Connection]:
+    """
+    Connections whose failure splits their component in two
+    """
+
+    return _cached(topology, "articulations", _articulations)[0]
+
+
+def articulation_objects(topology) -> Set[str]:
+    """
+    Names of the objects whose failure splits their component
+    """
+
+    return _cached(topology, "articulations", _articulations)[1]
+
+
+def _loops(topology):
+    # Links that are not articulation links are part of a cycle: the loops
+    # are the components of the graph of these links.
+    bridges = articulation_links(topology)
+    seen    = set()
+    res     = list()
+
+    for name in topology.objects:
+        if name in seen:
+            continue
+
+        loop  = {name}
+        queue = deque([name])
+        cycle = False
+
+        while queue:
+            current = queue.popleft()
+            for conn in topology._adjacency.get(current, ()):
+                if conn in bridges:
+                    continue
+
+                cycle = True
+                other = _other(conn, current)
+                if other not in loop:
+                    loop.add(other)
+                    queue.append(other)
+
+        seen.update(loop)
+        if cycle:
+            res.append(frozenset(loop))
+
+    return tuple(res)
+
+
+def loops(topology):
+    """
+    Groups of objects forming L2 loops, as sets of object names. Each
+    group needs STP/RSTP on its switches to avoid broadcast storms.
+    """
+
+    return _cached(topology, "loops", _loops)
+
+
+def has_loop(topology) -> bool:
+    """
+    Tells if the topology has at least one loop
+    """
+
+    # A forest has exactly one link less than objects per component
+    return len(topology.links) > len(topology.objects) - len(components(topology))
+
+
+def split_by(topology, failed: Iterable[Endpoint_Connection]):
+    """
+    What a failure of some links disconnects
+
+    :param failed: Failing connections
+    :return: For each component split by the failure, the list of the
+             resulting parts, as sets of object names
+    """
+
+    failed = set(failed)
+    if (len(failed) == 1) and not (failed & articulation_links(topology)):
+        return []
+
+    res = list()
+    for comp in {component_of(topology, conn.a.parent.name) for conn in failed}:
+        parts = list()
+        seen  = set()
+        for name in comp:
+            if name not in seen:
+                part = reachable(topology, name, without=failed)
+                seen.update(part)
+                parts.append(part)
+
+        if len(parts) > 1:
+            res.append(parts)
+
+    return res
@@ -0,0 +1,36 @@
+"""
+============
+Direct edits
+============
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+Topologies keep their plan until they change. Their methods increment the
+topology version, but object attributes and endpoint properties can also
+be changed directly. These changes increment a process wide counter, so
+that Topology.plan() only hashes the topology contents when something may
+have changed.
+
+Changes inside values, e.g. of a dict set as an endpoint property, are not
+counted: call Topology.invalidate() after them.
+"""
+
+__count = 0
+
+
+def touch():
+    """
+    Count a direct change of an object or endpoint
+    """
+
+    global __count
+    __count += 1
+
+
+def count() -> int:
+    """
+    Number of direct changes so far
+    """
+
+    return __count
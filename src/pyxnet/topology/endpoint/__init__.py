@@ -15,10 +15,9 @@ from abc         import ABC, abstractmethod
 
 from enum        import Enum, auto
 
-from pyroute2 import NDB
-
 from pyxnet.platform.link    import (Link_Phy, Link_VEth, Link_Pipe)
-from pyxnet.platform.tools   import ifp, sth
+from pyxnet.platform.tools   import netlink, names, to_thread
+from pyxnet.topology         import edits
 
 
 ############################
@@ -36,23 +35,101 @@ class Endpoint_Kind(Enum):
     """Describes an endpoint in the real world"""
 
 
+############################
+# Endpoint properties
+############################
+
+class Endpoint_Properties(dict):
+    """
+    Auxiliary properties of an endpoint. Changes are counted, see
+    pyxnet.topology.edits.
+    """
+
+    __slots__ = ()
+
+    def __setitem__(self, key, value):
+        edits.touch()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        edits.touch()
+        super().__delitem__(key)
+
+    def __ior__(self, other):
+        edits.touch()
+        return super().__ior__(other)
+
+    def update(self, *args, **kwargs):
+        edits.touch()
+        super().update(*args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        edits.touch()
+        return super().setdefault(key, default)
+
+    def pop(self, *args):
+        edits.touch()
+        return super().pop(*args)
+
+    def popitem(self):
+        edits.touch()
+        return super().popitem()
+
+    def clear(self):
+        edits.touch()
+        super().clear()
+
+
 ############################
 # Endpoint base class
 ############################
 
 class Endpoint:
+    # Big topologies have a lot of endpoints: no instance dict, and the
+    # logger and properties dict are only created when used.
+    __slots__ = ("name", "kind", "parent", "_ifname", "_netns", "_properties", "_log", "_path", "_hash")
+
     def __init__(self, name: str, kind: Endpoint_Kind, parent: "PyxNetObject"):
-        self.log        = logging.getLogger(f"Endpoint {name}")
-        self.name       = name
-        self.kind       = kind
-        self.parent     = parent
+        self.name        = name
+        self.kind        = kind
+        self.parent      = parent
+
+        self._ifname     = None # Attached interface name from Endpoint_Connection
+        self._netns      = None # Network namespace of the interface, None for the current one
+        self._properties = None # Auxiliary properties
+        self._log        = None
 
-        self._ifname    = None   # Attached interface name from Endpoint_Connection
-        self.properties = dict() # Auxiliary properties
+        # Endpoints are hashed on each set or dict operation. The path
+        # string is only kept once it is asked for.
+        self._path       = None
+        self._hash       = hash((parent.name, name))
 
     @property
     def path(self):
-        return f"{self.parent.name}/{self.name}"
+        if self._path is None:
+            self._path = f"{self.parent.name}/{self.name}"
+        return self._path
+
+    @property
+    def log(self):
+        if self._log is None:
+            self._log = logging.getLogger(f"Endpoint {self.name}")
+        return self._log
+
+    @property
+    def properties(self):
+        if self._properties is None:
+            self._properties = Endpoint_Properties()
+        return self._properties
+
+    def get_property(self, key: str, default=None):
+        """
+        Same as properties.get(), without creating the properties dict
+        """
+
+        if self._properties is None:
+            return default
+        return self._properties.get(key, default)
     
 
     @property
@@ -61,13 +138,31 @@ class Endpoint:
             raise RuntimeError(f"endpoint {self} has no associated interface")
         return self._ifname
 
+    @property
+    def netns(self):
+        return self._netns
+
+    @property
+    def movable(self):
+        """
+        Tells if the interface of the endpoint can be put in another network
+        namespace. Interfaces attached to openvswitch or physical interfaces
+        must stay in the namespace of the host.
+        """
+
+        return (self.kind == Endpoint_Kind.Virtual) and self.parent.netns_movable
+
 
     def __hash__(self) -> int:
-        return str.__hash__(self.path)
+        return self._hash
 
 
     def __eq__(self, other):
-        return self.path == other.path
+        if self is other:
+            return True
+        elif not isinstance(other, Endpoint):
+            return NotImplemented
+        return (self._hash == other._hash) and (self.name == other.name) and (self.parent.name == other.parent.name)
 
 
     def __str__(self):
@@ -83,8 +178,7 @@ class Endpoint:
         self.log.info("Up endpoint")
 
         if self.kind != Endpoint_Kind.Real:
-            with NDB() as ndb:
-                ndb.interfaces[self.ifname].set("state", "up").commit()
+            self._set_state("up")
         else:
             self.log.warn("Real endpoint, assuming correct action on target")
 
@@ -93,45 +187,84 @@ class Endpoint:
         self.log.info("Down endpoint")
 
         if self.kind != Endpoint_Kind.Real:
-            with NDB() as ndb:
-                ndb.interfaces[self.ifname].set("state", "down").commit()
+            self._set_state("down")
         else:
             self.log.warn("Real endpoint, assuming correct action on target")
 
 
+    def _set_state(self, state):
+        with netlink.ipr(self._netns) as ipr:
+            ipr.link("set", index=ipr.link_lookup(ifname=self.ifname)[0], state=state)
+
+
+    async def up_async(self):
+        return await to_thread(self.up)
+
+
+    async def down_async(self):
+        return await to_thread(self.down)
+
+
 ############################
 # Endpoint connection tuple
 ############################
 
-@dataclass
 class Endpoint_Connection:
-    a: Endpoint
-    b: Endpoint
+    __slots__ = ("a", "b", "link_obj", "_log", "_hash")
 
-    def __post_init__(self):
-        self.log       = logging.getLogger(f"{self.a.path} <-> {self.b.path}")
+    def __init__(self, a: Endpoint, b: Endpoint):
+        self.a         = a
+        self.b         = b
+
+        self._log      = None
+        self._hash     = hash((a._hash, b._hash))
         self.link_obj  = None # Instanciated link object
 
     def __hash__(self) -> int:
-        return str.__hash__(f"{self.a.path}|{self.b.path}")
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        elif not isinstance(other, Endpoint_Connection):
+            return NotImplemented
+        return (self.a == other.a) and (self.b == other.b)
+
+    def __repr__(self):
+        return f"Endpoint_Connection(a={self.a!r}, b={self.b!r})"
+
+    @property
+    def log(self):
+        # Loggers are created on first use, as big topologies have a lot of connections
+        if self._log is None:
+            self._log = logging.getLogger(f"{self.a.path} <-> {self.b.path}")
+        return self._log
 
 
     # --------- Instanciation and interface names
 
-    def _instanciate_veth(self):
-        self.a._ifname = ifp(f"{sth(self.a.parent.name)}-{sth(self.a.name)}")
-        self.b._ifname = ifp(f"{sth(self.b.parent.name)}-{sth(self.b.name)}")
+    def _instanciate_veth(self, netns, allocator):
+        self.a._ifname = allocator.allocate(self.a.path, hint=f"{self.a.parent.name}-{self.a.name}")
+        self.b._ifname = allocator.allocate(self.b.path, hint=f"{self.b.parent.name}-{self.b.name}")
+
+        # Network namespace from the endpoint properties, or the topology one
+        for endp in (self.a, self.b):
+            endp._netns = (endp.get_property("netns") or netns) if endp.movable else None
 
         # Look for MAC and IP address
-        a_mac = self.a.properties.get("mac_addr", None)
-        a_ip  = self.a.properties.get("ip_addr" , None)
-        b_mac = self.b.properties.get("mac_addr", None)
-        b_ip  = self.b.properties.get("ip_addr" , None)
+        a_mac = self.a.get_property("mac_addr")
+        a_ip  = self.a.get_property("ip_addr" )
+        b_mac = self.b.get_property("mac_addr")
+        b_ip  = self.b.get_property("ip_addr" )
 
         self.link_obj  = Link_VEth(
             self.a.ifname, self.b.ifname,
-            p0_mac = a_mac, p1_mac = b_mac,
-            p0_ip  = a_ip , p1_ip  = b_ip
+            p0_mac   = a_mac       , p1_mac   = b_mac       ,
+            p0_ip    = a_ip        , p1_ip    = b_ip        ,
+            p0_netns = self.a.netns, p1_netns = self.b.netns,
+
+            p0_impairment = self.a.get_property("impairment"),
+            p1_impairment = self.b.get_property("impairment"),
         )
 
     def _instanciate_phy(self, ep_phy, ep_virtual):
@@ -139,20 +272,33 @@ class Endpoint_Connection:
         ep_phy._ifname     = ep_phy.name
 
         # Take properties from virtual endpoint
-        phy_mac            = ep_virtual.properties.get("mac_addr", None)
-        phy_ip             = ep_virtual.properties.get("ip_addr" , None)
+        phy_mac            = ep_virtual.get_property("mac_addr")
+        phy_ip             = ep_virtual.get_property("ip_addr" )
+        phy_impairment     = ep_virtual.get_property("impairment")
 
-        self.link_obj      = Link_Phy(ep_phy.name, mac_addr=phy_mac, ip_addr=phy_ip)
+        self.link_obj      = Link_Phy(ep_phy.name, mac_addr=phy_mac, ip_addr=phy_ip, impairment=phy_impairment)
 
-    def _instanciate_pipe(self):
+    def _instanciate_pipe(self, allocator):
         self.a._ifname = self.a.name
         self.b._ifname = self.b.name
-        pipe_name = ifp(f"{sth(self.a.name)}-{sth(self.b.name)}")
+        pipe_name = allocator.allocate(f"{self.a.path}|{self.b.path}", hint=f"{self.a.name}-{self.b.name}")
         self.link_obj = Link_Pipe(pipe_name, self.a.ifname, self.b.ifname)
 
 
-    def instanciate(self):
-        self.log.info(f"Instanciate connection: {self.a.path} <-> {self.b.path}")
+    def resolve(self, netns: str = None, allocator: "names.Name_Allocator" = None):
+        """
+        Choose the link type for this connection and assign interface names
+        to the endpoints, without touching the platform. The link object is
+        available in link_obj afterwards (None if there is nothing to do).
+
+        :param netns: Network namespace of the movable endpoints which
+                      have no "netns" property.
+        :param allocator: Interface names allocator, the default one if not given
+        """
+
+        self.link_obj = None
+        if allocator is None:
+            allocator = names.default()
 
         # Let's go to the if clause of death!!!!!!!!!!!!!!!!!!
         if   self.a.kind == Endpoint_Kind.Real:
@@ -166,7 +312,7 @@ class Endpoint_Connection:
             if   self.b.kind == Endpoint_Kind.Real:
                 raise RuntimeError("Cannot connect a virtual endpoint to a real one; There must be a Phy interface in-between.")
             elif self.b.kind == Endpoint_Kind.Virtual:
-                self._instanciate_veth()
+                self._instanciate_veth(netns, allocator)
             elif self.b.kind == Endpoint_Kind.Phy:
                 self._instanciate_phy(self.b, self.a)
         elif self.a.kind == Endpoint_Kind.Phy:
@@ -175,16 +321,39 @@ class Endpoint_Connection:
             elif self.b.kind == Endpoint_Kind.Virtual:
                 self._instanciate_phy(self.a, self.b)
             elif self.b.kind == Endpoint_Kind.Phy:
-                self._instanciate_pipe()
+                self._instanciate_pipe(allocator)
 
+        return self.link_obj
+
+
+    def instanciate(self):
+        self.log.info(f"Instanciate connection: {self.a.path} <-> {self.b.path}")
+
+        self.resolve()
         if self.link_obj is not None:
             self.link_obj.instanciate()
         else:
             self.log.info("No virtual link instanciated")
+
+
+    async def instanciate_async(self):
+        self.log.info(f"Instanciate connection: {self.a.path} <-> {self.b.path}")
+
+        self.resolve()
+        if self.link_obj is not None:
+            await self.link_obj.instanciate_async()
+        else:
+            self.log.info("No virtual link instanciated")
             
 
     
     def remove(self):
         if self.link_obj is not None:
             self.link_obj.remove()
-            self.link_obj = None # Go garbage collector... go!
\ No newline at end of file
+            self.link_obj = None # Go garbage collector... go!
+
+
+    async def remove_async(self):
+        if self.link_obj is not None:
+            await self.link_obj.remove_async()
+            self.link_obj = None
\ No newline at end of file
@@ -0,0 +1,370 @@
+"""
+==============================
+Machine-readable export/import
+==============================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+Topologies can be exported for analysis tools as JSON, GraphML or a
+networkx graph, with their objects, endpoints (kind and properties),
+groups and links.
+
+The JSON export is a description as read by pyxnet.topology.loader, so
+that it is imported back with loader.load(). The GraphML and networkx
+imports are converted to the same description.
+
+JSON and GraphML are written as they are generated: iter_json() and
+iter_graphml() yield the document in chunks, and write_json() and
+write_graphml() write them to a file, without building the document in
+memory.
+
+.. code:: python
+
+    with open("ring.graphml", "w") as fhandle:
+        export.write_graphml(topo, fhandle)
+
+    same = export.load_graphml("ring.graphml")
+
+Objects are rebuilt by calling their class with the name and the
+parameters given by export_params() that the constructor accepts.
+Objects of classes defined in __main__ can't be imported back.
+"""
+
+import functools
+import inspect
+import json
+
+from dataclasses                     import asdict, is_dataclass
+from enum                            import Enum
+from xml.etree                       import ElementTree
+from xml.sax.saxutils                import escape, quoteattr
+
+from pyxnet.topology                 import loader
+
+
+##############################
+# Description
+##############################
+
+def _type_name(cls):
+    for name, registered in loader.object_types.items():
+        if registered is cls:
+            return name
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+@functools.lru_cache(maxsize=None)
+def _init_params(cls):
+    # None if the constructor takes any keyword argument
+    params = inspect.signature(cls.__init__).parameters
+    if any(p.kind == inspect.Parameter.VAR_KEYWORD for p in params.values()):
+        return None
+    return frozenset(list(params)[2:]) # Without self and name
+
+
+def _json_default(value):
+    if isinstance(value, Enum):
+        return value.value
+    elif is_dataclass(value):
+        return asdict(value)
+    elif isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _params_of(obj):
+    accepted = _init_params(type(obj))
+    return {
+        key: value for key, value in obj.export_params().items()
+        if (value is not None) and ((accepted is None) or (key in accepted))
+    }
+
+
+def _endpoint_spec(endp):
+    spec = {"name": endp.name, "kind": endp.kind.value}
+    if endp._properties:
+        spec["properties"] = dict(endp._properties)
+    return spec
+
+
+def object_spec(obj, group: str = None):
+    """
+    Description of an object, as read by loader.from_dict
+    """
+
+    spec = {"name": obj.name, "type": _type_name(type(obj))}
+    if group is not None:
+        spec["group"] = group
+
+    params = _params_of(obj)
+    if params:
+        spec["params"] = params
+
+    spec["endpoints"] = [_endpoint_spec(endp) for endp in sorted(obj.endpoints, key=lambda e: e.name)]
+    return spec
+
+
+def object_specs(topology):
+    """
+    Generator of the descriptions of the topology objects, by group
+    """
+
+    for group, items in topology.groups.items():
+        for name in items:
+            yield object_spec(topology.objects[name], group)
+
+
+def link_specs(topology):
+    """
+    Generator of the links of the topology, as [a path, b path] pairs
+    """
+
+    for conn in topology.links:
+        yield [conn.a.path, conn.b.path]
+
+
+def to_dict(topology):
+    """
+    Description of the whole topology, see loader.from_dict
+    """
+
+    return {
+        "name"   : topology.name,
+        "objects": list(object_specs(topology)),
+        "links"  : list(link_specs(topology)),
+    }
+
+
+##############################
+# JSON
+##############################
+
+def iter_json(topology):
+    """
+    Generator of the JSON description of the topology, one object or
+    link per line
+    """
+
+    dumps = functools.partial(json.dumps, default=_json_default)
+
+    yield f'{{"name": {dumps(topology.name)},\n"objects": ['
+    for i, spec in enumerate(object_specs(topology)):
+        yield ("\n" if i == 0 else ",\n") + dumps(spec)
+
+    yield '],\n"links": ['
+    for i, spec in enumerate(link_specs(topology)):
+        yield ("\n" if i == 0 else ",\n") + dumps(spec)
+
+    yield "]}\n"
+
+
+def write_json(topology, out):
+    """
+    Write the JSON description of the topology to a file object
+    """
+
+    for chunk in iter_json(topology):
+        out.write(chunk)
+
+
+def load_json(path, topology=None):
+    """
+    Build a topology from a JSON export, see loader.load
+    """
+
+    return loader.load(path, topology=topology, format="json")
+
+
+##############################
+# GraphML
+##############################
+
+# Objects are GraphML nodes, their endpoints are ports of the nodes, and
+# links are edges between ports.
+
+_GRAPHML_KEYS = (
+    ("type",       "node", "type"),
+    ("group",      "node", "group"),
+    ("params",     "node", "params"),     # JSON
+    ("kind",       "port", "kind"),
+    ("properties", "port", "properties"), # JSON
+)
+
+_GRAPHML_NS = "http://graphml.graphdrawing.org/xmlns"
+
+
+def _data(key, value):
+    return f'<data key="{key}">{escape(value)}</data>'
+
+
+def iter_graphml(topology):
+    """
+    Generator of the GraphML document of the topology
+    """
+
+    dumps = functools.partial(json.dumps, default=_json_default)
+
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield f'<graphml xmlns="{_GRAPHML_NS}">\n'
+    for key, domain, name in _GRAPHML_KEYS:
+        yield f'  <key id="{key}" for="{domain}" attr.name="{name}" attr.type="string"/>\n'
+
+    yield f'  <graph id={quoteattr(topology.name)} edgedefault="undirected">\n'
+
+    for spec in object_specs(topology):
+        data = [_data("type", spec["type"])]
+        if "group" in spec:
+            data.append(_data("group", spec["group"]))
+        if "params" in spec:
+            data.append(_data("params", dumps(spec["params"])))
+
+        yield f'    <node id={quoteattr(spec["name"])}>{"".join(data)}\n'
+        for ep_spec in spec["endpoints"]:
+            props = _data("properties", dumps(ep_spec["properties"])) if "properties" in ep_spec else ""
+            yield f'      <port name={quoteattr(ep_spec["name"])}>{_data("kind", ep_spec["kind"])}{props}</port>\n'
+        yield '    </node>\n'
+
+    for conn in topology.links:
+        yield (
+            f'    <edge source={quoteattr(conn.a.parent.name)} sourceport={quoteattr(conn.a.name)}'
+            f' target={quoteattr(conn.b.parent.name)} targetport={quoteattr(conn.b.name)}/>\n'
+        )
+
+    yield '  </graph>\n'
+    yield '</graphml>\n'
+
+
+def write_graphml(topology, out):
+    """
+    Write the GraphML document of the topology to a file object
+    """
+
+    for chunk in iter_graphml(topology):
+        out.write(chunk)
+
+
+def _graphml_data(elem, ns):
+    return {data.get("key"): (data.text or "") for data in elem.findall(f"{ns}data")}
+
+
+def graphml_description(source):
+    """
+    Read a GraphML export back as a description, see loader.from_dict.
+    Nodes are released as they are read.
+
+    :param source: Path or file object
+    """
+
+    ns      = f"{{{_GRAPHML_NS}}}"
+    desc    = {"objects": list(), "links": list()}
+
+    for event, elem in ElementTree.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if elem.tag == f"{ns}graph":
+                desc["name"] = elem.get("id")
+            continue
+
+        if elem.tag == f"{ns}node":
+            data = _graphml_data(elem, ns)
+            spec = {"name": elem.get("id"), "type": data["type"], "endpoints": list()}
+            if "group" in data:
+                spec["group"] = data["group"]
+            if "params" in data:
+                spec["params"] = json.loads(data["params"])
+
+            for port in elem.findall(f"{ns}port"):
+                port_data = _graphml_data(port, ns)
+                ep_spec   = {"name": port.get("name"), "kind": port_data.get("kind", "virtual")}
+                if "properties" in port_data:
+                    ep_spec["properties"] = json.loads(port_data["properties"])
+                spec["endpoints"].append(ep_spec)
+
+            desc["objects"].append(spec)
+            elem.clear()
+
+        elif elem.tag == f"{ns}edge":
+            desc["links"].append([
+                f"{elem.get('source')}/{elem.get('sourceport')}",
+                f"{elem.get('target')}/{elem.get('targetport')}",
+            ])
+            elem.clear()
+
+    return desc
+
+
+def load_graphml(source, topology=None):
+    """
+    Build a topology from a GraphML export
+
+    :param source: Path or file object
+    :param topology: Existing topology to add the objects to
+    """
+
+    return loader.from_dict(graphml_description(source), topology=topology)
+
+
+##############################
+# networkx
+##############################
+
+def _networkx():
+    try:
+        import networkx
+    except ImportError:
+        raise RuntimeError("networkx is needed to export topologies as networkx graphs")
+
+    return networkx
+
+
+def to_networkx(topology):
+    """
+    Export the topology as a networkx.MultiGraph: objects are nodes, with
+    type, group, params and endpoints (by name) attributes. Each link is an
+    edge, with the a and b endpoint paths as attributes, as two objects can
+    have several links between them.
+    """
+
+    nx    = _networkx()
+    graph = nx.MultiGraph(name=topology.name)
+
+    for spec in object_specs(topology):
+        endpoints = {ep_spec.pop("name"): ep_spec for ep_spec in spec.pop("endpoints")}
+        graph.add_node(spec.pop("name"), endpoints=endpoints, **spec)
+
+    graph.add_edges_from(
+        (conn.a.parent.name, conn.b.parent.name, {"a": conn.a.path, "b": conn.b.path})
+        for conn in topology.links
+    )
+
+    return graph
+
+
+def networkx_description(graph):
+    """
+    Description of a networkx graph exported with to_networkx(), see
+    loader.from_dict
+    """
+
+    objects = list()
+    for name, attrs in graph.nodes(data=True):
+        spec = {"name": name, "type": attrs["type"]}
+        if attrs.get("group", None) is not None:
+            spec["group"] = attrs["group"]
+        if attrs.get("params"):
+            spec["params"] = attrs["params"]
+
+        spec["endpoints"] = [dict(ep_spec, name=ep_name) for ep_name, ep_spec in attrs.get("endpoints", dict()).items()]
+        objects.append(spec)
+
+    links = [[attrs["a"], attrs["b"]] for _, _, attrs in graph.edges(data=True)]
+
+    return {"name": graph.graph.get("name", "topology"), "objects": objects, "links": links}
+
+
+def from_networkx(graph, topology=None):
+    """
+    Build a topology from a networkx graph exported with to_networkx()
+    """
+
+    return loader.from_dict(networkx_description(graph), topology=topology)
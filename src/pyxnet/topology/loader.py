@@ -0,0 +1,206 @@
+"""
+=================================
+Declarative topology descriptions
+=================================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+Topologies can be described in YAML, JSON or TOML files instead of Python
+code. The description is a dict with the following keys:
+
+.. code:: yaml
+
+    name: ring
+    objects:
+      - name: s0
+        type: switch                  # Registered type name, or "module.Class"
+        group: group1
+        params: {mac_addr: "02:01:02:00:00:01"}
+        endpoints:                    # Endpoints to register on the object
+          - p0
+          - {name: p1, kind: virtual, properties: {ip_addr: 10.0.0.1/24}}
+
+      - name: eth0
+        type: phy
+
+    links:
+      - [s0/p0, s1/p1]
+      - {a: s0/p1, b: eth0/eth0}
+
+Objects and links are added with register_many()/connect_many(), so that
+the whole description is checked at once.
+
+YAML needs PyYAML, TOML needs tomllib (python 3.11) or tomli.
+"""
+
+import importlib
+import json
+
+from pathlib                         import Path
+
+from pyxnet.topology.endpoint        import Endpoint_Kind
+from pyxnet.topology.objects.switch  import Switch
+from pyxnet.topology.objects.phy     import Phy
+
+
+##############################
+# Object types
+##############################
+
+object_types = {
+    "switch": Switch,
+    "phy"   : Phy,
+}
+"""Object classes by type name, as used in descriptions"""
+
+
+def register_type(name: str, cls):
+    """
+    Make a custom object class available in descriptions under a short name
+    """
+
+    object_types[name] = cls
+
+
+def _object_type(name: str):
+    if name in object_types:
+        return object_types[name]
+
+    module, _, clsname = name.rpartition(".")
+    if not module:
+        raise ValueError(f"Unknown object type: {name}")
+
+    return getattr(importlib.import_module(module), clsname)
+
+
+##############################
+# Description parsing
+##############################
+
+def _endpoint_spec(spec):
+    if isinstance(spec, str):
+        return spec, Endpoint_Kind.Virtual, dict()
+    else:
+        return spec["name"], Endpoint_Kind(spec.get("kind", "virtual")), spec.get("properties", dict())
+
+
+def _link_spec(spec):
+    if isinstance(spec, (list, tuple)):
+        a, b = spec
+        return a, b, dict(), dict()
+    else:
+        return spec["a"], spec["b"], spec.get("a_properties", dict()), spec.get("b_properties", dict())
+
+
+def from_dict(desc: dict, topology=None):
+    """
+    Build a topology from a description
+
+    :param desc: Description dict
+    :param topology: Existing topology to add the description to
+    :return: The topology
+    """
+
+    # Imported here, as the topology module imports the object modules
+    from pyxnet.topology.objects.topology import Topology
+
+    if topology is None:
+        topology = Topology(name=desc.get("name", "topology"))
+
+    # Objects, registered by group
+    endpoints = dict() # Path -> Endpoint, for links lookup
+    groups    = dict()
+
+    for spec in desc.get("objects", list()):
+        cls = _object_type(spec["type"])
+        obj = cls(spec["name"], **spec.get("params", dict()))
+
+        known = {endp.name: endp for endp in obj.endpoints}
+        for ep_spec in spec.get("endpoints", list()):
+            name, kind, props = _endpoint_spec(ep_spec)
+            if name not in known:
+                known[name] = obj._endpoint_register(name, kind)
+            known[name].properties.update(props)
+
+        for name, endp in known.items():
+            endpoints[f"{obj.name}/{name}"] = endp
+
+        groups.setdefault(spec.get("group", None), list()).append(obj)
+
+    for group, objs in groups.items():
+        topology.register_many(objs, group=group)
+
+    # Links
+    pairs = list()
+    for spec in desc.get("links", list()):
+        a, b, a_props, b_props = _link_spec(spec)
+
+        missing = [x for x in (a, b) if x not in endpoints]
+        if missing:
+            # Endpoints of objects registered before the description
+            for path in missing:
+                obj_name, _, ep_name = path.partition("/")
+                if obj_name not in topology.objects:
+                    raise ValueError(f"Unknown object for endpoint {path}")
+                endpoints[path] = topology.objects[obj_name].endpoint(ep_name)
+
+        endpoints[a].properties.update(a_props)
+        endpoints[b].properties.update(b_props)
+        pairs.append((endpoints[a], endpoints[b]))
+
+    topology.connect_many(pairs)
+
+    return topology
+
+
+##############################
+# Files
+##############################
+
+def _parse_yaml(text):
+    try:
+        import yaml
+    except ImportError:
+        raise RuntimeError("PyYAML is needed to load YAML topologies")
+
+    return yaml.safe_load(text)
+
+
+def _parse_toml(text):
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            raise RuntimeError("tomli is needed to load TOML topologies before python 3.11")
+
+    return tomllib.loads(text)
+
+
+__parsers = {
+    ".yaml": _parse_yaml,
+    ".yml" : _parse_yaml,
+    ".json": json.loads,
+    ".toml": _parse_toml,
+}
+
+
+def load(path, topology=None, format: str = None):
+    """
+    Load a topology description file
+
+    :param path: Path to the file
+    :param topology: Existing topology to add the description to
+    :param format: "yaml", "json" or "toml". Guessed from the file extension by default.
+    :return: The topology
+    """
+
+    path   = Path(path)
+    suffix = f".{format}" if format is not None else path.suffix.lower()
+
+    if suffix not in __parsers:
+        raise ValueError(f"Unknown topology description format: {suffix}")
+
+    return from_dict(__parsers[suffix](path.read_text()), topology=topology)
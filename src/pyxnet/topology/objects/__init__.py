@@ -12,7 +12,9 @@ import logging
 from abc                      import ABC, abstractmethod
 from dataclasses              import dataclass
 
+from pyxnet.topology          import edits
 from pyxnet.topology.endpoint import Endpoint, Endpoint_Kind
+from pyxnet.platform.tools    import to_thread
 
 
 ##################################
@@ -20,13 +22,24 @@ from pyxnet.topology.endpoint import Endpoint, Endpoint_Kind
 ##################################
 
 class PyxNetObject(ABC):
+    netns_movable = True
+    """Virtual endpoints of the object can be put in a network namespace"""
+
     def __init__(self, name: str):
         super().__init__()
         self.name      = name
         self.log       = logging.getLogger(name)
 
+        self.topology_tag = None # Tag of the topology the object is registered in
+
         self.endpoints = set()
 
+    def __setattr__(self, name, value):
+        # Direct changes of the configuration, see pyxnet.topology.edits
+        if not name.startswith("_"):
+            edits.touch()
+        super().__setattr__(name, value)
+
     def __hash__(self) -> int:
         return str.__hash__(self.name)
 
@@ -37,7 +50,8 @@ class PyxNetObject(ABC):
         return self.name == other.name
 
     def __repr__(self):
-        return repr(self.__dict__)
+        endpoints = ", ".join(sorted(endp.name for endp in self.endpoints))
+        return f"{type(self).__name__}(name={self.name}, endpoints=[{endpoints}])"
 
     def export_graphviz(self, dot):
         """
@@ -69,9 +83,105 @@ class PyxNetObject(ABC):
         pass
 
 
+    # ---------------- asyncio variants
+    # By default, the blocking operations are run in the default executor.
+
+    async def instanciate_async(self):
+        return await to_thread(self.instanciate)
+
+    async def remove_async(self):
+        return await to_thread(self.remove)
+
+    async def up_async(self):
+        return await to_thread(self.up)
+
+    async def down_async(self):
+        return await to_thread(self.down)
+
+
+    # ---------------- Description and reconciliation
+    # describe() gives the platform configuration of the object as a plain
+    # dict. When it changes between two states of a topology, reconfigure()
+    # is called with the former description. Objects that disappeared are
+    # removed from their description, as the object itself is gone.
+
+    def describe(self) -> dict:
+        return dict()
+
+    def export_params(self) -> dict:
+        """
+        Constructor parameters of the object, other than its name, to build
+        it again from an export. See pyxnet.topology.export.
+        """
+
+        return dict()
+
+    def reconfigure(self, old: dict = None):
+        self.remove()
+        self.instanciate()
+
+    @classmethod
+    def _remove_described(cls, name: str, config: dict):
+        logging.getLogger(name).warning(f"Don't know how to remove {cls.__name__} object from its description")
+
+    @classmethod
+    def _described_live(cls, name: str, config: dict, live: dict):
+        """
+        Tells if a described object exists on the host.
+
+        :param live: dict with "interfaces" and "bridges" sets
+        """
+
+        return True
+
+    def _endpoint_attach(self, endp: Endpoint):
+        """
+        Called when an endpoint of an existing object gets a new link
+        """
+
+        pass
+
+    def _endpoint_detach(self, ifname: str):
+        """
+        Called when the link of an endpoint is removed. The interface
+        name is given as the endpoint may not exist anymore.
+        """
+
+        pass
+
+
     # ---------------- Endpoint registration
 
+    def _allocate_names(self, allocator):
+        """
+        Called before instanciation, to get names for the host resources of
+        the object (bridges...) from the topology names allocator.
+        """
+
+        pass
+
+    def _validate(self):
+        """
+        Called when planning a topology, once the connections are resolved.
+        Returns the list of problems that would make the instanciation fail.
+        """
+
+        return []
+
+    def endpoint(self, name: str):
+        """
+        Find an endpoint of the object by name
+
+        :raises KeyError: if there is no such endpoint
+        """
+
+        for endp in self.endpoints:
+            if endp.name == name:
+                return endp
+        raise KeyError(f"{self.name} has no endpoint {name}")
+
     def _endpoint_register(self, name: str, kind: Endpoint_Kind):
         endp = Endpoint(name, kind, parent=self)
         self.endpoints.add(endp)
+        edits.touch()
         return endp
\ No newline at end of file
@@ -13,6 +13,8 @@ from pyxnet.topology.objects  import PyxNetObject
 from pyxnet.topology.endpoint import Endpoint, Endpoint_Kind
 
 class Phy(PyxNetObject):
+    netns_movable = False
+
     def __init__(self, name: str, ifname: str = None):
         super().__init__(name)
         if not ifname:
@@ -23,10 +25,18 @@ class Phy(PyxNetObject):
         self.rep = Endpoint(name=f"{ifname}-real", kind=Endpoint_Kind.Real, parent=self)
         """This endpoint has no useful purpose, it is only for diagram representation"""
 
+        self.endpoints.update((self.ep, self.rep))
+
     @property
     def ifname(self):
         return self._ifname
 
+    def describe(self):
+        return {"ifname": self.ifname}
+
+    def export_params(self):
+        return {"ifname": self.ifname}
+
     def export_graphviz(self, dot):
         dghelp.box_logo_node(dot, self.name, dghelp.asset("icons/material/lan.png"), self.name)
 
@@ -10,10 +10,14 @@ Virtual switch description
 from pyxnet.topology.objects  import PyxNetObject
 from pyxnet.topology.endpoint import Endpoint, Endpoint_Kind
 
-from pyxnet.platform.tools    import ovs, ifp, sth
-from pyroute2                 import NDB
+from pyxnet.platform.tools    import ovs, netlink, names, to_thread, trace
+from pyxnet.platform          import journal
+from pyxnet.topology          import edits, plan
 
-from dataclasses              import dataclass
+import asyncio
+import time
+
+from dataclasses              import dataclass, fields
 from typing                   import Optional
 
 ##############################
@@ -38,6 +42,13 @@ class Switch_Config_STP:
     ## TODO # Per port config for RSTP
     # port_priority, port_num, path_cost, admin_edge, auto_edge, port_admin_state
 
+    def __setattr__(self, name, value):
+        # Changes of the configuration of a switch, see pyxnet.topology.edits.
+        # Configurations built when planning are not counted.
+        if name in self.__dict__:
+            edits.touch()
+        super().__setattr__(name, value)
+
 @dataclass
 class Switch_Endpoint_Config_STP:
     path_cost: int                   = 0
@@ -47,12 +58,19 @@ class Switch_Endpoint_Config_STP:
     auto_edge: bool                  = False
     admin_port_state: Optional[bool] = False
 
+    def __setattr__(self, name, value):
+        if name in self.__dict__:
+            edits.touch()
+        super().__setattr__(name, value)
+
 
 class Switch(PyxNetObject):
     """
     Represents a virtual switch object
     """
 
+    netns_movable = False # Ports are attached to openvswitch
+
     def __init__(self,
         name: str,
         mac_addr: str = None,
@@ -74,69 +92,159 @@ class Switch(PyxNetObject):
 
         self.stp_config = stp_config
 
+        self._ifname    = None # From the topology names allocator
+
 
     # ------------- Instanciation
 
     def instanciate(self):
-        _boolt = { True: "true", False: "false" }
+        self.log.info("Instanciate virtual switch")
 
+        # All commands are sent in a single ovs-vsctl call, or in the topology
+        # wide transaction if there is one active.
+        with ovs.transaction() as tr:
+            self._instanciate_commands(tr)
+
+    async def instanciate_async(self):
         self.log.info("Instanciate virtual switch")
 
+        async with ovs.transaction_async() as tr:
+            self._instanciate_commands(tr)
+
+    def _instanciate_commands(self, tr):
+        _boolt = { True: "true", False: "false" }
+
+        # Commands are idempotent, so that an existing switch can be reconfigured
         self.log.debug("-> Create bridge")
-        ovs.vsctl("add-br", self.ifname)
+        journal.record("bridge", self.ifname)
+        tr.add("--may-exist", "add-br", self.ifname)
 
         self.log.debug("-> Set MAC address?")
         if self.mac_addr is not None:
             self.log.info(f"Set bridge MAC address to {self.mac_addr}")
-            ovs.vsctl("set", "Bridge", self.ifname, f"other_config:rstp-address={self.mac_addr}")
+            tr.add("set", "Bridge", self.ifname, f"other_config:rstp-address={self.mac_addr}")
 
         self.log.debug("-> Set IP Address?")
         if self.ip_addr is not None:
-            self.log.info(f"Set bridge IP address to {self.ip_addr}")
-            with NDB() as ndb:
-                ndb.interfaces[self.ifname].add_ip(self.ip_addr).commit()
+            # The bridge interface only exists once the transaction is committed
+            tr.on_commit(self._instanciate_ip)
 
         self.log.debug("-> Set bridge STP/RSTP config")
-        ovs.vsctl("set", "Bridge", self.ifname, f"stp_enable={_boolt[self.stp_config.stp_enabled]}")
-        ovs.vsctl("set", "Bridge", self.ifname, f"rstp_enable={_boolt[self.stp_config.rstp_enabled]}")
-        ovs.vsctl("set", "Bridge", self.ifname, f"other_config:stp-priority=0x{self.stp_config.bridge_priority:04X}")
-        ovs.vsctl("set", "Bridge", self.ifname, f"other_config:stp-path-cost={self.stp_config.path_cost}")
-        ovs.vsctl("set", "Bridge", self.ifname, f"other_config:rstp-priority={self.stp_config.bridge_priority>>4}")
-        # > TODO Path cost is set per port
-        ovs.vsctl("set", "Bridge", self.ifname, f"other_config:rstp-ageing-time={self.stp_config.ageing_time}")
-        ovs.vsctl("set", "Bridge", self.ifname, f"other_config:rstp-max-age={self.stp_config.max_age}")
-        ovs.vsctl("set", "Bridge", self.ifname, f"other_config:rstp-forward-delay={self.stp_config.forward_delay}")
-        ovs.vsctl("set", "Bridge", self.ifname, f"other_config:rstp-transmit-hold-count={self.stp_config.transmit_hold_count}")
+        tr.add("set", "Bridge", self.ifname,
+            f"stp_enable={_boolt[self.stp_config.stp_enabled]}",
+            f"rstp_enable={_boolt[self.stp_config.rstp_enabled]}",
+            f"other_config:stp-priority=0x{self.stp_config.bridge_priority:04X}",
+            f"other_config:stp-path-cost={self.stp_config.path_cost}",
+            f"other_config:rstp-priority={self.stp_config.bridge_priority>>4}",
+            # > TODO Path cost is set per port
+            f"other_config:rstp-ageing-time={self.stp_config.ageing_time}",
+            f"other_config:rstp-max-age={self.stp_config.max_age}",
+            f"other_config:rstp-forward-delay={self.stp_config.forward_delay}",
+            f"other_config:rstp-transmit-hold-count={self.stp_config.transmit_hold_count}",
+            *self._external_ids(),
+        )
 
         # Add ports
         self.log.debug("-> Add ports to bridge")
         for p in self.endpoints:
-            ovs.vsctl("add-port", self.ifname, p.ifname)
-
-            # Configure RSTP properties
-            if "stp_config" in p.properties:
-                if isinstance(p.properties["stp_config"], Switch_Endpoint_Config_STP):
-                    ep_stp_config = p.Properties["stp_config"]
-                else:
-                    ep_stp_config = Switch_Endpoint_Config_STP(**p.properties["stp_config"])
-
-                # Mandatory properties
-                ovs.vsctl("set", "Port", p.ifname, f"other_config:stp-path-cost={ep_stp_config.path_cost}")
-                ovs.vsctl("set", "Port", p.ifname, f"other_config:rstp-path-cost={ep_stp_config.path_cost}")
-                ovs.vsctl("set", "Port", p.ifname, f"other_config:rstp-port-priority={ep_stp_config.priority>>8}")
-                ovs.vsctl("set", "Port", p.ifname, f"other_config:rstp-port-admin-edge={_boolt[ep_stp_config.admin_edge]}")
-                ovs.vsctl("set", "Port", p.ifname, f"other_config:rstp-port-auto-edge={_boolt[ep_stp_config.auto_edge]}")
-                
-                # Optional properties
-                if ep_stp_config.num is not None:
-                    ovs.vsctl("set", "Port", p.ifname, f"other_config:rstp-port-num={ep_stp_config.num}")
-
-                if ep_stp_config.admin_port_state is not None:
-                    ovs.vsctl("set", "Port", p.ifname, f"other_config:admin_port_state={_boolt[ep_stp_config.admin_port_state]}")
+            self._port_commands(tr, p)
+
+    def _external_ids(self):
+        # Bridges are tagged with their topology, to find them later
+        if self.topology_tag is None:
+            return ()
+        return (f"external_ids:pyxnet-topology={self.topology_tag}",)
+
+    def _port_commands(self, tr, p):
+        _boolt = { True: "true", False: "false" }
+
+        tr.add("--may-exist", "add-port", self.ifname, p.ifname)
+
+        # Configure RSTP properties
+        ep_stp_config = p.get_property("stp_config")
+        if ep_stp_config is not None:
+            if not isinstance(ep_stp_config, Switch_Endpoint_Config_STP):
+                ep_stp_config = Switch_Endpoint_Config_STP(**ep_stp_config)
+
+            # Mandatory properties
+            port_config = [
+                f"other_config:stp-path-cost={ep_stp_config.path_cost}",
+                f"other_config:rstp-path-cost={ep_stp_config.path_cost}",
+                f"other_config:rstp-port-priority={ep_stp_config.priority>>8}",
+                f"other_config:rstp-port-admin-edge={_boolt[ep_stp_config.admin_edge]}",
+                f"other_config:rstp-port-auto-edge={_boolt[ep_stp_config.auto_edge]}",
+            ]
+
+            # Optional properties
+            if ep_stp_config.num is not None:
+                port_config.append(f"other_config:rstp-port-num={ep_stp_config.num}")
+
+            if ep_stp_config.admin_port_state is not None:
+                port_config.append(f"other_config:admin_port_state={_boolt[ep_stp_config.admin_port_state]}")
+
+            tr.add("set", "Port", p.ifname, *port_config)
+
+    def _instanciate_ip(self):
+        self.log.info(f"Set bridge IP address to {self.ip_addr}")
+        with netlink.ipr() as ipr:
+            ipr.addr("replace", index=ipr.link_lookup(ifname=self.ifname)[0], address=self.ip_addr)
+
+    def _remove_ip(self, address: str):
+        self.log.info(f"Remove bridge IP address {address}")
+        with netlink.ipr() as ipr:
+            ipr.addr("del", index=ipr.link_lookup(ifname=self.ifname)[0], address=address)
+
+    def reconfigure(self, old: dict = None):
+        """
+        Apply the changes from a former description of the switch (see
+        describe()): settings that are not given anymore are removed, and
+        a renamed bridge is created again with the ports.
+
+        :param old: Former description, None to only apply the current settings
+        """
+
+        self.log.info("Reconfigure virtual switch")
+
+        with ovs.transaction() as tr:
+            if old is None:
+                pass
+
+            elif old["ifname"] != self.ifname:
+                # Bridges can't be renamed, their ports are added to the new one
+                tr.add("--if-exists", "del-br", old["ifname"])
+
+            else:
+                if (old["mac_addr"] is not None) and (self.mac_addr is None):
+                    tr.add("remove", "Bridge", self.ifname, "other_config", "rstp-address")
+
+                if (old["ip_addr"] is not None) and (old["ip_addr"] != self.ip_addr):
+                    # Before the new address is set, see _instanciate_commands()
+                    tr.on_commit(lambda: self._remove_ip(old["ip_addr"]))
+
+            # Instanciation commands are idempotent
+            self._instanciate_commands(tr)
+
+    def remove(self):
+        self.log.info("Remove virtual switch")
+        with ovs.transaction() as tr:
+            tr.add("--if-exists", "del-br", self.ifname)
+
+    async def remove_async(self):
+        self.log.info("Remove virtual switch")
+        async with ovs.transaction_async() as tr:
+            tr.add("--if-exists", "del-br", self.ifname)
 
 
     # ------------- Port managment
 
+    def _endpoint_attach(self, endp: Endpoint):
+        with ovs.transaction() as tr:
+            self._port_commands(tr, endp)
+
+    def _endpoint_detach(self, ifname: str):
+        with ovs.transaction() as tr:
+            tr.add("--if-exists", "del-port", self.ifname, ifname)
+
     def _endpoint_register(self, name: str, kind: Endpoint_Kind):
         # Check endpoint's kind
         if kind not in (Endpoint_Kind.Virtual, Endpoint_Kind.Phy):
@@ -151,7 +259,7 @@ class Switch(PyxNetObject):
         # Up switch
         self.log.info("Up switch")
 
-        with NDB() as ndb:
+        with netlink.ndb() as ndb:
             ndb.interfaces[self.ifname].set("state", "up").commit()
         
         # Up ports
@@ -161,16 +269,236 @@ class Switch(PyxNetObject):
     def down(self):
         # Down switch
         self.log.info("Down switch")
-        with NDB() as ndb:
+        with netlink.ndb() as ndb:
             ndb.interfaces[self.ifname].set("state", "down").commit()
 
         # Down ports
         for ep in self.endpoints:
             ep.down()
 
+    async def up_async(self):
+        self.log.info("Up switch")
+
+        await to_thread(self._set_state, "up")
+        await asyncio.gather(*(ep.up_async() for ep in self.endpoints))
+
+    async def down_async(self):
+        self.log.info("Down switch")
+
+        await to_thread(self._set_state, "down")
+        await asyncio.gather(*(ep.down_async() for ep in self.endpoints))
+
+    def _set_state(self, state):
+        with netlink.ndb() as ndb:
+            ndb.interfaces[self.ifname].set("state", state).commit()
+
+
+    # ------------- Spanning tree
+
+    def _stp_protocol(self):
+        # RSTP takes precedence in openvswitch when both are enabled
+        if self.stp_config.rstp_enabled:
+            return "rstp"
+        elif self.stp_config.stp_enabled:
+            return "stp"
+        return None
+
+    def stp_port_states(self, status: dict = None):
+        """
+        Returns the STP or RSTP state and role of the connected ports, by
+        endpoint path, as (state, role) tuples. (None, None) is given for
+        ports unknown to openvswitch.
+
+        :param status: Result of ovs.port_status(), read if not given
+        """
+
+        protocol = self._stp_protocol()
+        ports    = {endp.path: endp._ifname for endp in self.endpoints if endp._ifname is not None}
+        status   = status if status is not None else ovs.port_status(ports.values())
+
+        res = dict()
+        for path, ifname in ports.items():
+            port = status.get(ifname, None)
+            if (port is None) or (protocol is None):
+                res[path] = (None, None)
+            elif protocol == "rstp":
+                res[path] = (port["rstp_status"].get("rstp_port_state", None), port["rstp_status"].get("rstp_port_role", None))
+            else:
+                res[path] = (port["status"].get("stp_port_state", None), port["status"].get("stp_port_role", None))
+
+        return res
+
+    def _stp_stragglers(self, status: dict, elapsed: float = 0.0):
+        # Ports of unknown role can only be told blocking for good once the
+        # forward delay has passed
+        stable = elapsed >= self.stp_config.forward_delay
+
+        res = dict()
+        for path, (state, role) in self.stp_port_states(status).items():
+            if not _stp_settled(state, role, stable):
+                res[path] = state
+        return res
+
+    def wait_stp_converged(self, timeout: float = 60.0, interval: float = 0.2):
+        """
+        Wait until the spanning tree has converged on the ports of the
+        switch. See wait_stp_converged().
+        """
+
+        return wait_stp_converged([self], timeout=timeout, interval=interval)
+
     
+    # ------------- Description
+
+    def describe(self):
+        return {
+            "ifname"    : self.ifname,
+            "mac_addr"  : self.mac_addr,
+            "ip_addr"   : self.ip_addr,
+            "stp_config": {f.name: getattr(self.stp_config, f.name) for f in fields(self.stp_config)},
+        }
+
+    def export_params(self):
+        return {
+            "mac_addr"  : self.mac_addr,
+            "ip_addr"   : self.ip_addr,
+            "stp_config": {f.name: getattr(self.stp_config, f.name) for f in fields(self.stp_config)},
+        }
+
+    @classmethod
+    def _remove_described(cls, name: str, config: dict):
+        with ovs.transaction() as tr:
+            tr.add("--if-exists", "del-br", config["ifname"])
+
+    @classmethod
+    def _described_live(cls, name: str, config: dict, live: dict):
+        return config["ifname"] in live["bridges"]
+
+
+    # ------------- Validation
+
+    def _validate(self):
+        res = list()
+
+        if self.mac_addr is not None:
+            err = plan.check_mac(self.mac_addr)
+            if err is not None:
+                res.append(err)
+
+        if self.ip_addr is not None:
+            err = plan.check_ip(self.ip_addr)
+            if err is not None:
+                res.append(err)
+
+        if not (0 <= self.stp_config.bridge_priority <= 0xFFFF):
+            res.append(f"Invalid STP bridge priority {self.stp_config.bridge_priority}")
+
+        # All endpoints are added as ports
+        for p in self.endpoints:
+            if p._ifname is None:
+                res.append(f"Endpoint {p.name} has no interface to add as a port")
+
+            ep_stp_config = p.get_property("stp_config")
+            if (ep_stp_config is not None) and not isinstance(ep_stp_config, Switch_Endpoint_Config_STP):
+                try:
+                    ep_stp_config = Switch_Endpoint_Config_STP(**ep_stp_config)
+                except TypeError as exc:
+                    res.append(f"Invalid STP config for endpoint {p.name}: {exc}")
+                    continue
+
+            if (ep_stp_config is not None) and not (0 <= ep_stp_config.priority <= 0xFFFF):
+                res.append(f"Invalid STP priority {ep_stp_config.priority} for endpoint {p.name}")
+
+        return res
+
+
     # ------------- Various properties
 
+    def _allocate_names(self, allocator):
+        self._ifname = allocator.allocate(self.name)
+
     @property
     def ifname(self):
-        return ifp(sth(self.name))
\ No newline at end of file
+        if self._ifname is None:
+            self._allocate_names(names.default())
+        return self._ifname
+
+
+##############################
+# Spanning tree errors
+##############################
+
+class STP_Wait_Error(TimeoutError):
+    """
+    Raised when the spanning tree has not converged in time. stragglers
+    gives the last STP/RSTP state of each port that is not settled, by
+    endpoint path.
+    """
+
+    def __init__(self, stragglers: dict, timeout: float):
+        self.stragglers = dict(stragglers)
+        self.timeout    = timeout
+
+        ports = ", ".join(f"{key} ({state or 'unknown'})" for key, state in sorted(self.stragglers.items()))
+        super().__init__(f"Spanning tree not converged after {timeout}s, {len(self.stragglers)} ports: {ports}")
+
+
+##############################
+# Spanning tree convergence
+##############################
+
+def _stp_settled(state, role, stable: bool = False):
+    """
+    Tells if a port has reached its final spanning tree state:
+
+    - forwarding ;
+    - disabled, e.g. when its link is down: it won't change until then ;
+    - blocking (STP) or discarding (RSTP) because of its role, alternate or
+      backup. Root and designated ports also block for a while before
+      forwarding. Without a role, blocking ports are settled once stable,
+      i.e. when the forward delay has passed.
+    """
+
+    state = (state or "").lower()
+    role  = (role  or "").lower()
+
+    if (state in ("forwarding", "disabled")) or (role == "disabled"):
+        return True
+    elif state in ("blocking", "discarding"):
+        return (role in ("alternate", "backup")) or ((not role) and stable)
+    return False
+
+
+def wait_stp_converged(switches, timeout: float = 60.0, interval: float = 0.2):
+    """
+    Wait until every connected port of the switches with STP or RSTP enabled
+    is settled: forwarding, disabled, or blocking as an alternate or backup
+    port. The ports status of all the switches is read in a single OVSDB
+    query on each check.
+
+    :param switches: Iterable of Switch objects, switches without spanning tree are ignored
+    :param timeout: Maximum time to wait, in seconds
+    :param interval: Time between two checks, in seconds
+    :return: The time waited, in seconds
+    :raises STP_Wait_Error: listing the ports that are not settled in time
+    """
+
+    switches = [x for x in switches if x._stp_protocol() is not None]
+    t_start  = time.monotonic()
+    deadline = t_start + timeout
+
+    with trace.span("wait stp converged", tool="stp", switches=len(switches)):
+        while switches:
+            status     = ovs.port_status()
+            stragglers = dict()
+            for sw in switches:
+                stragglers.update(sw._stp_stragglers(status, time.monotonic() - t_start))
+
+            if not stragglers:
+                break
+            elif time.monotonic() + interval > deadline:
+                raise STP_Wait_Error(stragglers, timeout)
+
+            time.sleep(interval)
+
+    return time.monotonic() - t_start
@@ -7,15 +7,33 @@ Global topology object definition
 :Date: January 2023
 """
 
+from collections import Counter
 from copy        import copy
-from dataclasses import dataclass, field
-from typing      import List, Tuple, Set, Dict
+from dataclasses import dataclass, field, replace
+from typing      import List, Tuple, Set, Dict, Optional
 
 from pyxnet.topology.endpoint import Endpoint, Endpoint_Connection, Endpoint_Kind
 from pyxnet.topology.objects  import PyxNetObject
+from pyxnet.topology.objects  import switch
+from pyxnet.platform.link     import Link, Link_VEth, Link_Phy, Link_Pipe
+from pyxnet.topology.scheduler import Schedule
+from pyxnet.topology           import reconcile as rec
+from pyxnet.topology           import plan as tplan
+from pyxnet.topology           import edits
+from pyxnet.platform.tools    import ovs, netlink, tc, to_thread, trace
+from pyxnet.platform.tools.names import Name_Allocator
+from pyxnet.platform.journal  import Resource_Journal
+from pyxnet.platform          import journal
+from pyxnet.diagram.render    import Dot_Stream
 
+import asyncio
 import graphviz
+import io
 import logging
+import os
+
+LARGE_DIAGRAM_OBJECTS = 1000
+"""Number of objects from which diagrams are drawn in large mode, see Topology.export_graphviz"""
 
 @dataclass
 class Topology:
@@ -30,12 +48,108 @@ class Topology:
     links: Set[Endpoint_Connection] = field(default_factory=set )
     groups: Dict[str, List[str]]    = field(default_factory=dict)
 
+    journal_path: Optional[str]     = None
+    """File keeping track of the created resources, to remove them after a crash"""
+
+    netns: Optional[str]            = None
+    """Network namespace of the movable endpoints, see Endpoint.movable. Endpoints
+    can also be given their own namespace with the "netns" property."""
+
+    plan_cache: Optional[str]       = None
+    """Directory where plans are kept between runs, see plan.Plan_Cache. Defaults
+    to the PYXNET_PLAN_CACHE environment variable, plans are not kept if not set."""
+
     def __post_init__(self):
-        self.log = logging.getLogger(f"Topology {self.name}")
+        self.log     = logging.getLogger(f"Topology {self.name}")
+        self.session = netlink.Netlink_Session()
+        """Netlink session shared by all objects and links during an operation"""
+
+        self.journal = Resource_Journal.load(self.journal_path) if self.journal_path else Resource_Journal()
+        """Resources created on the host, removed by remove()"""
+
+        self.applied = None
+        """Snapshot of the last state applied on the host, see reconcile()"""
+
+        self._connections = dict()
+        """Connection of each connected endpoint"""
+
+        self._adjacency   = dict()
+        """Connections of each object, by object name"""
+
+        self._version = 0
+        """Incremented on each change of objects or connections"""
+
+        self._plan    = None
+        """Last plan, see plan()"""
+
+        self._plan_edits = None
+        """Count of direct edits when the last plan was checked, see pyxnet.topology.edits"""
+
+        self._analysis = (None, dict())
+        """Graph analyses of the last version, see pyxnet.topology.analysis"""
+
+        cache_dir = self.plan_cache or os.environ.get("PYXNET_PLAN_CACHE", None)
+        self._plan_cache = tplan.Plan_Cache(cache_dir) if cache_dir else None
+
+        # Names in the host namespace must differ between the copies of a topology
+        self.names = Name_Allocator(salt=self.netns or "")
+        """Interface names of the topology"""
+
+        for conn in self.links:
+            self._index(conn)
+
+    @property
+    def tag(self):
+        """
+        Identifies the resources of this topology on the host, e.g. in
+        the external_ids of openvswitch bridges
+        """
+
+        return self.netns or self.name
+
+
+    def invalidate(self):
+        """
+        Forget the cached plan, so that the next plan() builds it again.
+        Direct changes of objects or endpoint properties are found by plan()
+        already, but not changes inside their values, see
+        pyxnet.topology.edits.
+        """
+
+        self._plan     = None
+        self._version += 1
 
 
     # --------------- Endpoints managment
 
+    def _index(self, conn):
+        for endp in (conn.a, conn.b):
+            if endp in self._connections:
+                raise ValueError(f"{endp} is already connected")
+        self._connections[conn.a] = conn
+        self._connections[conn.b] = conn
+
+        self._adjacency.setdefault(conn.a.parent.name, set()).add(conn)
+        self._adjacency.setdefault(conn.b.parent.name, set()).add(conn)
+
+    def _unindex(self, conn):
+        self._connections.pop(conn.a, None)
+        self._connections.pop(conn.b, None)
+
+        for name in (conn.a.parent.name, conn.b.parent.name):
+            conns = self._adjacency.get(name, None)
+            if conns is not None:
+                conns.discard(conn)
+                if not conns:
+                    del self._adjacency[name]
+
+    def _release(self, conn):
+        # Interface names of a removed connection can be given to new ones
+        self.names.release(conn.a.path)
+        self.names.release(conn.b.path)
+        self.names.release(f"{conn.a.path}|{conn.b.path}")
+
+
     def connect(self, endpA, endpB):
         """
         Adds a connection between endpoint A end endpoint B,
@@ -52,17 +166,19 @@ class Topology:
             raise ValueError(f"{endpB} parent not registered in topology")
 
         # Check endpoints are not already connected
-        # FIXME: This O(n) check can lead to some bulky overhead when the topology become complex.
-        # Is there any O(1) algo to do this?
-
-        for x in self.links:
-            if (x.a == endpA) or (x.b == endpB):
-                raise ValueError(f"{endpA} is already connected")
-            elif (x.a == endpB) or (x.b == endpB):
-                raise ValueError(f"{endpB} is already connected")
+        if endpA == endpB:
+            raise ValueError(f"Cannot connect {endpA} to itself")
+        if endpA in self._connections:
+            raise ValueError(f"{endpA} is already connected")
+        if endpB in self._connections:
+            raise ValueError(f"{endpB} is already connected")
 
         # Create endpoint connection
-        self.links.add(Endpoint_Connection(endpA, endpB))
+        conn = Endpoint_Connection(endpA, endpB)
+        self.links.add(conn)
+        self._index(conn)
+        self._version += 1
+        return conn
     
 
     def disconnect(self, endpA, endpB):
@@ -74,10 +190,80 @@ class Topology:
         :param endpB: Endpoint B
         """
 
-        conn_a = Endpoint_Connection(endpA, endpB)
-        conn_b = Endpoint_Connection(endpB, endpA)
-        self.links.discard(conn_a)
-        self.links.discard(conn_b)
+        conn = self._connections.get(endpA, None)
+        if (conn is not None) and (endpB in (conn.a, conn.b)):
+            self.links.discard(conn)
+            self._unindex(conn)
+            self._release(conn)
+            self._version += 1
+
+
+    def connect_many(self, pairs):
+        """
+        Adds several connections at once. The whole batch is checked before
+        any connection is added: nothing is connected if a check fails.
+
+        :param pairs: Iterable of (endpoint A, endpoint B) tuples
+        :return: List of the created connections
+        """
+
+        pairs = list(pairs)
+        endps = [endp for pair in pairs for endp in pair]
+        uniq  = set(endps)
+
+        unknown = {endp.parent.name for endp in uniq} - self.objects.keys()
+        if unknown:
+            raise ValueError(f"Parents of endpoints not registered in topology: {', '.join(sorted(unknown))}")
+
+        if len(uniq) != len(endps):
+            raise ValueError("Endpoints used more than once in connections: " + ", ".join(sorted(
+                str(endp) for endp, n in Counter(endps).items() if n > 1
+            )))
+
+        connected = uniq & self._connections.keys()
+        if connected:
+            raise ValueError(f"Endpoints already connected: {', '.join(sorted(map(str, connected)))}")
+
+        conns = [Endpoint_Connection(a, b) for a, b in pairs]
+        self.links.update(conns)
+        for conn in conns:
+            self._index(conn)
+
+        self._version += 1
+        return conns
+
+
+    def connection_of(self, endp: Endpoint):
+        """
+        Returns the connection of an endpoint, or None if it is not connected
+
+        :param endp: The endpoint
+        """
+
+        return self._connections.get(endp, None)
+
+
+    def connected(self, endp: Endpoint):
+        """
+        Returns the endpoint connected to the given one, or None
+        """
+
+        conn = self._connections.get(endp, None)
+        if conn is None:
+            return None
+        return conn.b if conn.a == endp else conn.a
+
+
+    def links_of(self, obj):
+        """
+        Returns the connections of an object, from the index kept up to date
+        by connect() and disconnect(). See pyxnet.topology.analysis.
+
+        :param obj: Object or object name
+        """
+
+        name = obj if isinstance(obj, str) else obj.name
+        return frozenset(self._adjacency.get(name, ()))
 
 
     # --------------- Objects managmnet
@@ -91,17 +277,55 @@ class Topology:
 
         if isinstance(obj, PyxNetObject):
             self.objects[obj.name] = obj
+            obj.topology_tag       = self.tag
 
             # Add object to group
             if not group in self.groups:
                 self.groups[group] = list()
 
             self.groups[group].append(obj.name)
+            self._version += 1
         else:
             raise TypeError(f"{obj} is not a pyxnet network object" )
         return obj
 
 
+    def register_many(self, objs, group: str = None):
+        """
+        Registers several network objects at once. The whole batch is
+        checked before any object is added.
+
+        :param objs: Iterable of network objects
+        :param group: Group of all the objects
+        :raises ValueError: if a name is used twice, or is already registered
+        :return: List of the registered objects
+        """
+
+        objs  = list(objs)
+        wrong = [obj for obj in objs if not isinstance(obj, PyxNetObject)]
+        if wrong:
+            raise TypeError(f"{wrong[0]} is not a pyxnet network object")
+
+        names = [obj.name for obj in objs]
+        uniq  = set(names)
+        if len(uniq) != len(names):
+            raise ValueError("Objects names used more than once: " + ", ".join(sorted(
+                name for name, n in Counter(names).items() if n > 1
+            )))
+
+        existing = uniq & self.objects.keys()
+        if existing:
+            raise ValueError(f"Objects already registered: {', '.join(sorted(existing))}")
+
+        self.objects.update(zip(names, objs))
+        for obj in objs:
+            obj.topology_tag = self.tag
+        self.groups.setdefault(group, list()).extend(names)
+
+        self._version += 1
+        return objs
+
+
     def unregister(self, obj: any):
         """
         Unregister a network object from the topology
@@ -110,17 +334,35 @@ class Topology:
         """
 
         if isinstance(obj, str):
-            if obj in self.objects:
-                del self.objects[obj]
+            obj = self.objects.get(obj, None)
         elif isinstance(obj, PyxNetObject):
-            if obj.name in self.objects:
-                del self.objects[obj]
+            obj = self.objects.get(obj.name, None)
         else:
             raise TypeError(f"{obj} is not a string nor a pyxnet network object")
 
+        if obj is None:
+            return
+
+        # Remove the connections of the object
+        for endp in obj.endpoints:
+            conn = self._connections.get(endp, None)
+            if conn is not None:
+                self.links.discard(conn)
+                self._unindex(conn)
+                self._release(conn)
+
+        for items in self.groups.values():
+            if obj.name in items:
+                items.remove(obj.name)
+
+        del self.objects[obj.name]
+        self.names.release(obj.name)
+        obj.topology_tag = None
+        self._version   += 1
+
 
     def get(self, name: str):
-        self.objects[name]
+        return self.objects[name]
 
 
     def __getitem__(self, name: str):
@@ -129,16 +371,104 @@ class Topology:
     
     # --------------- Diagram export
 
-    def export_graphviz(self):
-        dot = graphviz.Graph(
+    def _graphviz_large(self, large: Optional[bool] = None):
+        return (len(self.objects) >= LARGE_DIAGRAM_OBJECTS) if large is None else large
+
+    def _graphviz_attrs(self, large: bool = False):
+        if large:
+            # The layout attribute makes the dot command run sfdp as well
+            return dict(
+                name=self.name,
+                graph_attr={"fontname": "sans-serif", "layout": "sfdp", "splines": "line", "overlap": "prism", "outputorder": "edgesfirst"},
+                edge_attr={"fontname": "sans-serif", "fontsize": "11"},
+                node_attr={"fontname": "sans-serif"},
+                body=[f'label="{self.name}"']
+            )
+
+        return dict(
             name=self.name,
-            engine="dot",
             graph_attr={"fontname": "sans-serif", "splines": "spline"},
             edge_attr={"fontname": "sans-serif", "fontsize": "11"},
             node_attr={"fontname": "sans-serif"},
             body=["newrank=true;", "nodesep=1;", f'label="{self.name}"']
         )
 
+    def export_graphviz(self, large: Optional[bool] = None, expand=(), focus: Optional[str] = None):
+        """
+        Export the topology diagram as a graphviz.Graph.
+
+        Large topologies (LARGE_DIAGRAM_OBJECTS objects or more) are laid out
+        with sfdp, with straight edges without endpoint labels, and each group
+        is collapsed in a single summary node: the layout time stays bounded
+        by the number of groups instead of the number of objects.
+
+        :param large: Force the large diagram mode on or off
+        :param expand: Groups drawn with all their objects in large mode
+        :param focus: Only draw this group, and the objects or collapsed
+                      groups it is connected to. See dot_pages().
+        """
+
+        large = self._graphviz_large(large)
+        dot   = graphviz.Graph(engine="sfdp" if large else "dot", **self._graphviz_attrs(large))
+        self._graphviz_body(dot, large, expand, focus)
+        return dot
+
+    def write_dot(self, out=None, large: Optional[bool] = None, expand=(), focus: Optional[str] = None):
+        """
+        Write the DOT source of the diagram as it is generated, without
+        building a graphviz.Graph. The source is the same as the one of
+        export_graphviz(), with the same arguments. See pyxnet.diagram.render
+        to render it.
+
+        :param out: File object to write to. If not given, the source is returned.
+        """
+
+        if out is None:
+            buffer = io.StringIO()
+            self.write_dot(buffer, large, expand, focus)
+            return buffer.getvalue()
+
+        large = self._graphviz_large(large)
+        with Dot_Stream.graph(out, **self._graphviz_attrs(large)) as dot:
+            self._graphviz_body(dot, large, expand, focus)
+
+    def dot_pages(self, large: Optional[bool] = None):
+        """
+        Split the diagram in one page per group: each page draws the objects
+        of the group, and the collapsed groups and ungrouped objects it is
+        connected to. Ungrouped objects are only drawn on the pages of their
+        neighbours. By default, a page is drawn in large mode if its group
+        has LARGE_DIAGRAM_OBJECTS objects or more.
+
+        .. code:: python
+
+            render.render_many((source, f"docs/{group}.svg") for group, source in topo.dot_pages().items())
+
+        :return: Dict of DOT sources, by group name
+        """
+
+        group_of = self._group_of()
+        pages    = dict()
+
+        for group, items in self.groups.items():
+            if group is None:
+                continue
+
+            page_large = (len(items) >= LARGE_DIAGRAM_OBJECTS) if large is None else large
+            buffer     = io.StringIO()
+            with Dot_Stream.graph(buffer, **self._graphviz_attrs(page_large)) as dot:
+                self._graphviz_collapsed_body(dot, page_large, set(), group, group_of)
+            pages[group] = buffer.getvalue()
+
+        return pages
+
+    def _group_of(self):
+        return {name: group for group, items in self.groups.items() if group is not None for name in items}
+
+    def _graphviz_body(self, dot, large: bool = False, expand=(), focus: Optional[str] = None):
+        if large or (focus is not None):
+            return self._graphviz_collapsed_body(dot, large, set(expand), focus, self._group_of())
+
         # Add nodes
         for group, items in self.groups.items():
             if group is not None:
@@ -154,18 +484,558 @@ class Topology:
             style = "dashed"  if (edge.a.kind == Endpoint_Kind.Real) or (edge.b.kind == Endpoint_Kind.Real) else "solid"
             dot.edge(edge.a.parent.name, edge.b.parent.name, headlabel=edge.b.name, taillabel=edge.a.name, style=style)
 
-        return dot
+    def _graphviz_collapsed_body(self, dot, large: bool, expand: Set[str], focus: Optional[str], group_of: Dict[str, str]):
+        def node_of(name):
+            # Diagram node of an object: the summary node of its group when collapsed
+            group = group_of.get(name, None)
+            if (group is None) or (group in expand) or (group == focus):
+                return name
+            return f"group/{group}"
+
+        if focus is None:
+            links = self.links
+        else:
+            # Only the links of the group, from the endpoints index
+            links = {
+                self._connections[endp]
+                for name in self.groups.get(focus, ())
+                for endp in self.objects[name].endpoints if endp in self._connections
+            }
+
+        # Links between the same diagram nodes are merged
+        edges = dict()
+        for conn in links:
+            a    = node_of(conn.a.parent.name)
+            b    = node_of(conn.b.parent.name)
+            if a == b and a.startswith("group/"):
+                continue # Inside a collapsed group
+
+            real = (conn.a.kind == Endpoint_Kind.Real) or (conn.b.kind == Endpoint_Kind.Real)
+            key  = (a, b) if a <= b else (b, a)
+            if key in edges:
+                count, all_real, _ = edges[key]
+                edges[key] = (count + 1, all_real and real, None)
+            else:
+                edges[key] = (1, real, (conn.a.name, conn.b.name) if a <= b else (conn.b.name, conn.a.name))
+
+        # Add nodes
+        if focus is None:
+            for group, items in self.groups.items():
+                self._graphviz_group(dot, large, group, items, (group is not None) and (group not in expand))
+        else:
+            self._graphviz_group(dot, large, focus, self.groups.get(focus, ()), False)
+
+            others = sorted({node for edge in edges for node in edge if group_of.get(node, None) != focus})
+            for node in others:
+                if node.startswith("group/"):
+                    group = node[len("group/"):]
+                    self._graphviz_group(dot, large, group, self.groups[group], True)
+                else:
+                    self.objects[node].export_graphviz(dot)
+
+        # Add edges, sorted so that the source does not change between runs
+        for (a, b), (count, real, ports) in sorted(edges.items()):
+            style = "dashed" if real else "solid"
+            if count > 1:
+                dot.edge(a, b, label=str(count), penwidth=str(min(1 + count // 4, 8)), style=style)
+            elif large or a.startswith("group/") or b.startswith("group/"):
+                dot.edge(a, b, style=style)
+            else:
+                dot.edge(a, b, headlabel=ports[1], taillabel=ports[0], style=style)
+
+    def _graphviz_group(self, dot, large: bool, group: Optional[str], items, collapsed: bool):
+        if collapsed:
+            dot.node(f"group/{group}", label=f"{group}\\n{len(items)} objects", shape="box3d", style="filled", fillcolor="lightgrey")
+        elif (group is not None) and not large:
+            with dot.subgraph(name=group, body=[f"label={group};", "margin=16;", "rank=same;", "cluster=true;"]) as dotgroup:
+                for node in items:
+                    self.objects[node].export_graphviz(dotgroup)
+        else:
+            for node in items:
+                self.objects[node].export_graphviz(dot)
 
 
     # --------------- Instanciation / Cleanup
 
-    def instanciate(self):
-        self.log.info("Instanciate topology")
+    def plan(self):
+        """
+        Resolve the whole topology into an immutable execution plan: link of
+        each connection, interface names, namespaces, addresses and object
+        configurations. Nothing is done on the host.
+
+        The plan is kept until the topology is changed, by its methods or
+        directly (objects attributes, endpoint properties...). The content
+        hash is only computed when some object or endpoint was changed
+        directly since the last call, see pyxnet.topology.edits, or when
+        the plan is built. With a plan cache, a plan saved for the same
+        content hash is loaded instead of being built again.
+
+        :raises Plan_Error: listing all the problems found in the topology
+        :return: A Plan
+        """
+
+        count = edits.count()
+        kept  = (self._plan is not None) and (self._plan.version == self._version)
+        if kept and (self._plan_edits == count):
+            return self._plan
+
+        key = self.content_hash()
+        if kept and (self._plan.content_hash == key):
+            self._plan_edits = count
+            return self._plan
+
+        cached = self._plan_cache.load(key) if self._plan_cache is not None else None
+
+        if (cached is not None) and self.names.restore(cached[1]):
+            self.log.debug(f"Plan {key} loaded from cache")
+            self._plan = replace(cached[0], version=self._version)
+            self._bind_endpoints(self._plan)
+
+        else:
+            self._plan = replace(tplan.build(self, version=self._version), content_hash=key)
+            if self._plan_cache is not None:
+                self._plan_cache.store(self._plan, self.names.state())
+
+        self._plan_edits = count
+        return self._plan
+
+
+    def content_hash(self):
+        """
+        Returns a hash of the topology contents, see plan.content_hash()
+        """
+
+        return tplan.content_hash(self)
+
+
+    def resolve(self):
+        """
+        Allocate the interface names of the objects and connections,
+        and choose the link of each connection. Nothing is done on the host.
+        """
+
+        self.plan()
+
+
+    def _bind_endpoints(self, plan):
+        # Interfaces of the objects and endpoints, for a plan that was not built here
+        for obj in self.objects.values():
+            obj._allocate_names(self.names)
+
+        endps = {endp.path: endp for obj in self.objects.values() for endp in obj.endpoints}
+        for endp in endps.values():
+            endp._ifname = None
+
+        for spec in plan.links:
+            for path, ifname, netns in ((spec.a, spec.a_ifname, spec.a_netns), (spec.b, spec.b_ifname, spec.b_netns)):
+                endps[path]._ifname = ifname
+                endps[path]._netns  = netns
+
+
+    def _bind_links(self, plan):
+        # Links are built from the plan, so that a cached plan gives new link objects
+        conns = {endp.path: conn for conn in self.links for endp in (conn.a, conn.b)}
+        for spec in plan.links:
+            conns[spec.a].link_obj = Link.from_description(spec.link) if spec.link is not None else None
+
+
+    def _run_compiled(self, plan, tr):
+        # Instanciation of the compiled objects, as recorded in the plan
+        for entry in plan.records:
+            journal.record(**entry)
+
+        for cmd in plan.commands:
+            tr.add(*cmd)
+
+        for name, method in plan.hooks:
+            tr.on_commit(getattr(self.objects[name], method))
+
+
+    def _schedule(self, plan):
+        """
+        Build the dependency graph of the instanciation:
+
+        - veth pairs are created in a single netlink batch ;
+        - other links are configured on their own ;
+        - pipes come after the configuration of the phy interfaces they use ;
+        - objects come after the links attached to their endpoints.
+        """
+
+        schedule = Schedule(self.name)
+        self._bind_links(plan)
+
+        veths = [l.link_obj for l in self.links if isinstance(l.link_obj, Link_VEth)]
+        if veths:
+            schedule.add("links/veth",
+                lambda: Link_VEth.instanciate_batch(veths),
+                action_async=lambda: Link_VEth.instanciate_batch_async(veths)
+            )
+
+        objects_deps = {name: set() for name in self.objects}
+        phy_nodes    = dict() # Interface name -> phy configuration node
+        pipes        = list()
 
-        # Instanciate links
         for l in self.links:
-            l.instanciate()
+            if   l.link_obj is None:
+                continue
+            elif isinstance(l.link_obj, Link_VEth):
+                node_name = "links/veth"
+            else:
+                node_name = f"link/{l.a.path}<->{l.b.path}"
+                schedule.add(node_name, l.link_obj.instanciate, action_async=l.link_obj.instanciate_async, obj=rec.link_key(l))
+
+                if isinstance(l.link_obj, Link_Phy):
+                    phy_nodes[l.link_obj.name] = node_name
+                elif isinstance(l.link_obj, Link_Pipe):
+                    pipes.append((node_name, l.link_obj))
+
+            objects_deps[l.a.parent.name].add(node_name)
+            objects_deps[l.b.parent.name].add(node_name)
+
+        for node_name, pipe in pipes:
+            schedule.depends(node_name, *(phy_nodes[x] for x in (pipe.p0_name, pipe.p1_name) if x in phy_nodes))
+
+        # Compiled objects are in the ovs transaction already
+        for name, obj in self.objects.items():
+            if name not in plan.compiled:
+                schedule.add(f"object/{name}", obj.instanciate, objects_deps[name], action_async=obj.instanciate_async, obj=name)
+
+        return schedule
+
+
+    def instanciate(self, workers: int = None):
+        """
+        Instanciate the topology on the host. Independent links and objects
+        are instanciated concurrently.
+
+        All veth pairs are created by a single netlink batch, and compiled
+        objects (e.g. switches) by the single openvswitch transaction:
+        these are one operation each, whatever the number of workers.
+
+        :param workers: Maximum number of concurrent operations, i.e. of phy
+                        and pipe links, and of objects that are not compiled.
+                        1 runs everything sequentially.
+        :return: A Schedule_Report with the time spent in each operation
+        """
+
+        self.log.info("Instanciate topology")
+
+        # Invalid topologies fail here, before anything is created
+        with trace.phase("plan"):
+            plan = self.plan()
+        self.log.info(f"Plan: {plan}")
+
+        with trace.phase("recover"):
+            self._recover()
+
+        with self.session, self.journal:
+            with trace.phase("namespaces"):
+                self._create_namespaces(plan.namespaces)
+
+            # openvswitch commands from all objects are sent in one transaction
+            with trace.phase("build"), ovs.transaction() as tr:
+                self._run_compiled(plan, tr)
+                report = self._schedule(plan).run(workers=workers)
+
+        self.applied = plan.snapshot()
+
+        self.log.info(f"Topology instanciated in {report.wall_time:.3f}s")
+        return report
+
+
+    def namespaces(self):
+        """
+        Returns the network namespaces used by the topology
+        """
+
+        res = {self.netns} if self.netns is not None else set()
+        for conn in self.links:
+            for endp in (conn.a, conn.b):
+                netns = endp.get_property("netns")
+                if (netns is not None) and endp.movable:
+                    res.add(netns)
+
+        return res
+
+
+    def _create_namespaces(self, namespaces):
+        for name in namespaces:
+            if netlink.netns_create(name):
+                self.log.info(f"Created network namespace {name}")
+                journal.record("netns", name)
+
+
+    def _recover(self):
+        # Resources recorded by a previous run that was not removed
+        if self.journal.entries and (self.applied is None):
+            self.log.warning(f"Removing {len(self.journal)} resources left by a previous run")
+            with self.session:
+                self.journal.replay()
+
+
+    def remove(self):
+        """
+        Remove the instanciated objects and links from the host.
+        Only the resources recorded in the journal are removed, in batches.
+        """
+
+        self.log.info("Remove topology")
+
+        with self.session, trace.phase("remove"):
+            if self.journal.entries:
+                self.journal.replay()
+
+            else:
+                # Nothing recorded, the topology may have been instanciated by another process
+                with ovs.transaction():
+                    for n, obj in self.objects.items():
+                        with trace.span("remove", tool="object", obj=n):
+                            obj.remove()
+
+                for l in self.links:
+                    with trace.span("remove", tool="link", obj=rec.link_key(l)):
+                        l.remove()
+
+        self.applied = None
+
+
+    # --------------- Incremental changes
+
+    def snapshot(self):
+        """
+        Returns a JSON compatible description of the state this topology
+        puts on the host. See pyxnet.topology.reconcile.
+        """
+
+        return rec.snapshot(self)
+
+
+    def reconcile(self, snapshot: dict = None, check_live: bool = False):
+        """
+        Apply only the differences between the declared topology and
+        a previous state, instead of removing and instanciating everything.
+
+        :param snapshot: State to start from. Defaults to the last state applied
+                         by this object, or nothing if there is none.
+        :param check_live: Objects and links of the starting state missing on the
+                           host are created again.
+        :return: The applied Topology_Diff
+        """
+
+        old = snapshot or self.applied or rec.empty_snapshot(self.name)
+        if check_live:
+            with self.session:
+                old = rec.live(old)
+
+        with trace.phase("plan"):
+            plan    = self.plan()
+            new     = plan.snapshot()
+            changes = rec.diff(old, new)
+
+        self.log.info(f"Reconcile topology: {changes}")
+        if changes:
+            with trace.phase("apply"):
+                with self.journal:
+                    self._create_namespaces(plan.namespaces)
+                self._bind_links(plan)
+                rec.apply(self, changes)
+
+        self.applied = new
+        return changes
+
+
+    def impair(self, endp: Endpoint, impairment=None, **params):
+        """
+        Set the impairment of an endpoint (delay, jitter, loss, rate...), see
+        tools.tc.Impairment. If the topology is instanciated, the qdiscs are
+        changed right away, without creating the link again. Otherwise, they
+        are set by instanciate().
+
+        .. code:: python
+
+            topo.impair(sw1.p0, delay=20, jitter=5, loss=0.5)
+            topo.impair(sw1.p0, None) # No impairment anymore
+
+        :param impairment: An Impairment or a dict, or the Impairment fields as keyword arguments
+        """
+
+        return self.impair_many({endp: tc.Impairment(**params) if params else impairment})
+
+
+    def impair_many(self, impairments: dict):
+        """
+        Set the impairment of several endpoints, in one netlink batch per
+        network namespace.
+
+        :param impairments: Impairment (or None) by endpoint
+        """
+
+        errors = [err for err in (
+            tc.check_impairment(imp) for imp in impairments.values() if imp is not None
+        ) if err is not None]
+        if errors:
+            raise ValueError(f"Invalid impairments: {', '.join(errors)}")
+
+        targets = list()
+        for endp, imp in impairments.items():
+            if imp is None:
+                endp.properties.pop("impairment", None)
+            else:
+                endp.properties["impairment"] = imp
+
+            # Phy links take the impairment of the virtual endpoint
+            conn = self._connections.get(endp, None)
+            link = conn.link_obj if conn is not None else None
+            if (self.applied is None) or (link is None) or (endp.kind == Endpoint_Kind.Phy):
+                continue
+
+            for name, ns, old in link.impairments():
+                if name == endp.ifname:
+                    link.set_impairment(name, imp)
+                    targets.append((name, ns, old, imp))
+
+        self._version += 1
+
+        if targets:
+            self.log.info(f"Set impairments of {len(targets)} interfaces")
+            with self.session, trace.phase("impair"):
+                tc.apply(targets)
+
+
+    def up(self):
+        self.log.info("Up topology")
+
+        with self.session, trace.phase("up"):
+            for n, obj in self.objects.items():
+                with trace.span("up", tool="object", obj=n):
+                    obj.up()
+
+
+    def down(self):
+        self.log.info("Down topology")
+
+        with self.session, trace.phase("down"):
+            for n, obj in self.objects.items():
+                with trace.span("down", tool="object", obj=n):
+                    obj.down()
+
+
+    def wait_ready(self, timeout: float = 10.0, endpoints=None):
+        """
+        Wait until the interfaces of the endpoints are operationally up,
+        e.g. after up(). Link events are received from the kernel, so the
+        call returns as soon as the last interface is up.
+
+        :param timeout: Maximum time to wait, in seconds
+        :param endpoints: Endpoints to wait for. Defaults to all the connected
+                          endpoints, except real ones which are on other devices.
+        :return: The time waited, in seconds
+        :raises netlink.Link_Wait_Error: listing the endpoints that are not up in time
+        """
+
+        if endpoints is None:
+            endpoints = [
+                endp for conn in self.links for endp in (conn.a, conn.b)
+                if endp.kind != Endpoint_Kind.Real
+            ]
+
+        self.plan() # Interface names
+        interfaces = {endp.path: (endp.ifname, endp.netns) for endp in endpoints}
+
+        self.log.info(f"Wait for {len(interfaces)} interfaces to be up")
+        with trace.phase("wait"):
+            waited = netlink.wait_links_up(interfaces, timeout)
+
+        self.log.info(f"Interfaces up in {waited:.3f}s")
+        return waited
+
+
+    def wait_converged(self, timeout: float = 60.0, interval: float = 0.2):
+        """
+        Wait until the spanning tree has converged on all the switches of
+        the topology, see switch.wait_stp_converged().
+
+        :return: The time waited, in seconds
+        :raises switch.STP_Wait_Error: listing the ports that are not settled in time
+        """
+
+        self.plan() # Interface names
+        switches = [obj for obj in self.objects.values() if isinstance(obj, switch.Switch)]
+
+        self.log.info(f"Wait for the spanning tree of {len(switches)} switches to converge")
+        with trace.phase("wait"):
+            waited = switch.wait_stp_converged(switches, timeout=timeout, interval=interval)
+
+        self.log.info(f"Spanning tree converged in {waited:.3f}s")
+        return waited
+
+
+    # --------------- asyncio variants
+
+    async def instanciate_async(self, concurrency: int = None):
+        """
+        Same as instanciate(), as asyncio tasks. Several topologies can
+        be instanciated concurrently in the same event loop.
+
+        :param concurrency: Maximum number of operations in flight, None for no limit
+        """
+
+        self.log.info("Instanciate topology")
+
+        with trace.phase("plan"):
+            plan = self.plan()
+        self.log.info(f"Plan: {plan}")
+
+        with trace.phase("recover"):
+            await to_thread(self._recover)
+
+        with self.session, self.journal:
+            with trace.phase("namespaces"):
+                await to_thread(self._create_namespaces, plan.namespaces)
+
+            with trace.phase("build"):
+                async with ovs.transaction_async() as tr:
+                    self._run_compiled(plan, tr)
+                    report = await self._schedule(plan).run_async(concurrency=concurrency)
+
+        self.applied = plan.snapshot()
+
+        self.log.info(f"Topology instanciated in {report.wall_time:.3f}s")
+        return report
+
+
+    async def remove_async(self):
+        self.log.info("Remove topology")
+
+        with self.session, trace.phase("remove"):
+            if self.journal.entries:
+                await to_thread(self.journal.replay)
+
+            else:
+                async with ovs.transaction_async():
+                    await asyncio.gather(*(obj.remove_async() for obj in self.objects.values()))
+                await asyncio.gather(*(l.remove_async() for l in self.links))
+
+        self.applied = None
+
+
+    async def up_async(self):
+        self.log.info("Up topology")
+
+        with self.session:
+            await asyncio.gather(*(obj.up_async() for obj in self.objects.values()))
+
+
+    async def down_async(self):
+        self.log.info("Down topology")
+
+        with self.session:
+            await asyncio.gather(*(obj.down_async() for obj in self.objects.values()))
+
+
+    async def wait_ready_async(self, timeout: float = 10.0, endpoints=None):
+        return await to_thread(self.wait_ready, timeout, endpoints)
+
 
-        # Instanciate objects
-        for n, obj in self.objects.items():
-            obj.instanciate()
\ No newline at end of file
+    async def wait_converged_async(self, timeout: float = 60.0, interval: float = 0.2):
+        return await to_thread(self.wait_converged, timeout, interval)
\ No newline at end of file
@@ -0,0 +1,499 @@
+"""
+========================
+Topology execution plans
+========================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+A plan is the result of resolving a whole topology without touching the
+host: link type of each connection, interface names, network namespaces,
+addresses and object configurations. Every connection and object is checked,
+and all problems are reported at once in a `Plan_Error`, before anything is
+created.
+
+Plans are immutable: the same plan can be executed, compared or saved as a
+reconcile snapshot. The ovs-vsctl commands of the objects are compiled in the
+plan, and executed as is.
+
+Plans can be kept on disk with a `Plan_Cache`, keyed by the content hash
+of the topology: instanciating the same topology again loads the plan
+instead of resolving and checking everything again.
+
+.. code:: python
+
+    try:
+        plan = topo.plan()
+    except Plan_Error as exc:
+        for msg in exc.errors:
+            print(msg)
+
+    topo.instanciate() # Executes topo.plan()
+"""
+
+import hashlib
+import ipaddress
+import json
+import logging
+import os
+import re
+import tempfile
+
+from dataclasses               import dataclass
+from pathlib                   import Path
+from types                     import MappingProxyType
+from typing                    import FrozenSet, Mapping, Optional, Tuple
+
+from pyxnet.topology           import reconcile as rec
+from pyxnet.platform.tools     import ovs, tc
+from pyxnet.platform.journal   import Resource_Journal
+
+
+FORMAT = 2
+"""Version of the plan contents, part of the content hash"""
+
+
+##############################
+# Errors
+##############################
+
+class Plan_Error(ValueError):
+    """
+    Raised when a topology cannot be planned. All the problems found
+    are listed in errors.
+    """
+
+    def __init__(self, errors):
+        self.errors = tuple(errors)
+        super().__init__(f"{len(self.errors)} errors in topology:\n" + "\n".join(f"- {x}" for x in self.errors))
+
+
+##############################
+# Value checks
+##############################
+
+__mac_re = re.compile(r"^[0-9a-fA-F]{2}(:[0-9a-fA-F]{2}){5}$")
+
+
+def check_mac(addr: str):
+    """
+    Returns why a MAC address cannot be given to an interface, or None
+    """
+
+    if not isinstance(addr, str) or not __mac_re.match(addr):
+        return f"Invalid MAC address {addr!r}"
+    elif int(addr[:2], 16) & 0x01:
+        return f"MAC address {addr} is a multicast address"
+    return None
+
+
+def check_ip(addr: str):
+    """
+    Returns why an interface address (e.g. 10.0.0.1/24) is invalid, or None
+    """
+
+    try:
+        ipaddress.ip_interface(addr)
+    except (ValueError, TypeError):
+        return f"Invalid IP address {addr!r}"
+    return None
+
+
+def _check_endpoint(endp):
+    res = list()
+
+    mac = endp.get_property("mac_addr")
+    ip  = endp.get_property("ip_addr")
+    imp = endp.get_property("impairment")
+
+    for err in (
+        check_mac(mac) if mac is not None else None,
+        check_ip(ip) if ip is not None else None,
+        tc.check_impairment(imp) if imp is not None else None,
+    ):
+        if err is not None:
+            res.append(f"{endp.path}: {err}")
+
+    return res
+
+
+##############################
+# Plan
+##############################
+
+def _freeze(value):
+    # Values are fresh JSON compatible values, from reconcile._jsonable() or
+    # a cache file: dicts can be wrapped without copy. Most of them are flat.
+    if type(value) in rec._scalars:
+        return value
+    elif isinstance(value, dict):
+        if rec._scalars.issuperset(map(type, value.values())):
+            return MappingProxyType(value)
+        return MappingProxyType({k: (v if type(v) in rec._scalars else _freeze(v)) for k, v in value.items()})
+    elif isinstance(value, list):
+        return tuple(_freeze(x) for x in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, Mapping):
+        return {k: _thaw(v) for k, v in value.items()}
+    elif isinstance(value, tuple):
+        return [_thaw(x) for x in value]
+    return value
+
+
+@dataclass(frozen=True)
+class Object_Spec:
+    name: str
+    type: str
+    """Qualified name of the object class"""
+
+    config: Mapping
+    """Output of the object's describe()"""
+
+
+@dataclass(frozen=True)
+class Link_Spec:
+    key: str
+    """See reconcile.link_key()"""
+
+    a: str
+    b: str
+    a_ifname: Optional[str]
+    b_ifname: Optional[str]
+    a_netns: Optional[str]
+    b_netns: Optional[str]
+    properties: Mapping
+    """Endpoint properties, by endpoint path"""
+
+    link: Optional[Mapping]
+    """Description of the link to create, None if there is nothing to create"""
+
+    @property
+    def kind(self):
+        return self.link["type"] if self.link is not None else None
+
+
+@dataclass(frozen=True)
+class Plan:
+    name: str
+    namespaces: Tuple[str, ...]
+    """Network namespaces to create, sorted"""
+
+    objects: Tuple[Object_Spec, ...]
+    links: Tuple[Link_Spec, ...]
+
+    version: int
+    """Topology version the plan was made from"""
+
+    commands: Tuple[Tuple[str, ...], ...] = ()
+    """ovs-vsctl commands of the compiled objects"""
+
+    hooks: Tuple[Tuple[str, str], ...]    = ()
+    """Commit hooks of the compiled objects, as (object name, method name)"""
+
+    records: Tuple[Mapping, ...]          = ()
+    """Journal entries of the compiled objects"""
+
+    compiled: FrozenSet[str]              = frozenset()
+    """Objects which instanciation is in commands, hooks and records"""
+
+    content_hash: Optional[str]           = None
+    """See content_hash()"""
+
+    def __str__(self):
+        kinds = dict()
+        for spec in self.links:
+            kinds[spec.kind] = kinds.get(spec.kind, 0) + 1
+
+        return (
+            f"{len(self.objects)} objects, {len(self.links)} connections ("
+            + ", ".join(f"{n} {kind or 'none'}" for kind, n in sorted(kinds.items(), key=lambda x: x[0] or ""))
+            + f"), {len(self.namespaces)} namespaces"
+        )
+
+    def snapshot(self):
+        """
+        Returns the plan as a reconcile snapshot
+        """
+
+        return {
+            "name"   : self.name,
+            "objects": {
+                spec.name: {"type": spec.type, "config": _thaw(spec.config)}
+                for spec in self.objects
+            },
+            "links"  : {
+                spec.key: {
+                    "a"         : spec.a,
+                    "b"         : spec.b,
+                    "a_ifname"  : spec.a_ifname,
+                    "b_ifname"  : spec.b_ifname,
+                    "properties": _thaw(spec.properties),
+                    "link"      : _thaw(spec.link),
+                }
+                for spec in self.links
+            },
+        }
+
+
+
+##############################
+# Compilation
+##############################
+
+def _defining_class(cls, attr):
+    for base in cls.__mro__:
+        if attr in vars(base):
+            return base
+    return None
+
+
+def _compilable(obj):
+    # The instanciation of the object must only be the commands: a subclass
+    # overriding instanciate() may do something else.
+    cmds_cls = _defining_class(type(obj), "_instanciate_commands")
+    inst_cls = _defining_class(type(obj), "instanciate")
+    return (cmds_cls is not None) and issubclass(cmds_cls, inst_cls)
+
+
+def _compile(topology, obj):
+    """
+    Returns the ovs-vsctl commands, commit hooks and journal entries of an
+    object instanciation, or None if they cannot be kept in a plan.
+    """
+
+    tr      = ovs.VSCtl_Transaction()
+    journal = Resource_Journal()
+    with journal:
+        obj._instanciate_commands(tr)
+
+    hooks = list()
+    for hook in tr.hooks:
+        owner = getattr(hook, "__self__", None)
+        if (owner is None) or (topology.objects.get(getattr(owner, "name", None), None) is not owner):
+            return None
+        hooks.append((owner.name, hook.__name__))
+
+    return tr.commands, hooks, journal.entries
+
+
+##############################
+# Build
+##############################
+
+def build(topology, version: int = 0):
+    """
+    Resolve a topology into a plan. Interface names are allocated from the
+    topology allocator, and link objects are set on the connections, but
+    nothing is done on the host.
+
+    :param version: Version of the topology, stored in the plan
+    :raises Plan_Error: with every problem found in the topology
+    """
+
+    errors = list()
+
+    # Endpoints that were disconnected since the last plan have no interface anymore
+    for obj in topology.objects.values():
+        obj._allocate_names(topology.names)
+        for endp in obj.endpoints:
+            endp._ifname = None
+
+    links = list()
+    for conn in topology.links:
+        try:
+            conn.resolve(netns=topology.netns, allocator=topology.names)
+        except (RuntimeError, ValueError) as exc:
+            errors.append(f"{conn.a.path} <-> {conn.b.path}: {exc}")
+            continue
+
+        errors.extend(_check_endpoint(conn.a))
+        errors.extend(_check_endpoint(conn.b))
+
+        links.append(conn)
+
+    # Objects are checked once their endpoints have interface names
+    for name, obj in topology.objects.items():
+        errors.extend(f"{name}: {msg}" for msg in obj._validate())
+
+    if errors:
+        raise Plan_Error(errors)
+
+    link_specs = list()
+    for conn in links:
+        entry = rec.link_entry(conn)
+        link_specs.append(Link_Spec(key=rec.link_key(conn), a_netns=conn.a.netns, b_netns=conn.b.netns, **_freeze(entry)))
+
+    commands = list()
+    hooks    = list()
+    records  = list()
+    compiled = set()
+    for name, obj in topology.objects.items():
+        res = _compile(topology, obj) if _compilable(obj) else None
+        if res is not None:
+            commands.extend(res[0])
+            hooks.extend(res[1])
+            records.extend(_freeze(x) for x in res[2])
+            compiled.add(name)
+
+    return Plan(
+        name       = topology.name,
+        namespaces = tuple(sorted(topology.namespaces())),
+        objects    = tuple(Object_Spec(name=name, **_freeze(rec.object_entry(obj))) for name, obj in topology.objects.items()),
+        links      = tuple(sorted(link_specs, key=lambda x: x.key)),
+        version    = version,
+        commands   = tuple(commands),
+        hooks      = tuple(hooks),
+        records    = tuple(records),
+        compiled   = frozenset(compiled),
+    )
+
+
+##############################
+# Content hash
+##############################
+
+def content_hash(topology):
+    """
+    Hash of everything a plan depends on: objects and their configuration,
+    endpoints and their properties, connections, topology name, network
+    namespace and interface names prefix.
+
+    Objects are only covered through their export_params() output, which
+    does not depend on the interface names allocated for them: nothing is
+    changed in the topology.
+
+    :raises TypeError: if a parameter or property cannot be written as JSON
+    """
+
+    content = [FORMAT, topology.name, topology.netns, topology.names.prefix, topology.names.salt]
+
+    for name in sorted(topology.objects):
+        obj = topology.objects[name]
+        content.append([name, rec._type_name(type(obj)), rec._jsonable(obj.export_params())])
+        content.append(sorted(
+            [endp.name, endp.kind.value, rec._jsonable(endp._properties) if endp._properties else None]
+            for endp in obj.endpoints
+        ))
+
+    content.append(sorted(rec.link_key(conn) for conn in topology.links))
+
+    # A single dump is much faster than one per object. Values are not
+    # written with str(), which can give a different key on each run.
+    try:
+        data = json.dumps(content, sort_keys=True).encode("utf-8")
+    except TypeError as exc:
+        raise TypeError(f"Cannot hash the contents of topology {topology.name}: {exc}")
+
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+##############################
+# On-disk cache
+##############################
+
+def default_cache_dir():
+    """
+    Directory of the plan cache: $PYXNET_PLAN_CACHE, or pyxnet/plans in
+    the user cache directory.
+    """
+
+    if os.environ.get("PYXNET_PLAN_CACHE"):
+        return Path(os.environ["PYXNET_PLAN_CACHE"])
+
+    base = os.environ.get("XDG_CACHE_HOME") or (Path.home() / ".cache")
+    return Path(base) / "pyxnet" / "plans"
+
+
+class Plan_Cache:
+    """
+    Plans saved as JSON files named after the content hash of their
+    topology, with the interface names allocated for them.
+
+    Loading a plan must be cheaper than building it: specs are saved as
+    rows instead of dicts, and commands as single strings.
+    """
+
+    def __init__(self, directory=None):
+        self.log       = logging.getLogger("Plan cache")
+        self.directory = Path(directory) if directory is not None else default_cache_dir()
+
+    def _path(self, key: str):
+        return self.directory / f"{key}.json"
+
+    @staticmethod
+    def _encode(plan: Plan):
+        return {
+            "format"    : FORMAT,
+            "name"      : plan.name,
+            "hash"      : plan.content_hash,
+            "namespaces": list(plan.namespaces),
+            "objects"   : [[x.name, x.type, _thaw(x.config)] for x in plan.objects],
+            "links"     : [
+                [x.key, x.a, x.b, x.a_ifname, x.b_ifname, x.a_netns, x.b_netns, _thaw(x.properties), _thaw(x.link)]
+                for x in plan.links
+            ],
+            "commands"  : ["\x1f".join(cmd) for cmd in plan.commands],
+            "hooks"     : [list(x) for x in plan.hooks],
+            "records"   : [_thaw(x) for x in plan.records],
+            "compiled"  : sorted(plan.compiled),
+        }
+
+    @staticmethod
+    def _decode(data: dict):
+        if data["format"] != FORMAT:
+            raise ValueError(f"Unsupported plan format {data['format']}")
+
+        return Plan(
+            name         = data["name"],
+            namespaces   = tuple(data["namespaces"]),
+            objects      = tuple(Object_Spec(name, type, _freeze(config)) for name, type, config in data["objects"]),
+            links        = tuple(Link_Spec(*row[:7], _freeze(row[7]), _freeze(row[8])) for row in data["links"]),
+            version      = 0,
+            commands     = tuple(tuple(cmd.split("\x1f")) for cmd in data["commands"]),
+            hooks        = tuple(tuple(x) for x in data["hooks"]),
+            records      = tuple(_freeze(x) for x in data["records"]),
+            compiled     = frozenset(data["compiled"]),
+            content_hash = data["hash"],
+        )
+
+    def load(self, key: str):
+        """
+        Returns the (plan, names) saved for a content hash, or None.
+        names is a dict giving the interface name of each allocator key.
+        """
+
+        path = self._path(key)
+        try:
+            with open(path, "r") as fhandle:
+                data = json.load(fhandle)
+            return self._decode(data["plan"]), data["names"]
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError) as exc:
+            self.log.warning(f"Ignoring invalid cached plan {path}: {exc}")
+            return None
+
+    def store(self, plan: Plan, names: dict):
+        """
+        Save a plan. The file is written atomically, so that concurrent
+        runs never read a partial plan.
+        """
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        data = {"plan": self._encode(plan), "names": names}
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as fhandle:
+                json.dump(data, fhandle)
+            os.replace(tmp, self._path(plan.content_hash))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def clear(self):
+        for path in self.directory.glob("*.json"):
+            path.unlink()
@@ -0,0 +1,368 @@
+"""
+================================
+Incremental topology application
+================================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+A snapshot is a plain, JSON compatible description of what a topology puts
+on the host: the configuration of each object, and the link created for
+each connection. Comparing the snapshot of the declared topology with the
+snapshot of what was applied before gives the minimal set of creations,
+updates and removals to do, instead of a full cleanup and instanciation.
+
+.. code:: python
+
+    topo.instanciate()
+
+    topo.connect(sw1.port3, sw2.port3)
+    topo.reconcile() # Only creates the new veth pair and adds the ports
+"""
+
+import importlib
+import json
+import logging
+
+from dataclasses              import dataclass, field, asdict, is_dataclass
+from enum                     import Enum
+from typing                   import Dict, List
+
+from pyxnet.platform.link     import Link, Link_VEth, Link_Phy, Link_Pipe, link_types, set_addresses
+from pyxnet.platform.tools    import ovs, netlink, tc, trace
+
+__log = logging.getLogger("Reconcile")
+
+
+##############################
+# Snapshots
+##############################
+
+_scalars = frozenset((str, int, float, bool, type(None)))
+
+
+def _jsonable(value):
+    """
+    Convert dataclasses, enums, sets and tuples to JSON compatible values,
+    so that snapshots compare equal once saved and loaded.
+    """
+
+    # Most values are scalars: check them first, snapshots of big topologies have a lot of them
+    if type(value) in _scalars:
+        return value
+    elif isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    elif is_dataclass(value) and not isinstance(value, type):
+        return _jsonable(asdict(value))
+    elif isinstance(value, Enum):
+        return value.value
+    elif isinstance(value, (list, tuple)):
+        return [_jsonable(x) for x in value]
+    elif isinstance(value, (set, frozenset)):
+        return sorted(_jsonable(x) for x in value)
+    else:
+        return value
+
+
+def _type_name(cls):
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def _type_from_name(name: str):
+    module, _, qualname = name.rpartition(".")
+    return getattr(importlib.import_module(module), qualname)
+
+
+def link_key(conn):
+    """
+    Key of a connection in snapshots. It does not depend on the order
+    of the endpoints.
+    """
+
+    return "|".join(sorted((conn.a.path, conn.b.path)))
+
+
+def object_entry(obj):
+    """
+    Snapshot entry of an object
+    """
+
+    return {
+        "type"  : _type_name(type(obj)),
+        "config": _jsonable(obj.describe()),
+    }
+
+
+def link_entry(conn):
+    """
+    Snapshot entry of a resolved connection
+    """
+
+    link_obj = conn.link_obj
+    return {
+        "a"         : conn.a.path,
+        "b"         : conn.b.path,
+        "a_ifname"  : conn.a._ifname,
+        "b_ifname"  : conn.b._ifname,
+        "properties": {
+            conn.a.path: _jsonable(conn.a.properties),
+            conn.b.path: _jsonable(conn.b.properties),
+        },
+        "link"      : _jsonable(link_obj.describe()) if link_obj is not None else None,
+    }
+
+
+def snapshot(topology):
+    """
+    Describe the platform state wanted by a topology. Connections are
+    resolved to know their link type and interface names, see
+    Topology.plan().
+
+    :return: dict with "name", "objects" and "links" keys
+    """
+
+    return topology.plan().snapshot()
+
+
+def empty_snapshot(name: str = None):
+    return {"name": name, "objects": dict(), "links": dict()}
+
+
+def save(snap: dict, path):
+    with open(path, "w") as fhandle:
+        json.dump(snap, fhandle, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path, "r") as fhandle:
+        return json.load(fhandle)
+
+
+def live(snap: dict):
+    """
+    Drop from a snapshot the objects and links that are not present on the
+    host anymore, so that they are created again.
+    """
+
+    with netlink.ipr() as ipr:
+        state = {
+            "interfaces": set(netlink.link_indexes(ipr).keys()),
+            "bridges"   : set(ovs.list_br()),
+        }
+
+    objects = {
+        name: x for name, x in snap["objects"].items()
+        if _type_from_name(x["type"])._described_live(name, x["config"], state)
+    }
+
+    links = {
+        key: x for key, x in snap["links"].items()
+        if (x["link"] is None) or Link.from_description(x["link"])._described_live(x["link"], state)
+    }
+
+    return {"name": snap["name"], "objects": objects, "links": links}
+
+
+##############################
+# Diff
+##############################
+
+@dataclass
+class Topology_Diff:
+    """
+    Operations to go from a snapshot to another
+    """
+
+    objects_create: List[str]          = field(default_factory=list)
+    objects_remove: Dict[str, dict]    = field(default_factory=dict)
+    """Removed objects, with their old description"""
+
+    objects_update: Dict[str, dict]    = field(default_factory=dict)
+    """Reconfigured objects, with their old description"""
+
+    links_create: List[str]            = field(default_factory=list)
+    links_remove: Dict[str, dict]      = field(default_factory=dict)
+    """Removed links, with their old description"""
+
+    links_update: Dict[str, dict]      = field(default_factory=dict)
+    """Links which impairments or addresses changed, with their old description"""
+
+    endpoints_update: List[str]        = field(default_factory=list)
+    """Paths of the endpoints which properties changed, with the same link"""
+
+    def __bool__(self):
+        return any((
+            self.objects_create, self.objects_remove, self.objects_update,
+            self.links_create  , self.links_remove  , self.links_update,
+            self.endpoints_update
+        ))
+
+    def __str__(self):
+        return (
+            f"objects: +{len(self.objects_create)} -{len(self.objects_remove)} ~{len(self.objects_update)}, "
+            f"links: +{len(self.links_create)} -{len(self.links_remove)} ~{len(self.links_update)}, "
+            f"endpoints: ~{len(self.endpoints_update)}"
+        )
+
+
+# Endpoint properties carried by the link description, and changed in place
+_in_place_properties = ("impairment", "ip_addr")
+
+
+def _structure(desc):
+    # Link description without what can be changed on the existing link
+    if desc is None:
+        return None
+
+    fields = link_types[desc["type"]].address_fields
+    return {k: v for k, v in desc.items() if not (k.endswith("impairment") or (k in fields))}
+
+
+def _without(props, keys):
+    return {k: v for k, v in props.items() if k not in keys}
+
+
+def diff(old: dict, new: dict):
+    """
+    Compute the operations to go from the old snapshot to the new one.
+    A link which description changed is removed then created again, unless
+    only its impairments or addresses changed (see Link.address_fields).
+    """
+
+    res = Topology_Diff()
+
+    # Objects
+    for name, desc in new["objects"].items():
+        if name not in old["objects"]:
+            res.objects_create.append(name)
+        elif old["objects"][name]["type"] != desc["type"]:
+            res.objects_remove[name] = old["objects"][name]
+            res.objects_create.append(name)
+        elif old["objects"][name]["config"] != desc["config"]:
+            res.objects_update[name] = old["objects"][name]
+
+    for name, desc in old["objects"].items():
+        if name not in new["objects"]:
+            res.objects_remove[name] = desc
+
+    # Links
+    for key, desc in new["links"].items():
+        old_desc = old["links"].get(key, None)
+        if old_desc is None:
+            res.links_create.append(key)
+        elif (_structure(old_desc["link"]) != _structure(desc["link"])) or (old_desc["a_ifname"], old_desc["b_ifname"]) != (desc["a_ifname"], desc["b_ifname"]):
+            res.links_remove[key] = old_desc
+            res.links_create.append(key)
+        else:
+            if old_desc["link"] != desc["link"]:
+                res.links_update[key] = old_desc
+
+            for path, props in desc["properties"].items():
+                old_props = old_desc["properties"].get(path, None) or dict()
+                if _without(old_props, _in_place_properties) != _without(props, _in_place_properties):
+                    res.endpoints_update.append(path)
+
+    for key, desc in old["links"].items():
+        if key not in new["links"]:
+            res.links_remove[key] = desc
+
+    return res
+
+
+##############################
+# Application
+##############################
+
+# Phy interfaces are configured before the pipes using them
+__link_order = {Link_Phy: 0, Link_VEth: 1, Link_Pipe: 2}
+
+
+def apply(topology, changes: Topology_Diff):
+    """
+    Apply a diff computed against the current state of a topology.
+    Everything that disappears is removed first, then new links are
+    created, then objects are created or reconfigured.
+
+    OpenvSwitch commands are sent in a single transaction.
+    """
+
+    conns = {link_key(conn): conn for conn in topology.links}
+
+    def _parent(path):
+        return topology.objects.get(path.partition("/")[0], None)
+
+    with topology.session, topology.journal:
+        with ovs.transaction():
+
+            # ---------------- Teardown
+
+            for name, desc in changes.objects_remove.items():
+                __log.info(f"Remove object {name}")
+                with trace.span("remove", tool="object", obj=name):
+                    _type_from_name(desc["type"])._remove_described(name, desc["config"])
+
+            for key, desc in changes.links_remove.items():
+                __log.info(f"Remove link {key}")
+                if desc["link"] is not None:
+                    link = Link.from_description(desc["link"])
+                    if isinstance(link, Link_Phy):
+                        # The former settings of the interface are in the journal only
+                        link._recorded(topology.journal.pop_settings(link.name))
+
+                    with trace.span("remove", tool="link", obj=key):
+                        link.remove()
+
+                # Ports of the objects that stay must be detached
+                for path, ifname in ((desc["a"], desc["a_ifname"]), (desc["b"], desc["b_ifname"])):
+                    obj = _parent(path)
+                    if (obj is not None) and (ifname is not None) and (obj.name not in changes.objects_remove):
+                        obj._endpoint_detach(ifname)
+
+            # ---------------- Build
+
+            created = [conns[key] for key in changes.links_create]
+            links   = sorted((c.link_obj for c in created if c.link_obj is not None), key=lambda x: __link_order[type(x)])
+
+            Link_VEth.instanciate_batch([x for x in links if isinstance(x, Link_VEth)])
+            for link in links:
+                if not isinstance(link, Link_VEth):
+                    link.instanciate()
+
+            # Impairments and addresses are changed in place
+            impairments = list()
+            addresses   = list()
+            for key, desc in changes.links_update.items():
+                __log.info(f"Update link {key} in place")
+                old_link = Link.from_description(desc["link"])
+                new_link = conns[key].link_obj
+
+                old_imps = {name: imp for name, _, imp in old_link.impairments()}
+                impairments.extend((name, ns, old_imps.get(name, None), imp) for name, ns, imp in new_link.impairments())
+
+                old_ips  = {name: ip for name, _, ip in old_link.addresses()}
+                addresses.extend((name, ns, old_ips.get(name, None), ip) for name, ns, ip in new_link.addresses())
+
+            set_addresses(addresses)
+            tc.apply(impairments)
+
+            for name in changes.objects_create:
+                __log.info(f"Create object {name}")
+                with trace.span("create", tool="object", obj=name):
+                    topology.objects[name].instanciate()
+
+            for name, desc in changes.objects_update.items():
+                __log.info(f"Reconfigure object {name}")
+                with trace.span("reconfigure", tool="object", obj=name):
+                    topology.objects[name].reconfigure(desc["config"])
+
+            # New ports on objects that were already there
+            rebuilt   = set(changes.objects_create) | set(changes.objects_update)
+            endpoints = [ep for conn in created for ep in (conn.a, conn.b)]
+            endpoints.extend(
+                ep for conn in conns.values() for ep in (conn.a, conn.b)
+                if ep.path in changes.endpoints_update
+            )
+
+            for ep in endpoints:
+                if ep.parent.name not in rebuilt:
+                    ep.parent._endpoint_attach(ep)
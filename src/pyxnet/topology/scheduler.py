@@ -0,0 +1,293 @@
+"""
+======================================
+Dependency aware operations scheduling
+======================================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+Operations on a topology (creating links, instanciating objects...) are
+described as nodes of a dependency graph. Nodes that do not depend on each
+other are run concurrently on a bounded thread pool, or as asyncio tasks,
+so that the total time follows the depth of the graph rather than the number
+of nodes.
+"""
+
+import asyncio
+import contextvars
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses        import dataclass, field
+from typing             import Callable, Dict, List, Optional, Set
+
+from pyxnet.platform.tools import to_thread, trace
+
+
+##############################
+# Schedule description
+##############################
+
+@dataclass
+class Schedule_Node:
+    name: str
+    action: Callable
+    deps: Set[str]                   = field(default_factory=set)
+    action_async: Optional[Callable] = None
+    """Coroutine function used by run_async(). If not given, action is run in the default executor."""
+
+    obj: Optional[str]               = None
+    """Path of the object or link the operation is done for, see pyxnet.platform.tools.trace"""
+
+
+@dataclass
+class Schedule_Report:
+    """
+    Timings of an executed schedule
+    """
+
+    timings: Dict[str, float]  = field(default_factory=dict)
+    """Duration of each node, in seconds"""
+
+    wall_time: float           = 0.0
+    """Total execution time, in seconds"""
+
+    def slowest(self, n: int = 10):
+        """
+        Returns the n slowest nodes as (name, duration) tuples
+        """
+
+        return sorted(self.timings.items(), key=lambda x: x[1], reverse=True)[:n]
+
+
+class Schedule:
+    """
+    A set of operations with dependencies between them
+    """
+
+    def __init__(self, name: str = "schedule"):
+        self.log   = logging.getLogger(f"Schedule {name}")
+        self.nodes = dict()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, name: str):
+        return name in self.nodes
+
+    def add(self, name: str, action: Callable, deps=(), action_async: Callable = None, obj: str = None):
+        """
+        Add an operation to the schedule.
+
+        :param name: Unique name of the operation
+        :param action: Callable with no argument
+        :param deps: Names of the operations that must be done before this one
+        :param action_async: Optional coroutine function for run_async()
+        :param obj: Path of the object the operation is done for, in traces
+        """
+
+        if name in self.nodes:
+            raise ValueError(f"Node {name} already in schedule")
+
+        node = Schedule_Node(name, action, set(deps), action_async, obj)
+        self.nodes[name] = node
+        return node
+
+    def depends(self, name: str, *deps):
+        """
+        Add dependencies to an existing node
+        """
+
+        self.nodes[name].deps.update(deps)
+
+
+    # ---------------- Graph helpers
+
+    def _graph(self):
+        """
+        Returns the dependents of each node, and the number of
+        dependencies of each node.
+        """
+
+        dependents = {name: [] for name in self.nodes}
+        pending    = dict()
+
+        for name, node in self.nodes.items():
+            unknown = node.deps - self.nodes.keys()
+            if unknown:
+                raise ValueError(f"Node {name} depends on unknown nodes: {', '.join(sorted(unknown))}")
+
+            pending[name] = len(node.deps)
+            for dep in node.deps:
+                dependents[dep].append(name)
+
+        return dependents, pending
+
+    def levels(self) -> List[List[str]]:
+        """
+        Returns the nodes grouped by depth in the dependency graph. Nodes
+        in the same level can be run concurrently.
+
+        :raises ValueError: if the dependency graph has a cycle
+        """
+
+        dependents, pending = self._graph()
+
+        levels  = []
+        current = [name for name, n in pending.items() if n == 0]
+        done    = 0
+        while current:
+            levels.append(current)
+            done += len(current)
+
+            nxt = []
+            for name in current:
+                for dep in dependents[name]:
+                    pending[dep] -= 1
+                    if pending[dep] == 0:
+                        nxt.append(dep)
+            current = nxt
+
+        if done != len(self.nodes):
+            raise ValueError("Dependency cycle in schedule")
+
+        return levels
+
+
+    # ---------------- Execution
+
+    def _timed(self, node, report):
+        t_start = time.perf_counter()
+        try:
+            with trace.span(node.name, tool="schedule", obj=node.obj):
+                node.action()
+        finally:
+            report.timings[node.name] = time.perf_counter() - t_start
+
+    def run(self, workers: int = None):
+        """
+        Run all operations, respecting dependencies.
+
+        The calling context (contextvars) is given to each operation, so that
+        active netlink sessions or ovs transactions are shared with the workers.
+
+        :param workers: Maximum number of concurrent operations. None uses the
+                        ThreadPoolExecutor default, 1 runs everything in the
+                        calling thread.
+        :return: A Schedule_Report
+        :raises: The first exception raised by an operation, once running
+                 operations are finished.
+        """
+
+        report  = Schedule_Report()
+        t_start = time.perf_counter()
+
+        if workers == 1:
+            for level in self.levels():
+                for name in level:
+                    self._timed(self.nodes[name], report)
+
+        else:
+            self.levels() # Check the graph before running anything
+
+            dependents, pending = self._graph()
+            ready   = [name for name, n in pending.items() if n == 0]
+            running = dict()
+            error   = None
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                while ready or running:
+                    if error is None:
+                        for name in ready:
+                            ctx = contextvars.copy_context()
+                            running[pool.submit(ctx.run, self._timed, self.nodes[name], report)] = name
+                    ready = []
+
+                    if not running:
+                        break
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for fut in finished:
+                        name = running.pop(fut)
+                        exc  = fut.exception()
+                        if exc is not None:
+                            self.log.error(f"Operation {name} failed: {exc}")
+                            error = error or exc
+                            continue
+
+                        for dep in dependents[name]:
+                            pending[dep] -= 1
+                            if pending[dep] == 0:
+                                ready.append(dep)
+
+            if error is not None:
+                raise error
+
+        report.wall_time = time.perf_counter() - t_start
+        self.log.debug(f"Executed {len(self.nodes)} operations in {report.wall_time:.3f}s")
+        for name, duration in report.slowest(5):
+            self.log.debug(f"> {name}: {duration:.3f}s")
+
+        return report
+
+
+    async def _timed_async(self, node, report, semaphore):
+        async with semaphore:
+            t_start = time.perf_counter()
+            try:
+                with trace.span(node.name, tool="schedule", obj=node.obj):
+                    if node.action_async is not None:
+                        await node.action_async()
+                    else:
+                        await to_thread(node.action)
+            finally:
+                report.timings[node.name] = time.perf_counter() - t_start
+
+    async def run_async(self, concurrency: int = None):
+        """
+        Same as run(), as asyncio tasks in the running event loop.
+
+        :param concurrency: Maximum number of operations in flight, None for no limit.
+        """
+
+        report  = Schedule_Report()
+        t_start = time.perf_counter()
+
+        dependents, pending = self._graph()
+        self.levels() # Check the graph before running anything
+
+        semaphore = asyncio.Semaphore(concurrency or max(len(self.nodes), 1))
+        running   = dict()
+        error     = None
+
+        def _start(name):
+            task = asyncio.ensure_future(self._timed_async(self.nodes[name], report, semaphore))
+            running[task] = name
+
+        for name, n in pending.items():
+            if n == 0:
+                _start(name)
+
+        while running:
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                name = running.pop(task)
+                exc  = task.exception()
+                if exc is not None:
+                    self.log.error(f"Operation {name} failed: {exc}")
+                    error = error or exc
+                    continue
+
+                if error is None:
+                    for dep in dependents[name]:
+                        pending[dep] -= 1
+                        if pending[dep] == 0:
+                            _start(dep)
+
+        if error is not None:
+            raise error
+
+        report.wall_time = time.perf_counter() - t_start
+        self.log.debug(f"Executed {len(self.nodes)} operations in {report.wall_time:.3f}s")
+        return report
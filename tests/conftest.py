@@ -0,0 +1,22 @@
+"""
+===============
+Shared fixtures
+===============
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+"""
+
+import pytest
+
+from benchmarks.stubs import Stub_Host, Stub_Latency
+
+
+@pytest.fixture
+def host():
+    """
+    Stand-in host without latency, see benchmarks/stubs.py
+    """
+
+    with Stub_Host(Stub_Latency(**{name: 0.0 for name in Stub_Latency.__dataclass_fields__})) as stub:
+        yield stub
@@ -0,0 +1,442 @@
+"""
+===============================
+Stand-in OVSDB server (RFC7047)
+===============================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+A small in-memory server speaking the OVSDB JSON-RPC protocol on a unix
+socket, so that pyxnet.platform.tools.ovsdb can be tested without
+openvswitch. It knows enough of the Open_vSwitch schema for the commands
+pyxnet translates: the Open_vSwitch, Bridge, Port and Interface tables,
+the unique names of bridges, ports and interfaces, and the garbage
+collection of the rows that are not referenced anymore.
+
+ovs-vswitchd is simulated by copying next_cfg to cur_cfg after each
+transaction, after cfg_delay seconds.
+
+.. code:: python
+
+    with OVSDB_Stub_Server(tmp_path / "db.sock") as server:
+        ovsdb.OVSDB_Client(server.path).transact(...)
+        server.bridges()
+"""
+
+import copy
+import json
+import os
+import socketserver
+import threading
+import uuid
+
+
+##############################
+# Schema
+##############################
+
+_DEFAULTS = {
+    "Open_vSwitch": lambda: {"bridges": ["set", []], "next_cfg": 0, "cur_cfg": 0},
+    "Bridge"      : lambda: {
+        "ports": ["set", []], "stp_enable": False, "rstp_enable": False,
+        "other_config": ["map", []], "external_ids": ["map", []],
+    },
+    "Port"        : lambda: {
+        "interfaces": ["set", []], "other_config": ["map", []], "external_ids": ["map", []],
+        "status": ["map", []], "rstp_status": ["map", []],
+    },
+    "Interface"   : lambda: {"type": "", "other_config": ["map", []], "external_ids": ["map", []]},
+}
+
+_REFERENCES = (
+    # (table, column, referenced table)
+    ("Open_vSwitch", "bridges"   , "Bridge"   ),
+    ("Bridge"      , "ports"     , "Port"     ),
+    ("Port"        , "interfaces", "Interface"),
+)
+
+_ROOTS   = ("Open_vSwitch",)
+_INDEXED = ("Bridge", "Port", "Interface") # Unique "name" column
+
+
+class _Op_Error(Exception):
+    def __init__(self, error, details=""):
+        super().__init__(error)
+        self.error   = error
+        self.details = details
+
+
+##############################
+# Values
+##############################
+
+def _atoms(value):
+    """Elements of a set column, or the single atom of a scalar column"""
+
+    if isinstance(value, list) and value and (value[0] == "set"):
+        return [_hashable(x) for x in value[1]]
+    return [_hashable(value)]
+
+
+def _hashable(value):
+    return tuple(_hashable(x) for x in value) if isinstance(value, list) else value
+
+
+def _unhashable(value):
+    return [_unhashable(x) for x in value] if isinstance(value, tuple) else value
+
+
+def _pairs(value):
+    if isinstance(value, list) and value and (value[0] == "map"):
+        return {_hashable(k): v for k, v in value[1]}
+    raise _Op_Error("syntax error", f"{value!r} is not a map")
+
+
+def _map(pairs: dict):
+    return ["map", [[_unhashable(k), v] for k, v in sorted(pairs.items(), key=lambda x: str(x[0]))]]
+
+
+def _set(atoms):
+    return ["set", [_unhashable(x) for x in atoms]]
+
+
+##############################
+# Database
+##############################
+
+class OVSDB_Stub_Database:
+    def __init__(self):
+        self.lock   = threading.Lock()
+        self.tables = {name: dict() for name in _DEFAULTS}
+
+        root = str(uuid.uuid4())
+        self.tables["Open_vSwitch"][root] = dict(_DEFAULTS["Open_vSwitch"](), _uuid=["uuid", root])
+
+    @property
+    def root(self):
+        return next(iter(self.tables["Open_vSwitch"].values()))
+
+    # -------- Conditions
+
+    def _matches(self, row, where):
+        for column, function, value in where:
+            current = row.get(column, None)
+            if   function == "==":
+                ok = _hashable(current) == _hashable(value)
+            elif function == "!=":
+                ok = _hashable(current) != _hashable(value)
+            elif function in ("includes", "excludes"):
+                if isinstance(value, list) and value and (value[0] == "map"):
+                    cur = _pairs(current) if current is not None else dict()
+                    ok  = all(cur.get(k, None) == v for k, v in _pairs(value).items())
+                else:
+                    ok  = set(_atoms(value)) <= set(_atoms(current))
+                ok = ok if function == "includes" else not ok
+            else:
+                raise _Op_Error("syntax error", f"Unsupported function {function}")
+
+            if not ok:
+                return False
+        return True
+
+    def _rows(self, tables, op):
+        if op["table"] not in tables:
+            raise _Op_Error("unknown table", op["table"])
+        return [row for row in tables[op["table"]].values() if self._matches(row, op.get("where", []))]
+
+    # -------- Operations
+
+    def _resolve(self, value, names):
+        if isinstance(value, list):
+            if (len(value) == 2) and (value[0] == "named-uuid"):
+                if value[1] not in names:
+                    raise _Op_Error("referential integrity violation", f"Unknown named-uuid {value[1]}")
+                return ["uuid", names[value[1]]]
+            return [self._resolve(x, names) for x in value]
+        elif isinstance(value, dict):
+            return {k: self._resolve(v, names) for k, v in value.items()}
+        return value
+
+    def _insert(self, tables, op, names):
+        row_uuid = str(uuid.uuid4())
+        if "uuid-name" in op:
+            names[op["uuid-name"]] = row_uuid
+
+        row = dict(_DEFAULTS[op["table"]](), _uuid=["uuid", row_uuid])
+        row.update(self._resolve(op["row"], names))
+        tables[op["table"]][row_uuid] = row
+        return {"uuid": ["uuid", row_uuid]}
+
+    def _select(self, tables, op, names):
+        columns = op.get("columns", None)
+        return {"rows": [
+            {k: copy.deepcopy(v) for k, v in row.items() if (columns is None) or (k in columns)}
+            for row in self._rows(tables, op)
+        ]}
+
+    def _update(self, tables, op, names):
+        rows = self._rows(tables, op)
+        for row in rows:
+            row.update(self._resolve(op["row"], names))
+        return {"count": len(rows)}
+
+    def _mutate(self, tables, op, names):
+        rows = self._rows(tables, op)
+        for row in rows:
+            for column, mutator, value in self._resolve(op["mutations"], names):
+                current = row.get(column, None)
+
+                if mutator in ("+=", "-="):
+                    row[column] = current + value if mutator == "+=" else current - value
+
+                elif isinstance(current, list) and current and (current[0] == "map"):
+                    pairs = _pairs(current)
+                    if mutator == "insert":
+                        # Existing keys are kept, as in ovsdb-server
+                        for k, v in _pairs(value).items():
+                            pairs.setdefault(k, v)
+                    elif mutator == "delete":
+                        keys = _pairs(value).keys() if value[0] == "map" else _atoms(value)
+                        for k in keys:
+                            pairs.pop(k, None)
+                    row[column] = _map(pairs)
+
+                else:
+                    atoms = _atoms(current) if current is not None else []
+                    for atom in _atoms(value):
+                        if (mutator == "insert") and (atom not in atoms):
+                            atoms.append(atom)
+                        elif (mutator == "delete") and (atom in atoms):
+                            atoms.remove(atom)
+                    row[column] = _set(atoms)
+
+        return {"count": len(rows)}
+
+    def _delete(self, tables, op, names):
+        rows = self._rows(tables, op)
+        for row in rows:
+            del tables[op["table"]][row["_uuid"][1]]
+        return {"count": len(rows)}
+
+    def _wait(self, tables, op, names):
+        # Conditions are checked once: waiting would block the other clients
+        columns = op.get("columns", None)
+        rows    = [
+            {k: v for k, v in row.items() if (columns is None) or (k in columns)}
+            for row in self._rows(tables, op)
+        ]
+        expected = [{k: v for k, v in row.items()} for row in op["rows"]]
+        equal    = _hashable([sorted(x.items()) for x in rows]) == _hashable([sorted(x.items()) for x in expected])
+
+        if equal != (op["until"] == "=="):
+            raise _Op_Error("timed out", f"wait on {op['table']}")
+        return {}
+
+    __operations = {
+        "insert": _insert,
+        "select": _select,
+        "update": _update,
+        "mutate": _mutate,
+        "delete": _delete,
+        "wait"  : _wait,
+    }
+
+    # -------- Commit
+
+    def _collect(self, tables):
+        # Rows of non root tables must be referenced to stay
+        for table, column, target in _REFERENCES:
+            live = {atom[1] for row in tables[table].values() for atom in _atoms(row.get(column, ["set", []])) if isinstance(atom, tuple)}
+            for row_uuid in list(tables[target]):
+                if (target not in _ROOTS) and (row_uuid not in live):
+                    del tables[target][row_uuid]
+
+    def _check(self, tables):
+        for table in _INDEXED:
+            names = [row.get("name", None) for row in tables[table].values()]
+            if len(names) != len(set(names)):
+                raise _Op_Error("constraint violation", f"Duplicate name in table {table}")
+
+    def transact(self, ops):
+        """
+        Run operations atomically: nothing is changed if one of them fails
+        """
+
+        with self.lock:
+            tables  = copy.deepcopy(self.tables)
+            names   = dict()
+            results = list()
+
+            for op in ops:
+                try:
+                    handler = self.__operations.get(op["op"], None)
+                    if handler is None:
+                        raise _Op_Error("unknown operation", op["op"])
+                    results.append(handler(self, tables, op, names))
+                except _Op_Error as exc:
+                    results.append({"error": exc.error, "details": exc.details})
+                    results.extend([None] * (len(ops) - len(results)))
+                    return results, False
+
+            try:
+                self._collect(tables)
+                self._check(tables)
+            except _Op_Error as exc:
+                results.append({"error": exc.error, "details": exc.details})
+                return results, False
+
+            changed = (tables != self.tables)
+            self.tables = tables
+            return results, changed
+
+
+##############################
+# Server
+##############################
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server  = self.server.stub
+        decoder = json.JSONDecoder()
+        buffer  = ""
+
+        server.connections += 1
+        while True:
+            try:
+                chunk = self.request.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+
+            buffer += chunk.decode("utf-8")
+            while True:
+                data = buffer.lstrip()
+                try:
+                    msg, end = decoder.raw_decode(data)
+                except json.JSONDecodeError:
+                    break # Incomplete message
+                buffer = data[end:]
+                self._message(server, msg)
+
+    def _send(self, server, msg):
+        data = json.dumps(msg).encode("utf-8")
+        step = server.chunk_size or len(data)
+        for i in range(0, len(data), step):
+            self.request.sendall(data[i:i+step])
+
+    def _message(self, server, msg):
+        method = msg.get("method", None)
+
+        # Reply to an echo request sent by the server
+        if method is None:
+            server.echo_replies.append(msg)
+            return
+
+        server.requests.append(msg)
+
+        if   method == "echo":
+            result = msg["params"]
+        elif method == "list_dbs":
+            result = ["Open_vSwitch"]
+        elif method == "transact":
+            result = server.transact(msg["params"][1:])
+        else:
+            self._send(server, {"id": msg["id"], "result": None, "error": f"unknown method {method}"})
+            return
+
+        if server.send_echo:
+            self._send(server, {"method": "echo", "params": ["ping"], "id": f"echo{len(server.requests)}"})
+
+        self._send(server, {"id": msg["id"], "result": result, "error": None})
+
+
+class _Unix_Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class OVSDB_Stub_Server:
+    """
+    In-memory OVSDB server on a unix socket, served from a thread
+
+    :param path: Socket path
+    :param cfg_delay: Time taken by the simulated ovs-vswitchd to apply
+                      a configuration, in seconds
+    :param chunk_size: Split the messages sent to the clients in chunks
+                       of this size, to check the framing
+    :param send_echo: Send an echo request before each response
+    """
+
+    def __init__(self, path, cfg_delay: float = 0.0, chunk_size: int = None, send_echo: bool = False):
+        self.path         = str(path)
+        self.cfg_delay    = cfg_delay
+        self.chunk_size   = chunk_size
+        self.send_echo    = send_echo
+
+        self.db           = OVSDB_Stub_Database()
+        self.requests     = list()
+        self.echo_replies = list()
+        self.connections  = 0
+
+        self._server      = None
+        self._thread      = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self._server      = _Unix_Server(self.path, _Handler)
+        self._server.stub = self
+        self._thread      = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            os.unlink(self.path)
+
+    def transact(self, ops):
+        results, changed = self.db.transact(ops)
+        if changed:
+            self._vswitchd()
+        return results
+
+    def _vswitchd(self):
+        def _apply():
+            with self.db.lock:
+                root = self.db.root
+                root["cur_cfg"] = root["next_cfg"]
+
+        if self.cfg_delay > 0:
+            threading.Timer(self.cfg_delay, _apply).start()
+        else:
+            _apply()
+
+    # -------- Inspection
+
+    def rows(self, table):
+        with self.db.lock:
+            return copy.deepcopy(list(self.db.tables[table].values()))
+
+    def row(self, table, name):
+        return next((row for row in self.rows(table) if row.get("name", None) == name), None)
+
+    def bridges(self):
+        return sorted(row["name"] for row in self.rows("Bridge"))
+
+    def ports(self, bridge):
+        br    = self.row("Bridge", bridge)
+        uuids = {atom[1] for atom in _atoms(br["ports"])}
+        return sorted(row["name"] for row in self.rows("Port") if row["_uuid"][1] in uuids)
+
+    def map_of(self, table, name, column):
+        return {k: v for k, v in _pairs(self.row(table, name)[column]).items()}
@@ -0,0 +1,119 @@
+"""
+=======================
+Topology graph analysis
+=======================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+"""
+
+from pyxnet.topology                  import analysis
+from pyxnet.topology.endpoint         import Endpoint_Kind
+from pyxnet.topology.objects.switch   import Switch
+from pyxnet.topology.objects.topology import Topology
+
+from benchmarks.topologies            import ring
+
+
+def graph(edges, extra=()):
+    # Topology of switches, with a new port for each side of each edge
+    topo  = Topology(name="test")
+    objs  = dict()
+    conns = list()
+
+    for name in [x for edge in edges for x in edge] + list(extra):
+        if name not in objs:
+            objs[name] = Switch(name)
+            topo.register(objs[name])
+
+    for a, b in edges:
+        ports = [
+            objs[x]._endpoint_register(f"p{len(objs[x].endpoints)}", Endpoint_Kind.Virtual)
+            for x in (a, b)
+        ]
+        conns.append(topo.connect(*ports))
+
+    return topo, conns
+
+
+# Tree: r - a - (c, d), r - b
+TREE = [("r", "a"), ("r", "b"), ("a", "c"), ("a", "d")]
+
+# Two triangles joined by a link
+DUMBBELL = [("a", "b"), ("b", "c"), ("c", "a"), ("c", "d"), ("d", "e"), ("e", "f"), ("f", "d")]
+
+
+def test_ring():
+    topo  = ring(5)
+    names = set(topo.objects)
+
+    assert analysis.loops(topo) == (frozenset(names),)
+    assert analysis.has_loop(topo)
+    assert analysis.articulation_links(topo) == set()
+    assert analysis.articulation_objects(topo) == set()
+    assert analysis.components(topo) == (frozenset(names),)
+
+    # A single failure does not split a ring, two do
+    conns = list(topo.links)
+    assert analysis.split_by(topo, conns[:1]) == []
+    assert len(analysis.split_by(topo, conns[:2])[0]) == 2
+
+
+def test_tree():
+    topo, conns = graph(TREE)
+
+    assert analysis.loops(topo) == ()
+    assert not analysis.has_loop(topo)
+    assert analysis.articulation_links(topo) == set(conns)
+    assert analysis.articulation_objects(topo) == {"r", "a"}
+
+    assert analysis.neighbours(topo, "a") == {"r", "c", "d"}
+    assert [len(x) for x in (analysis.shortest_path(topo, "c", "b"), analysis.shortest_path(topo, "c", "d"))] == [3, 2]
+    assert analysis.shortest_path(topo, "c", "c") == []
+
+    parts = analysis.split_by(topo, [conns[0]])
+    assert sorted(parts[0], key=len) == [{"r", "b"}, {"a", "c", "d"}]
+    assert analysis.reachable(topo, "r", without=[conns[0]]) == {"r", "b"}
+
+
+def test_dumbbell():
+    topo, conns = graph(DUMBBELL)
+
+    assert set(analysis.loops(topo)) == {frozenset("abc"), frozenset("def")}
+    assert analysis.articulation_links(topo) == {conns[3]}
+    assert analysis.articulation_objects(topo) == {"c", "d"}
+
+
+def test_parallel_links():
+    # Two links between the same objects are a loop
+    topo, conns = graph([("a", "b"), ("a", "b"), ("b", "c")])
+
+    assert analysis.loops(topo) == (frozenset("ab"),)
+    assert analysis.articulation_links(topo) == {conns[2]}
+
+
+def test_components():
+    topo, conns = graph(TREE + [("x", "y")], extra=["z"])
+
+    assert analysis.components(topo) == (frozenset("rabcd"), frozenset("xy"), frozenset("z"))
+    assert analysis.component_of(topo, "y") == frozenset("xy")
+    assert analysis.shortest_path(topo, "r", "x") is None
+    assert not analysis.has_loop(topo)
+
+
+def test_cache():
+    topo, conns = graph(TREE)
+    assert not analysis.loops(topo)
+
+    # Results follow the changes of the topology
+    ports = [
+        topo.objects[x]._endpoint_register("px", Endpoint_Kind.Virtual)
+        for x in ("c", "b")
+    ]
+    topo.connect(*ports)
+
+    assert analysis.loops(topo) == (frozenset("rabc"),)
+    assert analysis.articulation_links(topo) == {conns[3]}
+
+    topo.disconnect(*ports)
+    assert analysis.loops(topo) == ()
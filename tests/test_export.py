@@ -0,0 +1,106 @@
+"""
+==========================
+Topology export and import
+==========================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+"""
+
+import io
+
+import pytest
+
+from pyxnet.topology                  import export
+from pyxnet.topology.endpoint         import Endpoint_Kind
+from pyxnet.topology.objects.phy      import Phy
+from pyxnet.topology.objects.switch   import Switch
+from pyxnet.topology.objects.topology import Topology
+
+from benchmarks.topologies            import ring
+
+
+def sample():
+    # Switches with parameters and endpoint properties, in several groups
+    topo = Topology(name="sample")
+    objs = [
+        Switch(f"sw{i}", ip_addr=f"10.0.1.{i+1}/24", stp_config={"rstp_enabled": True, "bridge_priority": 0x1000 * (i+1)})
+        for i in range(3)
+    ]
+
+    for sw in objs:
+        for name in ("p0", "p1"):
+            setattr(sw, name, sw._endpoint_register(name, Endpoint_Kind.Virtual))
+
+    objs[0].p1.properties.update(ip_addr="10.0.0.1/24", impairment={"delay": 5, "rate": "10mbit"})
+    objs[1].p0.properties.update(mac_addr="02:00:00:00:00:01", stp_config={"path_cost": 10})
+    objs[2].p2 = objs[2]._endpoint_register("p2", Endpoint_Kind.Virtual)
+
+    topo.register_many(objs[:2], group="core")
+    topo.register_many([objs[2], Phy("eth", ifname="eth0")])
+    topo.connect_many([
+        (objs[0].p1, objs[1].p0),
+        (objs[1].p1, objs[2].p0),
+        (objs[2].p1, objs[0].p0),
+        (objs[2].p2, topo.objects["eth"].ep),
+    ])
+
+    return topo
+
+
+def links(topo):
+    return {frozenset((conn.a.path, conn.b.path)) for conn in topo.links}
+
+
+def check_same(topo, other):
+    assert other.name == topo.name
+    assert other.content_hash() == topo.content_hash()
+    assert links(other) == links(topo)
+    assert {group: set(items) for group, items in other.groups.items()} \
+        == {group: set(items) for group, items in topo.groups.items()}
+
+
+@pytest.mark.parametrize("make", [sample, lambda: ring(4)])
+def test_json(tmp_path, make):
+    topo = make()
+    path = tmp_path / "topo.json"
+
+    with open(path, "w") as fhandle:
+        export.write_json(topo, fhandle)
+
+    check_same(topo, export.load_json(path))
+
+
+@pytest.mark.parametrize("make", [sample, lambda: ring(4)])
+def test_graphml(make):
+    topo = make()
+    out  = io.StringIO()
+
+    export.write_graphml(topo, out)
+    out.seek(0)
+
+    check_same(topo, export.load_graphml(out))
+
+
+def test_description():
+    topo = sample()
+    desc = export.to_dict(topo)
+
+    assert desc["name"] == "sample"
+    assert len(desc["objects"]) == 4 and len(desc["links"]) == 4
+
+    sw0 = next(spec for spec in desc["objects"] if spec["name"] == "sw0")
+    assert sw0["group"] == "core"
+    assert sw0["params"]["ip_addr"] == "10.0.1.1/24"
+    assert [ep["name"] for ep in sw0["endpoints"]] == ["p0", "p1"]
+
+
+def test_networkx():
+    pytest.importorskip("networkx")
+
+    topo  = sample()
+    graph = export.to_networkx(topo)
+
+    assert graph.number_of_nodes() == 4
+    assert graph.number_of_edges() == 4
+    check_same(topo, export.from_networkx(graph))
@@ -0,0 +1,98 @@
+"""
+================
+Resource journal
+================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+"""
+
+import json
+
+from pyxnet.platform                  import cleanup, journal
+from pyxnet.platform.journal          import Resource_Journal
+
+from benchmarks.topologies            import ring
+
+
+def test_load_truncated(tmp_path):
+    path = tmp_path / "journal.jsonl"
+
+    with Resource_Journal(path) as jr:
+        journal.record("bridge", "pxn-br0")
+        journal.record("veth", "pxn-a", netns=None, peer="pxn-b", peer_netns=None)
+
+    # A crash while writing leaves a truncated line
+    with open(path, "a") as fhandle:
+        fhandle.write('{"kind": "bri')
+
+    assert Resource_Journal.load(path).entries == jr.entries
+    assert journal.current() is None
+
+
+def test_pop_settings(tmp_path):
+    path = tmp_path / "journal.jsonl"
+
+    with Resource_Journal(path) as jr:
+        journal.record("mac", "eth0", address="02:00:00:00:00:01")
+        journal.record("veth", "pxn-a")
+        journal.record("ip", "eth0", address="10.0.0.1/24")
+
+    assert [x["kind"] for x in jr.pop_settings("eth0")] == ["mac", "ip"]
+    assert jr.pop_settings("eth0") == []
+
+    with open(path, "r") as fhandle:
+        assert [json.loads(x) for x in fhandle] == [{"kind": "veth", "name": "pxn-a"}]
+
+
+def test_recover(host, tmp_path):
+    path = tmp_path / "journal.jsonl"
+    topo = ring(4, journal_path=path)
+    topo.instanciate()
+
+    assert len(host.bridges) == 4
+    assert journal.recover(path)
+
+    assert host.bridges == set()
+    assert not [x for x in host.links[None] if x.startswith("pxn")]
+    assert not path.exists()
+    assert not journal.recover(path)
+
+
+def test_replay_restores(host):
+    eth0   = host.links[None]["eth0"] = host.new_link("eth0", "ether")
+    former = eth0["address"]
+
+    jr = Resource_Journal()
+    with jr:
+        journal.record("mac", "eth0", address=former)
+        journal.record("ip", "eth0", address="10.0.0.1/24")
+        journal.record("qdisc", "eth0")
+        journal.record("ip", "missing", address="10.0.0.2/24")
+
+    eth0["address"] = "02:00:00:00:00:aa"
+    host.set_address(None, "eth0", "10.0.0.1/24", True)
+    host.set_address(None, "eth0", "10.0.0.3/24", True)
+
+    jr.replay()
+
+    assert eth0["address"] == former
+    assert host.addresses[(None, "eth0")] == {"10.0.0.3/24"}
+    assert len(jr) == 0
+
+
+def test_remove_netns_groups(host, monkeypatch):
+    # Interfaces in namespaces are removed by group, as on journal replay.
+    # The first group picked is used by an interface of the namespace.
+    links = host.links["ns1"] = dict()
+    links["pxn-a"] = host.new_link("pxn-a", "veth", "pxn-b")
+    links["pxn-b"] = host.new_link("pxn-b", "veth", "pxn-a")
+    links["other"] = host.new_link("other", "dummy")
+    links["other"].attrs["IFLA_GROUP"] = 7
+
+    groups = iter([7, 8])
+    monkeypatch.setattr(cleanup.random, "randint", lambda a, b: next(groups))
+
+    cleanup.remove_resources(cleanup.Cleanup_Resources(netns_interfaces={"ns1": {"pxn-a": None}}))
+
+    assert list(host.links["ns1"]) == ["other"]
@@ -0,0 +1,102 @@
+"""
+=========================
+Interface name allocation
+=========================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+"""
+
+import pytest
+
+from pyxnet.platform.tools.names import Name_Allocator, IFNAMSIZ
+
+from benchmarks.topologies       import ring
+
+
+def test_readable():
+    names = Name_Allocator()
+
+    assert names.allocate("sw1/p0") == "pxn-sw1-p0"
+    assert names.allocate("sw1/p0") == "pxn-sw1-p0"
+    assert names.allocate("sw1", hint="bridge1") == "pxn-bridge1"
+    assert names.key_of("pxn-sw1-p0") == "sw1/p0"
+    assert len(names) == 2
+
+
+def test_hashed():
+    names = Name_Allocator()
+    long  = names.allocate("a_very_long_switch_name/port0")
+
+    assert long.startswith("pxn-") and len(long) == IFNAMSIZ - 1
+    assert names.allocate("a_very_long_switch_name/port0") == long
+
+    # Readable names already taken get a hashed one
+    names.reserve("pxn-eth0")
+    assert names.allocate("eth0") != "pxn-eth0"
+    assert len(names.allocate("eth0")) == IFNAMSIZ - 1
+
+
+def test_salt():
+    a = Name_Allocator(salt="ns1")
+    b = Name_Allocator(salt="ns2")
+
+    assert a.allocate("sw1/p0") != b.allocate("sw1/p0")
+    assert a.allocate("sw1/p0") == Name_Allocator(salt="ns1").allocate("sw1/p0")
+
+
+def test_prefix_too_long():
+    with pytest.raises(ValueError):
+        Name_Allocator(prefix="a-much-too-long-")
+
+
+def test_reserve_release():
+    names = Name_Allocator()
+    names.reserve("pxn-x", key="x")
+
+    with pytest.raises(ValueError, match="already used by x"):
+        names.reserve("pxn-x")
+
+    names.release("x")
+    assert "x" not in names
+    assert names.key_of("pxn-x") is None
+
+    names.release("x")
+    names.reserve("pxn-x")
+
+
+def test_state_restore():
+    names = Name_Allocator()
+    for key in ("sw0/p0", "sw0/p1", "a_very_long_switch_name/port0"):
+        names.allocate(key)
+    state = names.state()
+
+    other = Name_Allocator()
+    assert other.restore(state)
+    assert other.state() == state
+    assert other.restore(state)
+
+    # Names or keys used differently are not restored, and nothing changes
+    conflict = Name_Allocator()
+    conflict.allocate("other", hint="sw0-p1")
+    assert not conflict.restore(state)
+    assert conflict.state() == {"other": "pxn-sw0-p1"}
+
+    conflict = Name_Allocator()
+    conflict.reserve("pxn-sw0-p0x", key="sw0/p0")
+    assert not conflict.restore(state)
+
+
+def test_topology_release():
+    topo = ring(3)
+    topo.plan()
+    sw2  = topo.objects["sw2"]
+
+    assert {"sw2", "sw2/p0", "sw2/p1"} <= topo.names.state().keys()
+
+    topo.unregister(sw2)
+    assert not ({"sw2", "sw2/p0", "sw2/p1", "sw0/p0", "sw1/p1"} & topo.names.state().keys())
+
+    topo.disconnect(topo.objects["sw0"].p1, topo.objects["sw1"].p0)
+    assert not ({"sw0/p1", "sw1/p0"} & topo.names.state().keys())
+    assert topo.names.state().keys() == {"sw0", "sw1"}
@@ -0,0 +1,393 @@
+"""
+========================
+OVSDB client and backend
+========================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+
+pyxnet.platform.tools.ovsdb against the stand-in server of
+tests/ovsdb_server.py.
+"""
+
+import json
+import os
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+import pytest
+
+from pyxnet.platform.tools import ovs, ovsdb
+
+from .ovsdb_server         import OVSDB_Stub_Server
+
+
+##############################
+# Fixtures
+##############################
+
+@pytest.fixture
+def sock_dir():
+    # Unix socket paths are limited to 108 characters: pytest tmp_path may be too long
+    with tempfile.TemporaryDirectory(prefix="pxn-ovsdb") as path:
+        yield path
+
+
+@pytest.fixture
+def server(sock_dir):
+    with OVSDB_Stub_Server(os.path.join(sock_dir, "db.sock")) as srv:
+        yield srv
+
+
+@pytest.fixture
+def backend(server, monkeypatch):
+    """
+    ovs.vsctl() sent to the stand-in server
+    """
+
+    monkeypatch.setenv("OVS_RUNDIR", os.path.dirname(server.path))
+    ovsdb.client(server.path)
+
+    previous = ovs.get_backend()
+    ovs.set_backend("ovsdb")
+    yield server
+    ovs.set_backend(previous)
+
+
+@pytest.fixture
+def fake_vsctl(tmp_path, monkeypatch):
+    """
+    ovs-vsctl executable recording its arguments, for the fallback
+    """
+
+    log    = tmp_path / "calls.json"
+    script = tmp_path / "ovs-vsctl"
+    script.write_text(
+        "#!/bin/sh\n"
+        f"python3 -c 'import json, sys; print(json.dumps(sys.argv[1:]))' \"$@\" >> {log}\n"
+        "echo fallback\n"
+    )
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+    return log
+
+
+def _calls(log):
+    return [json.loads(line) for line in log.read_text().splitlines()] if log.exists() else []
+
+
+##############################
+# JSON-RPC client
+##############################
+
+def test_connect_error(sock_dir):
+    with pytest.raises(ovsdb.OVSDB_Error, match="Cannot connect"):
+        ovsdb.OVSDB_Client(os.path.join(sock_dir, "missing.sock")).list_dbs()
+
+
+def test_echo(server):
+    with ovsdb.OVSDB_Client(server.path) as cl:
+        assert cl.call("echo", ["hello", 1]) == ["hello", 1]
+        assert cl.list_dbs() == ["Open_vSwitch"]
+
+
+def test_framing_split_messages(sock_dir):
+    # Responses arrive a few bytes at a time, after an echo request
+    with OVSDB_Stub_Server(os.path.join(sock_dir, "db.sock"), chunk_size=3, send_echo=True) as server:
+        with ovsdb.OVSDB_Client(server.path) as cl:
+            for i in range(3):
+                assert cl.call("echo", [f"msg{i}"]) == [f"msg{i}"]
+            rows = cl.select("Open_vSwitch", columns=["next_cfg"])
+
+        assert rows == [{"next_cfg": 0}]
+
+        # Each echo request of the server got its reply
+        deadline = time.monotonic() + 2
+        while (len(server.echo_replies) < 4) and (time.monotonic() < deadline):
+            time.sleep(0.01)
+        assert [x["result"] for x in server.echo_replies] == [["ping"]] * 4
+        assert [x["id"] for x in server.echo_replies] == [f"echo{i}" for i in range(1, 5)]
+
+
+def test_framing_coalesced_messages():
+    # Several messages in a single read, the last one incomplete
+    cl = ovsdb.OVSDB_Client("unused")
+    cl._sock, peer = socket.socketpair()
+    cl._pid        = os.getpid()
+
+    try:
+        first  = json.dumps({"id": 0, "result": ["a"], "error": None})
+        second = json.dumps({"id": 1, "result": {"x": "}{"}, "error": None})
+        peer.sendall((first + "\n" + second[:10]).encode("utf-8"))
+
+        assert cl._recv() == {"id": 0, "result": ["a"], "error": None}
+
+        peer.sendall(second[10:].encode("utf-8"))
+        assert cl._recv() == {"id": 1, "result": {"x": "}{"}, "error": None}
+
+        peer.close()
+        with pytest.raises(ovsdb.OVSDB_Error, match="Connection closed"):
+            cl._recv()
+    finally:
+        cl.close()
+
+
+def test_framing_split_characters():
+    # Multibyte characters split between two reads
+    cl = ovsdb.OVSDB_Client("unused")
+    cl._sock, peer = socket.socketpair()
+    cl._pid        = os.getpid()
+
+    try:
+        data = json.dumps({"id": 0, "result": ["pxn-é€"], "error": None}, ensure_ascii=False).encode("utf-8")
+        cut  = data.index("é".encode("utf-8")) + 1
+
+        peer.sendall(data[:cut])
+        threading.Timer(0.05, peer.sendall, (data[cut:],)).start()
+        assert cl._recv() == {"id": 0, "result": ["pxn-é€"], "error": None}
+    finally:
+        peer.close()
+        cl.close()
+
+
+def test_stale_responses_dropped():
+    cl = ovsdb.OVSDB_Client("unused")
+    cl._sock, peer = socket.socketpair()
+    cl._pid        = os.getpid()
+
+    try:
+        # Response of a previous request, a notification, then the response
+        peer.sendall(b'{"id": 41, "result": 1, "error": null}')
+        peer.sendall(b'{"id": null, "method": "update", "params": []}')
+        peer.sendall(b'{"id": 0, "result": 2, "error": null}')
+        assert cl.call("echo", []) == 2
+
+        peer.sendall(b'{"id": 1, "result": null, "error": "unknown method"}')
+        with pytest.raises(ovsdb.OVSDB_Error, match="unknown method"):
+            cl.call("foo", [])
+    finally:
+        peer.close()
+        cl.close()
+
+
+def test_reconnect_after_fork(server):
+    cl = ovsdb.OVSDB_Client(server.path)
+    assert cl.list_dbs() == ["Open_vSwitch"]
+    parent_sock = cl._sock
+
+    rfd, wfd = os.pipe()
+    pid      = os.fork()
+    if pid == 0:
+        # Child: the inherited socket must not be used, nor closed
+        try:
+            ok = (cl.call("echo", ["child"]) == ["child"]) and (cl._sock is not parent_sock)
+            os.write(wfd, b"1" if ok else b"0")
+        finally:
+            os._exit(0)
+
+    os.close(wfd)
+    os.waitpid(pid, 0)
+    assert os.read(rfd, 1) == b"1"
+    os.close(rfd)
+
+    assert cl._sock is parent_sock
+    assert cl.call("echo", ["parent"]) == ["parent"]
+    assert server.connections == 2
+    cl.close()
+
+
+def test_transaction_error(server):
+    with ovsdb.OVSDB_Client(server.path) as cl:
+        with pytest.raises(ovsdb.OVSDB_Error, match="Operation select on Nope failed: unknown table"):
+            cl.transact({"op": "select", "table": "Nope", "where": []})
+
+        with pytest.raises(ovsdb.OVSDB_Error, match="custom message"):
+            cl.transact(
+                {"op": "select", "table": "Bridge", "where": []},
+                {"op": "wait", "table": "Bridge", "where": [], "columns": ["name"], "until": "!=", "rows": [], "timeout": 0},
+                errors={1: "custom message"},
+            )
+
+
+def test_wait_reconfigured(sock_dir):
+    with OVSDB_Stub_Server(os.path.join(sock_dir, "db.sock"), cfg_delay=0.2) as server:
+        with ovsdb.OVSDB_Client(server.path) as cl:
+            t_start = time.monotonic()
+            ovsdb_vsctl(cl, "add-br", "br0")
+            assert time.monotonic() - t_start >= 0.2
+
+            root = server.rows("Open_vSwitch")[0]
+            assert root["cur_cfg"] == root["next_cfg"] == 1
+
+
+def ovsdb_vsctl(cl, *args):
+    # vsctl() on a given client instead of the process wide one
+    saved = ovsdb.client
+    ovsdb.client = lambda path=None: cl
+    try:
+        return ovsdb.vsctl(*args)
+    finally:
+        ovsdb.client = saved
+
+
+##############################
+# ovs-vsctl commands translation
+##############################
+
+def test_add_br(backend):
+    ovs.vsctl("add-br", "br0")
+
+    assert backend.bridges() == ["br0"]
+    assert backend.ports("br0") == ["br0"]
+    assert backend.row("Interface", "br0")["type"] == "internal"
+    assert backend.rows("Open_vSwitch")[0]["next_cfg"] == 1
+
+    # Existing bridge
+    ovs.vsctl("--may-exist", "add-br", "br0")
+    assert backend.bridges() == ["br0"]
+
+    with pytest.raises(ovs.OVS_Error, match="constraint violation"):
+        ovs.vsctl("add-br", "br0")
+
+
+def test_del_br(backend):
+    ovs.vsctl("add-br", "br0", "--", "add-br", "br1", "--", "add-port", "br1", "p0")
+    ovs.vsctl("del-br", "br1")
+
+    # Ports and interfaces go with the bridge
+    assert backend.bridges() == ["br0"]
+    assert backend.row("Port", "p0") is None
+    assert backend.row("Interface", "p0") is None
+
+    ovs.vsctl("--if-exists", "del-br", "br1")
+    with pytest.raises(ovs.OVS_Error, match="no bridge named br1"):
+        ovs.vsctl("del-br", "br1")
+
+
+def test_del_br_moved_ports(backend):
+    ovs.vsctl("add-br", "br0", "--", "add-port", "br0", "p0")
+
+    # Ports of a bridge deleted earlier in the transaction can be added again
+    ovs.vsctl("del-br", "br0", "--", "--may-exist", "add-br", "br1", "--", "--may-exist", "add-port", "br1", "p0")
+
+    assert backend.bridges() == ["br1"]
+    assert backend.ports("br1") == ["br1", "p0"]
+
+
+def test_list_br(backend):
+    ovs.vsctl("add-br", "br1", "--", "add-br", "br0")
+
+    ret = ovs.vsctl("list-br")
+    assert ret.stdout == b"br0\nbr1\n"
+    assert ovs.list_br() == ["br0", "br1"]
+
+
+def test_add_port(backend):
+    ovs.vsctl("add-br", "br0", "--", "add-port", "br0", "p0", "other_config:rstp-port-num=3")
+
+    assert backend.ports("br0") == ["br0", "p0"]
+    assert backend.map_of("Port", "p0", "other_config") == {"rstp-port-num": "3"}
+
+    ovs.vsctl("--may-exist", "add-port", "br0", "p0")
+    assert backend.ports("br0") == ["br0", "p0"]
+
+    with pytest.raises(ovs.OVS_Error):
+        ovs.vsctl("add-port", "br0", "p0")
+
+
+def test_add_port_missing_bridge(backend):
+    # As with ovs-vsctl, instead of adding ports that are garbage collected
+    with pytest.raises(ovs.OVS_Error, match="no bridge named br1"):
+        ovs.vsctl("add-port", "br1", "p0")
+    with pytest.raises(ovs.OVS_Error, match="no bridge named br1"):
+        ovs.vsctl("--may-exist", "add-port", "br1", "p0")
+
+    assert backend.row("Port", "p0") is None
+
+    # Bridges added earlier in the transaction are found
+    ovs.vsctl("add-br", "br1", "--", "add-port", "br1", "p0")
+    assert backend.ports("br1") == ["br1", "p0"]
+
+
+def test_del_port(backend):
+    ovs.vsctl("add-br", "br0", "--", "add-port", "br0", "p0", "--", "add-port", "br0", "p1")
+
+    ovs.vsctl("del-port", "br0", "p0")
+    ovs.vsctl("del-port", "p1") # Bridge found from the port
+
+    assert backend.ports("br0") == ["br0"]
+    assert backend.row("Port", "p1") is None
+
+    ovs.vsctl("--if-exists", "del-port", "br0", "p0")
+    with pytest.raises(ovs.OVS_Error, match="no port named p0"):
+        ovs.vsctl("del-port", "br0", "p0")
+
+
+def test_set(backend):
+    ovs.vsctl("add-br", "br0")
+    ovs.vsctl("set", "Bridge", "br0", "stp_enable=true", "other_config:stp-priority=0x8000", "external_ids:pyxnet-topology=t")
+    ovs.vsctl("set", "Bridge", "br0", "other_config:stp-priority=0x1000")
+
+    br = backend.row("Bridge", "br0")
+    assert br["stp_enable"] is True
+    assert backend.map_of("Bridge", "br0", "other_config") == {"stp-priority": "0x1000"}
+    assert ovs.find_br("pyxnet-topology", "t") == ["br0"]
+
+
+def test_set_missing_row(backend):
+    ovs.vsctl("add-br", "br0")
+
+    # Map keys and columns of a missing row fail, as with ovs-vsctl, and nothing is applied
+    with pytest.raises(ovs.OVS_Error, match='no row "p0" in table Port'):
+        ovs.vsctl("set", "Bridge", "br0", "other_config:a=1", "--", "set", "Port", "p0", "other_config:rstp-port-num=1")
+    with pytest.raises(ovs.OVS_Error, match='no row "br1" in table Bridge'):
+        ovs.vsctl("set", "Bridge", "br1", "stp_enable=true")
+
+    assert backend.map_of("Bridge", "br0", "other_config") == {}
+
+    ovs.vsctl("--if-exists", "set", "Bridge", "br1", "other_config:a=1")
+
+
+def test_remove(backend):
+    ovs.vsctl("add-br", "br0")
+    ovs.vsctl("set", "Bridge", "br0", "other_config:rstp-address=02:00:00:00:00:01", "other_config:stp-priority=0x1000")
+    ovs.vsctl("remove", "Bridge", "br0", "other_config", "rstp-address")
+
+    assert backend.map_of("Bridge", "br0", "other_config") == {"stp-priority": "0x1000"}
+
+    with pytest.raises(ovs.OVS_Error, match='no row "br1" in table Bridge'):
+        ovs.vsctl("remove", "Bridge", "br1", "other_config", "rstp-address")
+    ovs.vsctl("--if-exists", "remove", "Bridge", "br1", "other_config", "rstp-address")
+
+
+def test_transaction(backend):
+    # A whole topology transaction is a single OVSDB transaction
+    with ovs.transaction() as tr:
+        tr.add("--may-exist", "add-br", "br0")
+        tr.add("set", "Bridge", "br0", "rstp_enable=true")
+        tr.add("--may-exist", "add-port", "br0", "p0")
+        tr.add("set", "Port", "p0", "other_config:rstp-path-cost=2")
+
+    transacts = [x for x in backend.requests if x["method"] == "transact"]
+    assert sum(1 for x in transacts if any(op["op"] == "insert" for op in x["params"][1:])) == 1
+    assert backend.row("Bridge", "br0")["rstp_enable"] is True
+    assert backend.map_of("Port", "p0", "other_config") == {"rstp-path-cost": "2"}
+
+
+def test_unsupported_fallback(backend, fake_vsctl):
+    # Unknown commands and options go to the ovs-vsctl process
+    ret = ovs.vsctl("--bare", "--columns=name", "find", "Bridge", "external_ids:a=b")
+    assert ret.stdout == b"fallback\n"
+
+    # The whole call falls back, nothing is sent to the server
+    ovs.vsctl("add-br", "br0", "--", "get", "Bridge", "br0", "name")
+    assert backend.bridges() == []
+
+    assert _calls(fake_vsctl) == [
+        ["--bare", "--columns=name", "find", "Bridge", "external_ids:a=b"],
+        ["add-br", "br0", "--", "get", "Bridge", "br0", "name"],
+    ]
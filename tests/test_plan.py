@@ -0,0 +1,149 @@
+"""
+========================
+Topology execution plans
+========================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+"""
+
+import pytest
+
+from pyxnet.topology                  import plan as tplan
+from pyxnet.topology.plan             import Plan_Error, Plan_Cache
+
+from benchmarks.topologies            import ring
+
+
+def test_compile():
+    topo = ring(3)
+    plan = topo.plan()
+
+    assert [spec.name for spec in plan.objects] == ["sw0", "sw1", "sw2"]
+    assert {spec.kind for spec in plan.links} == {"veth"}
+    assert plan.compiled == {"sw0", "sw1", "sw2"}
+    assert ("--may-exist", "add-br", "pxn-sw0") in plan.commands
+    assert plan.content_hash == topo.content_hash()
+    assert str(plan) == "3 objects, 3 connections (3 veth), 0 namespaces"
+
+
+def test_errors():
+    topo = ring(3)
+    topo.objects["sw0"].ip_addr = "10.0.0.300/24"
+    topo.objects["sw1"].p0.properties["mac_addr"] = "not a mac"
+    topo.disconnect(topo.objects["sw1"].p1, topo.objects["sw2"].p0)
+
+    # All the problems are reported at once
+    with pytest.raises(Plan_Error) as exc:
+        topo.plan()
+    assert len(exc.value.errors) >= 4
+
+
+def test_kept():
+    topo = ring(3)
+    assert topo.plan() is topo.plan()
+
+    topo.invalidate()
+    plan = topo.plan()
+    assert plan is topo.plan()
+
+    topo.unregister("sw2")
+    topo.connect(topo.objects["sw1"].p1, topo.objects["sw0"].p0)
+    assert topo.plan() is not plan
+
+
+@pytest.mark.parametrize("edit", [
+    lambda topo: topo.objects["sw0"].p1.properties.update(ip_addr="10.0.0.1/24"),
+    lambda topo: topo.objects["sw0"].p1.properties.update(impairment={"delay": 10}),
+    lambda topo: setattr(topo.objects["sw1"].stp_config, "bridge_priority", 0x1000),
+    lambda topo: setattr(topo.objects["sw1"], "mac_addr", "02:00:00:00:00:01"),
+])
+def test_direct_edit(edit):
+    # Direct edits are found without invalidate()
+    topo = ring(3)
+    plan = topo.plan()
+
+    edit(topo)
+    assert topo.plan() is not plan
+    assert topo.plan().snapshot() != plan.snapshot()
+
+
+def test_kept_without_hash(monkeypatch):
+    topo = ring(3)
+    plan = topo.plan()
+
+    # Nothing changed: the contents are not hashed again
+    def fail(*args, **kwargs):
+        raise AssertionError("contents hashed again")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(tplan, "content_hash", fail)
+        assert topo.plan() is plan
+
+    # Edits of other topologies only cost a hash
+    ring(2).objects["sw0"].ip_addr = "10.0.0.1/24"
+    assert topo.plan() is plan
+
+
+def test_instanciate_kept(host, monkeypatch):
+    topo = ring(3)
+    topo.instanciate()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("contents hashed again")
+
+    monkeypatch.setattr(tplan, "content_hash", fail)
+    assert not topo.reconcile()
+
+
+def test_content_hash():
+    a = ring(3)
+    b = ring(3)
+    assert a.content_hash() == b.content_hash()
+
+    b.objects["sw2"].p0.properties["ip_addr"] = "10.0.0.1/24"
+    assert a.content_hash() != b.content_hash()
+    assert ring(3, netns="ns1").content_hash() != a.content_hash()
+
+
+def test_content_hash_pure():
+    topo = ring(3)
+    key  = topo.content_hash()
+
+    # No names are allocated, and the hash does not depend on them
+    assert len(topo.names) == 0
+    topo.plan()
+    assert topo.content_hash() == key
+
+
+def test_content_hash_unknown_value():
+    topo = ring(3)
+    topo.objects["sw0"].p0.properties["extra"] = object()
+
+    with pytest.raises(TypeError, match="Cannot hash the contents of topology bench"):
+        topo.content_hash()
+
+
+def test_cache(tmp_path, monkeypatch):
+    first = ring(3, plan_cache=tmp_path)
+    plan  = first.plan()
+    assert (tmp_path / f"{plan.content_hash}.json").exists()
+
+    # A copy of the topology loads the plan, with the same names
+    def fail(*args, **kwargs):
+        raise AssertionError("plan built again")
+
+    monkeypatch.setattr(tplan, "build", fail)
+    other = ring(3, plan_cache=tmp_path)
+
+    assert other.plan().snapshot() == plan.snapshot()
+    assert other.names.state() == first.names.state()
+    assert other.objects["sw0"].p1.ifname == first.objects["sw0"].p1.ifname
+
+
+def test_cache_invalid(tmp_path):
+    cache = Plan_Cache(tmp_path)
+    (tmp_path / "bad.json").write_text("{")
+
+    assert cache.load("bad") is None
+    assert cache.load("missing") is None
@@ -0,0 +1,213 @@
+"""
+================================
+Incremental topology application
+================================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+"""
+
+from pyxnet.topology                  import reconcile as rec
+from pyxnet.topology.endpoint         import Endpoint_Kind
+from pyxnet.topology.objects.phy      import Phy
+from pyxnet.topology.objects.switch   import Switch
+from pyxnet.topology.objects.topology import Topology
+
+from benchmarks.topologies            import Bench_Switch, ring_pairs
+
+
+def ring(n: int = 2):
+    # All the switch ports must be connected
+    topo = Topology(name="test")
+    objs = [Bench_Switch(f"sw{i}") for i in range(n)]
+
+    topo.register_many(objs)
+    topo.connect_many(ring_pairs(objs))
+
+    return topo, objs
+
+
+def shrink(topo, objs):
+    # Remove the last switch of the ring
+    topo.unregister(objs[-1])
+    topo.connect(objs[-2].p1, objs[0].p0)
+
+
+def ifindex(host, ifname):
+    return host.links[None][ifname]["index"]
+
+
+# ---------------- Diff
+
+def test_diff_empty():
+    topo, _ = ring(3)
+    snap    = topo.snapshot()
+
+    assert not rec.diff(snap, snap)
+
+
+def test_diff_create_remove():
+    topo, objs = ring(3)
+    old        = topo.snapshot()
+
+    shrink(topo, objs)
+    changes = rec.diff(old, topo.snapshot())
+
+    assert changes.objects_create == []
+    assert list(changes.objects_remove) == ["sw2"]
+    assert sorted(changes.links_remove) == ["sw0/p0|sw2/p1", "sw1/p1|sw2/p0"]
+    assert changes.links_create == ["sw0/p0|sw1/p1"]
+
+    changes = rec.diff(topo.snapshot(), old)
+    assert changes.objects_create == ["sw2"]
+    assert list(changes.links_remove) == ["sw0/p0|sw1/p1"]
+
+
+def test_diff_address_in_place():
+    topo, objs = ring()
+    old        = topo.snapshot()
+
+    objs[0].p1.properties["ip_addr"] = "10.0.0.1/24"
+    changes = rec.diff(old, topo.snapshot())
+
+    assert list(changes.links_update) == ["sw0/p1|sw1/p0"]
+    assert (changes.links_create, changes.links_remove, changes.endpoints_update) == ([], {}, [])
+
+
+def test_diff_object_update():
+    topo, objs = ring()
+    old        = topo.snapshot()
+
+    objs[0].ip_addr = "10.0.1.1/24"
+    changes = rec.diff(old, topo.snapshot())
+
+    assert changes.objects_update == {"sw0": old["objects"]["sw0"]}
+
+
+def test_snapshot_roundtrip(tmp_path):
+    topo, objs = ring(3)
+    objs[0].p1.properties["impairment"] = {"delay": 10}
+
+    rec.save(topo.snapshot(), tmp_path / "snap.json")
+    assert not rec.diff(rec.load(tmp_path / "snap.json"), topo.snapshot())
+
+
+# ---------------- Apply
+
+def test_reconcile_new_link(host):
+    topo, objs = ring(3)
+    topo.instanciate()
+
+    # Insert a switch in the ring
+    extra = Bench_Switch("sw3")
+    topo.register(extra)
+    topo.disconnect(objs[2].p1, objs[0].p0)
+    topo.connect_many([(objs[2].p1, extra.p0), (extra.p1, objs[0].p0)])
+
+    changes = topo.reconcile()
+    assert changes.objects_create == ["sw3"]
+    assert sorted(changes.links_create) == ["sw0/p0|sw3/p1", "sw2/p1|sw3/p0"]
+    assert extra.ifname in host.bridges
+    assert extra.p0.ifname in host.links[None]
+
+    assert not topo.reconcile()
+
+
+def test_reconcile_remove(host):
+    topo, objs = ring(3)
+    topo.instanciate()
+
+    removed = (objs[1].p1.ifname, objs[0].p0.ifname)
+    shrink(topo, objs)
+    topo.reconcile()
+
+    assert objs[2].ifname not in host.bridges
+    assert ["--if-exists", "del-port", objs[1].ifname, removed[0]] in host.commands
+    assert ["--if-exists", "del-port", objs[0].ifname, removed[1]] in host.commands
+
+
+def test_reconcile_address(host):
+    topo, objs = ring()
+    ep         = objs[0].p1
+
+    ep.properties["ip_addr"] = "10.0.0.1/24"
+    topo.instanciate()
+    index = ifindex(host, ep.ifname)
+    assert host.addresses[(None, ep.ifname)] == {"10.0.0.1/24"}
+
+    # The veth pair stays, only its address changes
+    ep.properties["ip_addr"] = "10.0.0.2/24"
+    changes = topo.reconcile()
+
+    assert list(changes.links_update) == ["sw0/p1|sw1/p0"]
+    assert host.addresses[(None, ep.ifname)] == {"10.0.0.2/24"}
+    assert ifindex(host, ep.ifname) == index
+
+    del ep.properties["ip_addr"]
+    topo.reconcile()
+
+    assert host.addresses[(None, ep.ifname)] == set()
+
+
+def test_reconcile_switch_settings(host):
+    topo, objs = ring()
+    sw         = objs[0]
+
+    sw.mac_addr = "02:00:00:00:00:01"
+    sw.ip_addr  = "10.0.1.1/24"
+    topo.instanciate()
+    assert host.addresses[(None, sw.ifname)] == {"10.0.1.1/24"}
+
+    sw.mac_addr = None
+    sw.ip_addr  = "10.0.1.2/24"
+    host.commands.clear()
+    topo.reconcile()
+
+    assert ["remove", "Bridge", sw.ifname, "other_config", "rstp-address"] in host.commands
+    assert host.addresses[(None, sw.ifname)] == {"10.0.1.2/24"}
+
+
+def test_switch_renamed(host):
+    topo, objs = ring()
+    sw         = objs[0]
+    topo.instanciate()
+
+    host.vsctl("add-br", "oldbr")
+    host.commands.clear()
+    sw.reconfigure(dict(sw.describe(), ifname="oldbr"))
+
+    assert "oldbr" not in host.bridges
+    assert sw.ifname in host.bridges
+    assert ["--may-exist", "add-port", sw.ifname, sw.p1.ifname] in host.commands
+
+
+def test_reconcile_phy_restored(host):
+    eth0   = host.links[None]["eth0"] = host.new_link("eth0", "ether")
+    former = eth0["address"]
+
+    sw = Switch("sw")
+    sw.p0 = sw._endpoint_register("p0", Endpoint_Kind.Virtual)
+    sw.p0.properties.update(mac_addr="02:00:00:00:00:aa", ip_addr="10.0.0.1/24")
+
+    topo = Topology(name="test")
+    topo.register_many([sw, Phy("eth", ifname="eth0")])
+    topo.connect(sw.p0, topo.objects["eth"].ep)
+    topo.instanciate()
+
+    assert eth0["address"] == "02:00:00:00:00:aa"
+    assert host.addresses[(None, "eth0")] == {"10.0.0.1/24"}
+
+    # The link is configured again: the added address goes away
+    sw.p0.properties["ip_addr"] = "10.0.0.2/24"
+    topo.reconcile()
+
+    assert host.addresses[(None, "eth0")] == {"10.0.0.2/24"}
+    assert eth0["address"] == "02:00:00:00:00:aa"
+
+    # The interface gets its settings back when the link is removed
+    topo.unregister(sw)
+    topo.reconcile()
+
+    assert host.addresses[(None, "eth0")] == set()
+    assert eth0["address"] == former
+    assert topo.journal.pop_settings("eth0") == []
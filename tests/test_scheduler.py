@@ -0,0 +1,154 @@
+"""
+=====================
+Operations scheduling
+=====================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+"""
+
+import asyncio
+import threading
+
+import pytest
+
+from pyxnet.topology.scheduler import Schedule
+
+from benchmarks.topologies     import ring
+
+
+def diamond(log):
+    #   a
+    #  / \
+    # b   c
+    #  \ /
+    #   d
+    schedule = Schedule("diamond")
+    for name, deps in (("a", ()), ("b", ("a",)), ("c", ("a",)), ("d", ("b", "c"))):
+        schedule.add(name, lambda name=name: log.append(name), deps)
+    return schedule
+
+
+# ---------------- Graph
+
+def test_levels():
+    schedule = diamond([])
+
+    assert [sorted(level) for level in schedule.levels()] == [["a"], ["b", "c"], ["d"]]
+
+
+def test_levels_independent():
+    schedule = Schedule()
+    for i in range(4):
+        schedule.add(f"n{i}", lambda: None)
+
+    assert len(schedule.levels()) == 1
+
+
+def test_cycle():
+    schedule = Schedule()
+    schedule.add("a", lambda: None, ["c"])
+    schedule.add("b", lambda: None, ["a"])
+    schedule.add("c", lambda: None, ["b"])
+    schedule.add("d", lambda: None)
+
+    with pytest.raises(ValueError, match="cycle"):
+        schedule.levels()
+
+
+def test_cycle_not_run():
+    ran      = []
+    schedule = Schedule()
+    schedule.add("free", lambda: ran.append("free"))
+    schedule.add("a", lambda: ran.append("a"), ["b"])
+    schedule.add("b", lambda: ran.append("b"), ["a"])
+
+    for workers in (1, 4):
+        with pytest.raises(ValueError):
+            schedule.run(workers=workers)
+
+    with pytest.raises(ValueError):
+        asyncio.run(schedule.run_async())
+
+    assert ran == []
+
+
+def test_unknown_dependency():
+    schedule = Schedule()
+    schedule.add("a", lambda: None, ["missing"])
+
+    with pytest.raises(ValueError, match="missing"):
+        schedule.levels()
+
+
+def test_duplicate():
+    schedule = Schedule()
+    schedule.add("a", lambda: None)
+
+    with pytest.raises(ValueError):
+        schedule.add("a", lambda: None)
+
+
+# ---------------- Execution
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_run_order(workers):
+    log    = []
+    report = diamond(log).run(workers=workers)
+
+    assert log[0] == "a" and log[-1] == "d"
+    assert sorted(log[1:3]) == ["b", "c"]
+    assert set(report.timings) == {"a", "b", "c", "d"}
+
+
+def test_run_concurrent():
+    # Both nodes of the level must run at the same time to pass the barrier
+    barrier  = threading.Barrier(2, timeout=5)
+    schedule = Schedule()
+    schedule.add("a", barrier.wait)
+    schedule.add("b", barrier.wait)
+
+    schedule.run(workers=2)
+
+
+def test_run_error():
+    ran      = []
+    schedule = Schedule()
+
+    def fail():
+        raise RuntimeError("failed")
+
+    schedule.add("a", fail)
+    schedule.add("b", lambda: ran.append("b"), ["a"])
+
+    with pytest.raises(RuntimeError, match="failed"):
+        schedule.run(workers=2)
+
+    assert ran == []
+
+
+def test_run_async():
+    log      = []
+    schedule = diamond(log)
+
+    async def d():
+        log.append("d async")
+
+    schedule.nodes["d"].action_async = d
+    report = asyncio.run(schedule.run_async(concurrency=2))
+
+    assert log[0] == "a" and log[-1] == "d async"
+    assert set(report.timings) == {"a", "b", "c", "d"}
+
+
+# ---------------- Topology schedule
+
+def test_topology_schedule(host):
+    topo = ring(4)
+
+    # Veths are one batch, switches are compiled in the ovs transaction
+    assert set(topo._schedule(topo.plan()).nodes) == {"links/veth"}
+
+    report = topo.instanciate(workers=2)
+    assert set(report.timings) == {"links/veth"}
+    assert len(host.bridges) == 4
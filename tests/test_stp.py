@@ -0,0 +1,82 @@
+"""
+=========================
+Spanning tree convergence
+=========================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+"""
+
+import pytest
+
+from pyxnet.platform.tools          import ovs
+from pyxnet.topology.objects        import switch
+from pyxnet.topology.objects.switch import STP_Wait_Error, wait_stp_converged
+
+from benchmarks.topologies          import ring
+
+
+@pytest.mark.parametrize("state, role, stable, settled", [
+    ("Forwarding", "Designated", False, True ),
+    ("forwarding", None        , False, True ),
+    ("Discarding", "Alternate" , False, True ),
+    ("Discarding", "Backup"    , False, True ),
+    ("Discarding", "Designated", True , False),
+    ("Discarding", "Root"      , True , False),
+    ("blocking"  , "alternate" , False, True ),
+    ("blocking"  , "designated", True , False),
+    ("blocking"  , None        , False, False),
+    ("blocking"  , None        , True , True ),
+    ("listening" , None        , True , False),
+    ("Learning"  , "Root"      , True , False),
+    ("disabled"  , None        , False, True ),
+    ("Discarding", "Disabled"  , False, True ),
+    (None        , None        , True , False),
+])
+def test_settled(state, role, stable, settled):
+    assert switch._stp_settled(state, role, stable) == settled
+
+
+def rstp_status(topo, states):
+    # ovs.port_status() output, with the (state, role) of p0 and p1 of every switch
+    return {
+        endp.ifname: {"status": {}, "rstp_status": {"rstp_port_state": state, "rstp_port_role": role}}
+        for obj in topo.objects.values() for endp, (state, role) in zip((obj.p0, obj.p1), states)
+    }
+
+
+def test_wait(monkeypatch):
+    topo = ring(3)
+    topo.plan()
+
+    checks = iter([
+        rstp_status(topo, [("Learning", "Designated"), ("Discarding", "Root")]),
+        rstp_status(topo, [("Forwarding", "Designated"), ("Discarding", "Alternate")]),
+    ])
+    monkeypatch.setattr(ovs, "port_status", lambda *args: next(checks))
+
+    wait_stp_converged(topo.objects.values(), timeout=1, interval=0.01)
+
+
+def test_wait_down_ports(monkeypatch):
+    topo = ring(3)
+    topo.plan()
+
+    status = rstp_status(topo, [("Disabled", "Disabled"), ("Forwarding", "Root")])
+    monkeypatch.setattr(ovs, "port_status", lambda *args: status)
+
+    assert wait_stp_converged(topo.objects.values(), timeout=1, interval=0.01) < 0.5
+
+
+def test_wait_timeout(monkeypatch):
+    topo = ring(3)
+    topo.plan()
+
+    status = rstp_status(topo, [("Discarding", "Designated"), ("Forwarding", "Root")])
+    monkeypatch.setattr(ovs, "port_status", lambda *args: status)
+
+    with pytest.raises(STP_Wait_Error) as exc:
+        wait_stp_converged(topo.objects.values(), timeout=0.05, interval=0.01)
+
+    assert set(exc.value.stragglers) == {f"sw{i}/p0" for i in range(3)}
+    assert set(exc.value.stragglers.values()) == {"Discarding"}
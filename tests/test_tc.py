@@ -0,0 +1,119 @@
+"""
+================
+Link impairments
+================
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+"""
+
+import pytest
+
+from pyroute2.netlink.rtnl    import TC_H_ROOT
+
+from pyxnet.platform.tools    import netlink, tc
+from pyxnet.platform.tools.tc import Impairment
+
+
+NETEM = {"delay": 20, "jitter": 5, "loss": 0.5}
+TBF   = {"rate": "10mbit"}
+
+
+def qdiscs(msgs):
+    # (kind, handle, parent) of qdisc messages, kind is None for deletions
+    return [(msg.get_attr("TCA_KIND"), msg["handle"], msg["parent"]) for msg in msgs]
+
+
+@pytest.mark.parametrize("value, layout", [
+    (None                  , (False, False)),
+    ({}                    , (False, False)),
+    (NETEM                 , (True , False)),
+    ({"loss": 1}           , (True , False)),
+    (TBF                   , (False, True )),
+    (dict(NETEM, **TBF)    , (True , True )),
+    (Impairment(rate=1000) , (False, True )),
+])
+def test_layout(value, layout):
+    assert tc.layout(value) == layout
+    assert (tc.describe(value) is None) == (layout == (False, False))
+
+
+def test_requests():
+    assert qdiscs(Impairment(**NETEM).requests(3)) == [("netem", 0x10000, TC_H_ROOT)]
+    assert qdiscs(Impairment(**TBF).requests(3))   == [("tbf", 0x20000, TC_H_ROOT)]
+
+    # tbf goes under netem when both are used
+    assert qdiscs(Impairment(**NETEM, **TBF).requests(3)) == [
+        ("netem", 0x10000, TC_H_ROOT),
+        ("tbf"  , 0x20000, 0x10001),
+    ]
+    assert all(msg["index"] == 3 for msg in Impairment(**NETEM, **TBF).requests(3))
+
+
+@pytest.mark.parametrize("value, error", [
+    (NETEM                 , None),
+    ({"rate": 1000}        , None),
+    ({"rate": "10mbit"}    , None),
+    ({"delay": -1}         , "Negative impairment delay"),
+    ({"loss": 150}         , "loss above 100%"),
+    ({"rate": "10 parsecs"}, "Invalid impairment rate"),
+    ({"rate": "10furlong"} , "Invalid impairment rate"),
+    ({"speed": 3}          , "Invalid impairment"),
+    ([1, 2]                , "Invalid impairment"),
+])
+def test_check(value, error):
+    res = tc.check_impairment(value)
+    if error is None:
+        assert res is None
+    else:
+        assert error in res
+
+
+@pytest.fixture
+def batches(host, monkeypatch):
+    # Messages of each netlink batch
+    host.links[None]["eth0"] = host.new_link("eth0", "ether")
+    sent = list()
+
+    def batch(ipr, msgs):
+        sent.append(qdiscs(msgs))
+        return [None] * len(msgs)
+
+    monkeypatch.setattr(netlink, "batch", batch)
+    return sent
+
+
+def test_apply_in_place(batches):
+    # Same layout: the qdisc is replaced, without removing it first
+    tc.apply([("eth0", None, NETEM, dict(NETEM, delay=50))])
+    assert batches == [[("netem", 0x10000, TC_H_ROOT)]]
+
+
+def test_apply_new(batches):
+    tc.apply([("eth0", None, None, TBF)])
+    assert batches == [[("tbf", 0x20000, TC_H_ROOT)]]
+
+
+def test_apply_layout_change(batches):
+    # netem to netem + tbf: the qdiscs are removed first
+    tc.apply([("eth0", None, NETEM, dict(NETEM, **TBF))])
+    assert batches == [
+        [(None, 0, TC_H_ROOT)],
+        [("netem", 0x10000, TC_H_ROOT), ("tbf", 0x20000, 0x10001)],
+    ]
+
+
+def test_apply_removed(batches):
+    tc.apply([("eth0", None, TBF, None)])
+    assert batches == [[(None, 0, TC_H_ROOT)]]
+
+    batches.clear()
+    tc.apply([("eth0", None, None, None), ("eth0", None, {}, {})])
+    assert batches == []
+
+
+def test_apply_error(batches, monkeypatch):
+    monkeypatch.setattr(netlink, "batch", lambda ipr, msgs: [RuntimeError("no")] * len(msgs))
+
+    with pytest.raises(RuntimeError, match="1 qdisc requests failed"):
+        tc.apply([("eth0", None, None, NETEM)])
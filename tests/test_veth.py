@@ -0,0 +1,51 @@
+"""
+=============
+Veth batching
+=============
+
+:Authors: - Florian Dupeyron <florian.dupeyron@mugcat.fr>
+:Date: January 2023
+"""
+
+import pytest
+
+from pyxnet.platform.link import Link_VEth
+
+
+def test_create(host):
+    Link_VEth.instanciate_batch([Link_VEth("pxn-a", "pxn-b", p0_ip="10.0.0.1/24")])
+
+    assert {"pxn-a", "pxn-b"} <= host.links[None].keys()
+    assert host.addresses[(None, "pxn-a")] == {"10.0.0.1/24"}
+
+    # Existing pairs are configured again
+    index = host.links[None]["pxn-a"]["index"]
+    Link_VEth.instanciate_batch([Link_VEth("pxn-a", "pxn-b", p0_ip="10.0.0.1/24")])
+    assert host.links[None]["pxn-a"]["index"] == index
+
+    with pytest.raises(RuntimeError, match="already exists"):
+        Link_VEth.instanciate_batch([Link_VEth("pxn-a", "pxn-b")], exists_ok=False)
+
+
+def test_half_pair(host):
+    # The peer was in a namespace that is gone
+    lone = host.links[None]["pxn-a"] = host.new_link("pxn-a", "veth", "pxn-b")
+
+    Link_VEth.instanciate_batch([Link_VEth("pxn-a", "pxn-b", p1_ip="10.0.0.2/24")])
+
+    assert host.links[None]["pxn-a"]["index"] != lone["index"]
+    assert host.links[None]["pxn-b"].peer == "pxn-a"
+    assert host.addresses[(None, "pxn-b")] == {"10.0.0.2/24"}
+
+
+def test_missing_without_create(host):
+    with pytest.raises(RuntimeError, match="pxn-a of pxn-a@pxn-b not found in namespace host"):
+        Link_VEth.instanciate_batch([Link_VEth("pxn-a", "pxn-b")], create=False)
+
+    # The pair was never moved to its namespace
+    links = host.links[None]
+    links["pxn-a"] = host.new_link("pxn-a", "veth", "pxn-b")
+    links["pxn-b"] = host.new_link("pxn-b", "veth", "pxn-a")
+
+    with pytest.raises(RuntimeError, match="pxn-b of pxn-a@pxn-b not found in namespace ns1"):
+        Link_VEth.instanciate_batch([Link_VEth("pxn-a", "pxn-b", p1_netns="ns1")], create=False)